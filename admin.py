@@ -0,0 +1,127 @@
+import argparse
+import asyncio
+import json
+import logging
+import os
+import sys
+import time
+
+from cogs.requisition_cache import STATUS_PENDING
+from cogs.requisition_flow import NOTIFY_CHANNEL
+from cogs.storage import open_storage
+from cogs.transfer import FORMATS, TABLES, IMPORT_TABLES, read_batches, validate_batch, validate_channels
+
+# Configure logging
+logging.basicConfig(level=logging.INFO, format='%(asctime)s:%(levelname)s:%(name)s:%(message)s')
+logger = logging.getLogger('admin')
+
+DATABASE_URL = os.getenv('DATABASE_URL')
+
+# Offline administration of requisitions, feedback and channel configuration, against
+# DATABASE_URL:
+#
+#   python admin.py export --guild 123456789012345678 --format jsonl --output requisitions.jsonl
+#   python admin.py export --table feedback --output feedback.csv
+#   python admin.py import drive.csv --guild 123456789012345678
+#   python admin.py import channels.csv --table channels
+#
+# Exports stream straight from the database to the output. Imports are validated and
+# written in batches; rejected rows are logged with their line number and skipped. Open
+# requisitions without a message_id are posted by the bot process that owns their
+# guild - right away with Postgres, at its next start with SQLite. Imported channel
+# configuration replaces that of the same guilds.
+
+
+async def export(storage, args):
+    started = time.perf_counter()
+    export_table = getattr(storage, f"export_{args.table}")
+    if args.output == '-':
+        count = await export_table(sys.stdout, args.format, args.guild)
+    else:
+        with open(args.output, 'w', encoding='utf-8', newline='') as out:
+            count = await export_table(out, args.format, args.guild)
+    logger.info("Exported %d %s in %.2fs.", count, args.table, time.perf_counter() - started)
+
+
+async def import_channels(storage, args):
+    started = time.perf_counter()
+    imported, rejected, guilds = 0, 0, set()
+    with open(args.file, encoding='utf-8', newline='') as f:
+        for batch in read_batches(f, args.format, args.batch_size):
+            rows, errors = validate_channels(batch, args.guild)
+            for line, error in errors:
+                logger.warning("%s:%s: %s", args.file, line, error)
+            rejected += len(errors)
+            if rows and not args.dry_run:
+                imported += await storage.import_channels(rows)
+                guilds.update(row['guild_id'] for row in rows)
+    logger.info("Imported %d channel configurations, rejected %d, in %.2fs.", imported, rejected, time.perf_counter() - started)
+    # Running bots reload the configuration of their own guilds
+    for guild_id in guilds:
+        await storage.notify(NOTIFY_CHANNEL, json.dumps({'kind': 'config', 'id': guild_id, 'origin': 'admin'}))
+
+
+async def import_file(storage, args):
+    if args.table == 'channels':
+        await import_channels(storage, args)
+        return
+    started = time.perf_counter()
+    imported, rejected, pending_guilds = 0, 0, set()
+    with open(args.file, encoding='utf-8', newline='') as f:
+        for batch in read_batches(f, args.format, args.batch_size):
+            rows, errors = validate_batch(batch, args.guild)
+            for line, error in errors:
+                logger.warning("%s:%s: %s", args.file, line, error)
+            rejected += len(errors)
+            if rows and not args.dry_run:
+                imported += await storage.insert_requisitions(rows)
+                pending_guilds.update(row['guild_id'] for row in rows if row['status'] == STATUS_PENDING)
+    logger.info("Imported %d requisitions, rejected %d, in %.2fs.", imported, rejected, time.perf_counter() - started)
+    for guild_id in pending_guilds:
+        await storage.notify(NOTIFY_CHANNEL, json.dumps({'kind': 'pending', 'id': guild_id, 'origin': 'admin'}))
+    if pending_guilds and not storage.shared:
+        logger.info("New requisitions will be posted when the bot next starts.")
+
+
+def file_format(path, requested):
+    if requested:
+        return requested
+    return 'jsonl' if path.endswith(('.jsonl', '.json')) else 'csv'
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Export and import MatMaster requisitions, feedback and channels.")
+    commands = parser.add_subparsers(dest='command', required=True)
+    export_parser = commands.add_parser('export', help="write requisitions, feedback or channels as CSV or JSONL")
+    export_parser.add_argument('--table', choices=TABLES, default='requisitions')
+    export_parser.add_argument('--guild', type=int, help="only this guild's rows")
+    export_parser.add_argument('--format', choices=FORMATS)
+    export_parser.add_argument('--output', default='-', help="file to write, - for stdout (default)")
+    import_parser = commands.add_parser('import', help="bulk-insert requisitions or channels from CSV or JSONL")
+    import_parser.add_argument('file')
+    import_parser.add_argument('--table', choices=IMPORT_TABLES, default='requisitions')
+    import_parser.add_argument('--guild', type=int, help="import every row into this guild")
+    import_parser.add_argument('--format', choices=FORMATS)
+    import_parser.add_argument('--batch-size', type=int, default=5000)
+    import_parser.add_argument('--dry-run', action='store_true', help="validate only")
+    args = parser.parse_args()
+
+    if not DATABASE_URL:
+        logger.error("DATABASE_URL is not set.")
+        exit(1)
+    if args.command == 'export':
+        args.format = file_format(args.output, args.format)
+    else:
+        args.format = file_format(args.file, args.format)
+
+    storage = open_storage(DATABASE_URL, max_size=1, timeout=60.0)
+    await storage.open()
+    try:
+        await storage.migrate()
+        await (export(storage, args) if args.command == 'export' else import_file(storage, args))
+    finally:
+        await storage.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
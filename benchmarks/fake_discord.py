@@ -0,0 +1,140 @@
+import asyncio
+import itertools
+import time
+from types import SimpleNamespace
+
+# In-process stand-ins for the parts of discord.py RequisitionFlow touches, so the cog
+# can be driven without a gateway connection. Sends and edits complete immediately
+# (after an optional simulated REST delay) and hand out snowflake-like message IDs.
+
+DISCORD_EPOCH_MS = 1420070400000
+
+_increment = itertools.count()
+
+
+def snowflake():
+    return ((int(time.time() * 1000) - DISCORD_EPOCH_MS) << 22) | (next(_increment) & 0x3FFFFF)
+
+
+class FakeUser:
+    def __init__(self, user_id, bot=False):
+        self.id = user_id
+        self.bot = bot
+        self.sent = 0
+
+    @property
+    def mention(self):
+        return f"<@{self.id}>"
+
+    async def send(self, content):
+        self.sent += 1
+        return FakeMessage(None, content)
+
+
+class FakePermissions:
+    administrator = False
+
+
+class FakeMessage:
+    def __init__(self, channel, content, message_id=None):
+        self.id = message_id or snowflake()
+        self.channel = channel
+        self.content = content
+
+    async def add_reaction(self, emoji):
+        await self.channel.rest()
+
+    async def edit(self, content=None):
+        await self.channel.rest()
+        self.content = content
+        self.channel.edits += 1
+        return self
+
+    async def delete(self):
+        await self.channel.rest()
+        self.channel.deleted += 1
+
+
+class FakeChannel:
+    def __init__(self, channel_id, guild_id, rest_delay=0.0):
+        self.id = channel_id
+        self.guild_id = guild_id
+        self.rest_delay = rest_delay
+        self.sent = 0
+        self.edits = 0
+        self.deleted = 0
+
+    async def rest(self):
+        if self.rest_delay:
+            await asyncio.sleep(self.rest_delay)
+
+    async def send(self, content=None, **kwargs):
+        await self.rest()
+        self.sent += 1
+        return FakeMessage(self, content)
+
+    def get_partial_message(self, message_id):
+        return FakeMessage(self, None, message_id)
+
+    async def delete_messages(self, messages):
+        await self.rest()
+        self.deleted += len(messages)
+
+    def permissions_for(self, member):
+        return FakePermissions()
+
+
+class FakeContext:
+    def __init__(self, author, guild_id, channel):
+        self.author = author
+        self.guild = SimpleNamespace(id=guild_id, name=f"guild {guild_id}")
+        self.channel = channel
+        self.replies = []
+
+    async def send(self, content=None, **kwargs):
+        self.replies.append(content)
+        return FakeMessage(self.channel, content)
+
+
+# Just enough of commands.Bot for the cog: channel and user lookups and readiness.
+class FakeBot:
+    def __init__(self, rest_delay=0.0):
+        self.user = FakeUser(1, bot=True)
+        self.rest_delay = rest_delay
+        self.channels = {}
+        self.users = {}
+
+    def add_channel(self, channel_id, guild_id):
+        channel = self.channels[channel_id] = FakeChannel(channel_id, guild_id, self.rest_delay)
+        return channel
+
+    def get_channel(self, channel_id):
+        return self.channels.get(channel_id)
+
+    def get_partial_messageable(self, channel_id):
+        return self.channels.get(channel_id) or FakeChannel(channel_id, None, self.rest_delay)
+
+    def get_user(self, user_id):
+        return self.users.get(user_id)
+
+    async def fetch_user(self, user_id):
+        await asyncio.sleep(self.rest_delay)
+        user = self.users[user_id] = FakeUser(user_id)
+        return user
+
+    async def wait_until_ready(self):
+        return None
+
+    def member(self, user_id):
+        user = self.users.get(user_id)
+        if user is None:
+            user = self.users[user_id] = FakeUser(user_id)
+        return user
+
+
+def reaction(guild_id, channel_id, message_id, user, emoji):
+    # Shaped like discord.RawReactionActionEvent
+    return SimpleNamespace(
+        guild_id=guild_id, channel_id=channel_id, message_id=message_id,
+        user_id=user.id, member=user, emoji=emoji
+    )
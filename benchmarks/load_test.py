@@ -0,0 +1,355 @@
+import argparse
+import asyncio
+import json
+import logging
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.fake_discord import FakeBot, FakeContext, reaction, snowflake  # noqa: E402
+from cogs.logs import CATEGORY_REACTION, TEXT_FORMAT, setup_logging  # noqa: E402
+from cogs.requisition import Requisition  # noqa: E402
+from cogs.requisition_flow import RequisitionFlow  # noqa: E402
+from cogs.storage import open_storage  # noqa: E402
+
+# Offline load tests for RequisitionFlow. The cog runs unmodified against a FakeBot in
+# place of the gateway and a scratch database (Postgres or SQLite), and every scenario
+# reports events/sec, p50/p99 handler latency and RSS as JSON so runs can be compared.
+#
+#   python benchmarks/load_test.py --database-url postgresql://localhost/matmaster_bench
+#   python benchmarks/load_test.py --database-url sqlite:///bench.db --scenario reaction_storm --output results.json
+#
+# The database must be a scratch one: its MatMaster tables are emptied before each scenario.
+
+logger = logging.getLogger('benchmark')
+
+TABLES = ('requisitions', 'reminders', 'conversations', 'channels', 'demand_stats', 'stats_events', 'stats_daily',
+          'feedback', 'reputation')
+MATERIALS = ['Iron Ingot', 'Copper Wire', 'Steel Plate', 'Oak Plank', 'Leather', 'Silk Thread', 'Gold Bar', 'Obsidian']
+REGIONS = ['EU', 'NA', 'SA', 'OCE', 'ASIA']
+
+
+def rss_mb():
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2 ** 20
+    except OSError:
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def percentile(values, q):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * (len(ordered) - 1) + 0.5))]
+
+
+def result(scenario, events, seconds, latencies, **extra):
+    return {
+        'scenario': scenario,
+        'events': events,
+        'seconds': round(seconds, 4),
+        'events_per_sec': round(events / seconds, 2) if seconds else None,
+        'p50_ms': round(percentile(latencies, 0.5) * 1000, 3) if latencies else None,
+        'p99_ms': round(percentile(latencies, 0.99) * 1000, 3) if latencies else None,
+        'rss_mb': round(rss_mb(), 1),
+        **extra
+    }
+
+
+async def timed(latencies, coro):
+    started = time.perf_counter()
+    await coro
+    latencies.append(time.perf_counter() - started)
+
+
+# One bot, database and cog per scenario, with guilds already configured
+class Harness:
+    def __init__(self, database_url, guilds, rest_delay=0.0, **cog_kwargs):
+        self.database_url = database_url
+        self.guild_count = guilds
+        self.cog_kwargs = cog_kwargs
+        self.bot = FakeBot(rest_delay)
+        self.storage = open_storage(database_url)
+        self.cog = None
+        self.guilds = []
+
+    async def open(self):
+        await self.storage.open()
+        await self.storage.migrate()
+        for table in TABLES:
+            await self.storage.db.execute(f"DELETE FROM {table};")
+        for index in range(self.guild_count):
+            guild_id, channel_id, archive_id = snowflake(), snowflake(), snowflake()
+            self.bot.add_channel(channel_id, guild_id)
+            self.bot.add_channel(archive_id, guild_id)
+            self.guilds.append((guild_id, channel_id))
+            await self.storage.save_channel_config(guild_id, channel_id, archive_id, f"Server {index}")
+
+    async def start(self):
+        self.cog = RequisitionFlow(self.bot, self.storage, **self.cog_kwargs)
+        # Benchmarks measure MatMaster, not Discord's rate limits
+        self.cog.outbound.route_rate = 10 ** 9
+        started = time.perf_counter()
+        await self.cog.cog_load()
+        await self.cog.ready.wait()
+        return time.perf_counter() - started
+
+    async def stop(self):
+        await self.cog.cog_unload()
+        self.cog = None
+
+    async def close(self):
+        if self.cog is not None:
+            await self.stop()
+        await self.storage.close()
+
+    async def create(self, guild_index, requester_id):
+        guild_id, channel_id = self.guilds[guild_index]
+        ctx = FakeContext(self.bot.member(requester_id), guild_id, self.bot.get_channel(channel_id))
+        await self.cog.create_requisition(
+            ctx, random.choice(MATERIALS), random.randint(1, 500), 'gold',
+            (datetime.now() + timedelta(days=30)).strftime('%Y-%m-%d %H:%M'), random.choice(REGIONS)
+        )
+        return ctx
+
+
+async def requisitions(args):
+    # Many open requisitions at once: create them concurrently, then accept each one
+    harness = Harness(args.database_url, args.guilds, args.rest_delay, cache_size=args.requisitions + 1000)
+    await harness.open()
+    await harness.start()
+    try:
+        semaphore = asyncio.Semaphore(args.concurrency)
+
+        async def create(index):
+            async with semaphore:
+                await timed(create_latencies, harness.create(index % args.guilds, 10_000 + index))
+
+        create_latencies = []
+        started = time.perf_counter()
+        await asyncio.gather(*(create(index) for index in range(args.requisitions)))
+        create_seconds = time.perf_counter() - started
+
+        open_requisitions = list(harness.cog.active_requisitions.values())
+        accept_latencies = []
+
+        async def accept(index, requisition):
+            async with semaphore:
+                channel_id = harness.cog.channel_ids[requisition.guild_id]['REQUISITIONS_CHANNEL_ID']
+                payload = reaction(requisition.guild_id, channel_id, requisition.message_id,
+                                   harness.bot.member(1_000_000 + index), '✋')
+                await timed(accept_latencies, harness.cog.on_raw_reaction_add(payload))
+
+        started = time.perf_counter()
+        await asyncio.gather(*(accept(index, requisition) for index, requisition in enumerate(open_requisitions)))
+        accept_seconds = time.perf_counter() - started
+        return [
+            result('requisitions.create', len(create_latencies), create_seconds, create_latencies,
+                   open_requisitions=len(open_requisitions)),
+            result('requisitions.accept', len(accept_latencies), accept_seconds, accept_latencies)
+        ]
+    finally:
+        await harness.close()
+
+
+async def reaction_storm(args):
+    # A steady stream of accept/unaccept reactions on a single hot post
+    harness = Harness(args.database_url, 1, args.rest_delay)
+    await harness.open()
+    await harness.start()
+    try:
+        await harness.create(0, 42)
+        requisition = next(iter(harness.cog.active_requisitions.values()))
+        guild_id, channel_id = harness.guilds[0]
+        latencies = []
+        tasks = []
+        interval = 1 / args.rate
+        total = int(args.rate * args.duration)
+        started = time.perf_counter()
+        for index in range(total):
+            user = harness.bot.member(2_000_000 + index % args.storm_users)
+            payload = reaction(guild_id, channel_id, requisition.message_id, user, '✋')
+            handler = harness.cog.on_raw_reaction_add if (index // args.storm_users) % 2 == 0 else harness.cog.on_raw_reaction_remove
+            tasks.append(asyncio.ensure_future(timed(latencies, handler(payload))))
+            delay = started + (index + 1) * interval - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+        await asyncio.gather(*tasks)
+        seconds = time.perf_counter() - started
+        channel = harness.bot.get_channel(channel_id)
+        return [result('reaction_storm', total, seconds, latencies, target_rate=args.rate,
+                       accepted=len(requisition.accepted_by), post_edits=channel.edits)]
+    finally:
+        await harness.close()
+
+
+async def cold_start(args):
+    # Startup against a large history of mostly archived requisitions, first from the
+    # database alone and then again from the snapshot written on shutdown
+    snapshot_path = os.path.join(tempfile.mkdtemp(), 'snapshot.json.gz')
+    harness = Harness(args.database_url, args.guilds, args.rest_delay, snapshot_path=snapshot_path)
+    await harness.open()
+    now = datetime.now()
+    statuses = ['archived'] * 17 + ['cancelled', 'expired', 'open']
+    batch = 10_000
+    for start in range(0, args.history, batch):
+        rows = []
+        for index in range(start, min(start + batch, args.history)):
+            guild_id, _ = harness.guilds[index % args.guilds]
+            requisition = Requisition(
+                10_000 + index % 5000, random.choice(MATERIALS), random.randint(1, 500), 'gold',
+                now + timedelta(days=random.randint(-365, 60)), random.choice(REGIONS), guild_id,
+                status=random.choice(statuses), message_id=snowflake()
+            )
+            rows.append(requisition.to_row())
+        await harness.storage.insert_requisitions(rows)
+    # History predates the snapshot, as it would in production
+    await harness.storage.db.execute("UPDATE requisitions SET updated_at = '2000-01-01 00:00:00';")
+    await harness.storage.db.execute("ANALYZE requisitions;")
+
+    before = rss_mb()
+    try:
+        seconds = await harness.start()
+        loaded = len(harness.cog.active_requisitions)
+        results = [result('cold_start', 1, seconds, [seconds], history_rows=args.history,
+                          loaded_requisitions=loaded, rss_growth_mb=round(rss_mb() - before, 1))]
+        await harness.stop()
+        seconds = await harness.start()
+        results.append(result('warm_start', 1, seconds, [seconds], history_rows=args.history,
+                              loaded_requisitions=len(harness.cog.active_requisitions),
+                              snapshot_bytes=os.path.getsize(snapshot_path)))
+        return results
+    finally:
+        await harness.close()
+        shutil.rmtree(os.path.dirname(snapshot_path), ignore_errors=True)
+
+
+async def logging_overhead(args):
+    # One sequence of accept/unaccept reactions, handled one at a time with logging off
+    # (WARNING), at DEBUG through a synchronous handler, and at DEBUG through the sampled
+    # queue. The extra handler time per event over the first run is the cost of logging
+    # on the event loop.
+    harness = Harness(args.database_url, 1, args.rest_delay)
+    await harness.open()
+    await harness.start()
+    log_dir = tempfile.mkdtemp()
+    root = logging.getLogger()
+    root_handlers, root_level = root.handlers[:], root.level
+    record_globals = (logging._srcfile, logging.logThreads, logging.logProcesses, logging.logMultiprocessing)
+    try:
+        await harness.create(0, 42)
+        requisition = next(iter(harness.cog.active_requisitions.values()))
+        guild_id, channel_id = harness.guilds[0]
+
+        async def react():
+            latencies = []
+            started = time.perf_counter()
+            for index in range(args.log_events):
+                user = harness.bot.member(3_000_000 + index % args.storm_users)
+                payload = reaction(guild_id, channel_id, requisition.message_id, user, '✋')
+                handler = harness.cog.on_raw_reaction_add if (index // args.storm_users) % 2 == 0 else harness.cog.on_raw_reaction_remove
+                await timed(latencies, handler(payload))
+            return time.perf_counter() - started, latencies
+
+        def configure(mode, stream):
+            for existing in root.handlers[:]:
+                root.removeHandler(existing)
+            if mode == 'queued':
+                # As the bot configures it
+                return setup_logging('DEBUG', sample_rates={CATEGORY_REACTION: args.log_sample_rate}, stream=stream,
+                                     lean_records=True)
+            handler = logging.StreamHandler(stream)
+            handler.setFormatter(logging.Formatter(TEXT_FORMAT))
+            root.addHandler(handler)
+            root.setLevel(logging.WARNING if mode == 'off' else logging.DEBUG)
+            return None
+
+        # Warm caches and the database first so the baseline isn't penalized
+        configure('off', open(os.devnull, 'w'))
+        await react()
+        results = []
+        baseline = None
+        for mode in ('off', 'sync', 'queued'):
+            path = os.path.join(log_dir, f'{mode}.log')
+            with open(path, 'w') as stream:
+                listener = configure(mode, stream)
+                seconds, latencies = await react()
+                if listener is not None:
+                    listener.stop()
+            if baseline is None:
+                baseline = seconds
+            results.append(result(f'logging.{mode}', args.log_events, seconds, latencies,
+                                  overhead_us_per_event=round((seconds - baseline) / args.log_events * 1e6, 2),
+                                  log_bytes=os.path.getsize(path)))
+        return results
+    finally:
+        for existing in root.handlers[:]:
+            root.removeHandler(existing)
+        for existing in root_handlers:
+            root.addHandler(existing)
+        root.setLevel(root_level)
+        logging._srcfile, logging.logThreads, logging.logProcesses, logging.logMultiprocessing = record_globals
+        await harness.close()
+        shutil.rmtree(log_dir, ignore_errors=True)
+
+
+SCENARIOS = {
+    'requisitions': requisitions,
+    'reaction_storm': reaction_storm,
+    'cold_start': cold_start,
+    'logging': logging_overhead,
+}
+
+
+async def run(args):
+    results = []
+    for name in args.scenario or SCENARIOS:
+        logger.info(f"Running {name}...")
+        results.extend(await SCENARIOS[name](args))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Offline load tests for RequisitionFlow.')
+    parser.add_argument('--database-url', required=True, help='scratch database URL (postgresql:// or sqlite:///); its tables are emptied')
+    parser.add_argument('--scenario', action='append', choices=sorted(SCENARIOS))
+    parser.add_argument('--guilds', type=int, default=100)
+    parser.add_argument('--requisitions', type=int, default=10_000)
+    parser.add_argument('--concurrency', type=int, default=200)
+    parser.add_argument('--rate', type=float, default=500, help='reactions per second for reaction_storm')
+    parser.add_argument('--duration', type=float, default=10, help='seconds of reaction_storm')
+    parser.add_argument('--storm-users', type=int, default=250, help='distinct users reacting in reaction_storm')
+    parser.add_argument('--history', type=int, default=1_000_000, help='historical rows for cold_start')
+    parser.add_argument('--log-events', type=int, default=5000, help='reactions per logging configuration')
+    parser.add_argument('--log-sample-rate', type=float, default=0.01, help='share of reaction records kept by the queued logging run')
+    parser.add_argument('--rest-delay', type=float, default=0.0, help='simulated Discord REST latency in seconds')
+    parser.add_argument('--output', help='write JSON results here instead of stdout')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING, format='%(asctime)s:%(levelname)s:%(name)s:%(message)s')
+    logger.setLevel(logging.INFO)
+    results = asyncio.run(run(args))
+    report = json.dumps({
+        'timestamp': datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'results': results
+    }, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(report + '\n')
+    else:
+        print(report)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,141 @@
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+# Compares the resident memory discord.py's cache needs per 1,000 guilds with the old
+# member-chunking setup and the lean one matmaster.py runs with now. Each profile is
+# loaded in a fresh interpreter from synthetic GUILD_CREATE payloads; for the full
+# profile every member is included, as it would be once chunking has finished.
+#
+#   python benchmarks/memory_report.py --guilds 1000 --members 250
+
+BOT_ID = 1 << 40
+
+PROFILES = ('full', 'lean')
+
+
+def rss_bytes():
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+
+def user_payload(user_id):
+    return {
+        'id': str(user_id),
+        'username': f"user{user_id}",
+        'discriminator': '0',
+        'global_name': None,
+        'avatar': None,
+    }
+
+
+def member_payload(user_id):
+    return {
+        'user': user_payload(user_id),
+        'roles': [],
+        'joined_at': '2023-01-01T00:00:00+00:00',
+        'deaf': False,
+        'mute': False,
+        'flags': 0,
+    }
+
+
+def guild_payload(guild_id, members, channels, with_members):
+    member_ids = range(guild_id * members + 1, guild_id * members + members) if with_members else ()
+    return {
+        'id': str(guild_id),
+        'name': f"guild {guild_id}",
+        'owner_id': str(BOT_ID),
+        'member_count': members,
+        'large': members > 250,
+        'roles': [{
+            'id': str(guild_id), 'name': '@everyone', 'permissions': '0', 'position': 0,
+            'color': 0, 'hoist': False, 'managed': False, 'mentionable': False, 'flags': 0,
+        }],
+        'channels': [{
+            'id': str(guild_id * 1000 + index), 'type': 0, 'name': f"channel-{index}",
+            'position': index, 'permission_overwrites': [], 'nsfw': False,
+        } for index in range(channels)],
+        'members': [member_payload(BOT_ID)] + [member_payload(user_id) for user_id in member_ids],
+        'emojis': [],
+        'stickers': [],
+        'features': [],
+        'voice_states': [],
+        'presences': [],
+        'threads': [],
+        'stage_instances': [],
+        'guild_scheduled_events': [],
+    }
+
+
+def build_state(profile):
+    import discord
+    from discord.state import ConnectionState
+
+    intents = discord.Intents.default()
+    intents.message_content = True
+    if profile == 'full':
+        intents.members = True
+        flags = discord.MemberCacheFlags.from_intents(intents)
+    else:
+        flags = discord.MemberCacheFlags.none()
+    state = ConnectionState(
+        dispatch=lambda *args, **kwargs: None, handlers={}, hooks={}, http=None,
+        intents=intents, member_cache_flags=flags, max_messages=100,
+        chunk_guilds_at_startup=profile == 'full'
+    )
+    state.user = discord.ClientUser(state=state, data={**user_payload(BOT_ID), 'bot': True})
+    return state
+
+
+def measure(profile, guilds, members, channels):
+    state = build_state(profile)
+    before = rss_bytes()
+    for guild_id in range(1, guilds + 1):
+        # Without the members intent Discord only sends the bot's own member
+        state._add_guild_from_data(guild_payload(guild_id, members, channels, profile == 'full'))
+    after = rss_bytes()
+    return {
+        'profile': profile,
+        'guilds': guilds,
+        'members_per_guild': members,
+        'cached_members': sum(len(guild._members) for guild in state._guilds.values()),
+        'cached_users': len(state._users),
+        'rss_bytes': after - before,
+        'rss_mb_per_1k_guilds': (after - before) / guilds * 1000 / 2 ** 20,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare discord.py cache memory with and without member caching.')
+    parser.add_argument('--guilds', type=int, default=1000)
+    parser.add_argument('--members', type=int, default=250, help='members per guild')
+    parser.add_argument('--channels', type=int, default=10, help='text channels per guild')
+    parser.add_argument('--profile', choices=PROFILES, help='measure a single profile in this process')
+    args = parser.parse_args()
+
+    if args.profile:
+        print(json.dumps(measure(args.profile, args.guilds, args.members, args.channels)))
+        return
+
+    results = []
+    for profile in PROFILES:
+        output = subprocess.check_output([
+            sys.executable, __file__, '--profile', profile, '--guilds', str(args.guilds),
+            '--members', str(args.members), '--channels', str(args.channels)
+        ])
+        results.append(json.loads(output))
+
+    print(f"{'profile':<8} {'members cached':>15} {'users cached':>13} {'RSS MB / 1k guilds':>19}")
+    for result in results:
+        print(f"{result['profile']:<8} {result['cached_members']:>15} {result['cached_users']:>13} "
+              f"{result['rss_mb_per_1k_guilds']:>19.1f}")
+    full, lean = results
+    if lean['rss_bytes'] > 0:
+        print(f"Lean profile uses {full['rss_bytes'] / lean['rss_bytes']:.1f}x less memory.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,98 @@
+import argparse
+import os
+import random
+import sys
+import tracemalloc
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from cogs.requisition import Requisition, DEADLINE_FORMAT  # noqa: E402
+
+# Measures the bytes each open requisition costs in the working set, for the slotted
+# Requisition model and for the dicts it replaced. Rows are generated the way psycopg2
+# returns them - every string a fresh object - so interning is measured too.
+#
+#   python benchmarks/requisition_memory.py --count 100000
+
+MATERIALS = ['Iron Ingot', 'Copper Wire', 'Steel Plate', 'Oak Plank', 'Leather', 'Silk Thread',
+             'Gold Bar', 'Obsidian', 'Glass Pane', 'Coal']
+PAYMENTS = ['gold', '500 gold', 'trade', 'free', '1000 silver']
+REGIONS = ['EU', 'NA', 'SA', 'OCE', 'ASIA']
+STATUSES = ['open', 'accepted', 'completed']
+
+
+def fresh(text):
+    # A new string object with the same value, like a freshly decoded column
+    return ''.join(list(text))
+
+
+def make_row(index, rng):
+    accepted = [rng.getrandbits(62) for _ in range(rng.randint(0, 3))]
+    return {
+        'id': index,
+        'message_id': rng.getrandbits(62),
+        'guild_id': rng.getrandbits(62),
+        'requester': rng.getrandbits(62),
+        'material': fresh(rng.choice(MATERIALS)),
+        'quantity': rng.randint(1, 1000),
+        'payment': fresh(rng.choice(PAYMENTS)),
+        'deadline': datetime(2024, 1, 1) + timedelta(minutes=rng.randint(0, 500000)),
+        'region': fresh(rng.choice(REGIONS)),
+        'accepted_by': accepted,
+        'completed_by': accepted[:len(accepted) // 2],
+        'completion_details': None,
+        'status': fresh(rng.choice(STATUSES)),
+    }
+
+
+def legacy_from_row(row):
+    # The per-message dict MatMaster used to keep
+    return {
+        'requester': row['requester'],
+        'material': row['material'],
+        'quantity': row['quantity'],
+        'payment': row['payment'],
+        'deadline': row['deadline'].strftime(DEADLINE_FORMAT),
+        'accepted_by': list(row['accepted_by'] or []),
+        'completed_by': list(row['completed_by'] or []),
+        'region': row['region'],
+        'completion_details': row.get('completion_details') or "",
+        'status': row['status'],
+        'guild_id': row['guild_id']
+    }
+
+
+def measure(convert, count, seed):
+    # Rows are built and dropped one at a time, so only what the working set keeps is counted
+    rng = random.Random(seed)
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    entries = {}
+    for index in range(count):
+        row = make_row(index, rng)
+        entries[row['message_id']] = convert(row)
+    del row
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return (after - before) / len(entries)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Bytes per open requisition in the working set.')
+    parser.add_argument('--count', type=int, default=100000)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    results = {}
+    for name, convert in (('dict', legacy_from_row), ('Requisition', Requisition.from_row)):
+        results[name] = measure(convert, args.count, args.seed)
+
+    print(f"{args.count} open requisitions")
+    for name, per_entry in results.items():
+        print(f"{name:<12} {per_entry:>8.0f} bytes each  {per_entry * args.count / 2 ** 20:>8.1f} MB total")
+    print(f"Requisition uses {results['dict'] / results['Requisition']:.1f}x less memory per entry.")
+
+
+if __name__ == "__main__":
+    main()
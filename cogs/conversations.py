@@ -0,0 +1,226 @@
+import asyncio
+import json
+import logging
+from collections import deque
+from datetime import datetime, timedelta
+
+import discord
+
+from cogs import metrics
+
+logger = logging.getLogger('matmaster.conversations')
+
+live_sessions = metrics.gauge('matmaster_conversations_live', 'Interactive conversations waiting for a reply.')
+timed_out_total = metrics.counter('matmaster_conversations_timed_out_total', 'Conversations ended by a step timeout or TTL.')
+
+
+class Step:
+    def __init__(self, key, prompt, parse=None):
+        self.key = key
+        self.prompt = prompt
+        self.parse = parse
+
+    def render(self, session):
+        return self.prompt(session) if callable(self.prompt) else self.prompt
+
+
+class Flow:
+    def __init__(self, name, steps, on_complete, on_timeout=None, step_timeout=None, ttl=None):
+        self.name = name
+        self.steps = steps
+        self.on_complete = on_complete
+        self.on_timeout = on_timeout
+        self.step_timeout = step_timeout
+        self.ttl = ttl
+
+
+class Session:
+    __slots__ = ('id', 'user_id', 'channel_id', 'guild_id', 'flow', 'step', 'data', 'context',
+                 'step_deadline', 'expires_at')
+
+    def __init__(self, user_id, channel_id, guild_id, flow, step=0, data=None, context=None,
+                 step_deadline=None, expires_at=None, id=None):
+        self.id = id
+        self.user_id = user_id
+        self.channel_id = channel_id
+        self.guild_id = guild_id
+        self.flow = flow
+        self.step = step
+        self.data = data or {}
+        self.context = context or {}
+        self.step_deadline = step_deadline
+        self.expires_at = expires_at
+
+    @property
+    def key(self):
+        return (self.user_id, self.channel_id)
+
+
+# Interactive conversations as persisted state machines instead of bot.wait_for
+# listeners. Sessions are indexed by (user ID, channel ID) - channel ID is None for
+# DMs - so each incoming message costs one dict lookup no matter how many
+# conversations are open. Each key holds a queue; only its head is prompted and
+# answered, later sessions start when it ends. Every step has a timeout and every
+# session a TTL, enforced by a periodic sweep, and state is stored in the
+# conversations table so a restart resumes where the user left off.
+#
+# In a sharded cluster a process only holds the sessions it will receive replies
+# for: guild-channel sessions for its own guilds, and DM sessions only if it owns
+# the shard DMs arrive on. A DM session begun elsewhere is saved and handed to
+# that process through the on_remote callback, which ends up calling adopt().
+class ConversationManager:
+    def __init__(self, storage, send, step_timeout=300, ttl=1800, sweep_interval=15,
+                 owns=lambda session: True, on_remote=None):
+        self.storage = storage
+        self.send = send
+        self.owns = owns
+        self.on_remote = on_remote
+        self.step_timeout = step_timeout
+        self.ttl = ttl
+        self.sweep_interval = sweep_interval
+        self.flows = {}
+        self.sessions = {}
+        self.task = None
+        live_sessions.set_function(lambda: len(self))
+
+    def __len__(self):
+        return sum(len(queue) for queue in self.sessions.values())
+
+    def register(self, flow):
+        self.flows[flow.name] = flow
+
+    def _from_row(self, row):
+        return Session(
+            row['user_id'], row['channel_id'], row['guild_id'], row['flow'], row['step'],
+            json.loads(row['data']), json.loads(row['context']), row['step_deadline'],
+            row['expires_at'], row['id']
+        )
+
+    async def load(self):
+        self.sessions = {}
+        rows = await self.storage.load_conversations()
+        for row in rows:
+            if row['flow'] not in self.flows:
+                continue
+            session = self._from_row(row)
+            if self.owns(session):
+                self.sessions.setdefault(session.key, deque()).append(session)
+        logger.info("Resumed %d conversations.", len(self))
+
+    async def start(self):
+        self.task = asyncio.create_task(self.sweep())
+
+    async def stop(self):
+        if self.task:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+
+    def _timeouts(self, flow):
+        step_timeout = timedelta(seconds=flow.step_timeout or self.step_timeout)
+        ttl = timedelta(seconds=flow.ttl or self.ttl)
+        return step_timeout, ttl
+
+    async def begin(self, flow_name, user_id, channel_id, guild_id, context=None, replace=False):
+        flow = self.flows[flow_name]
+        step_timeout, ttl = self._timeouts(flow)
+        now = datetime.now()
+        session = Session(user_id, channel_id, guild_id, flow_name, context=context,
+                          step_deadline=now + step_timeout, expires_at=now + ttl)
+        if replace:
+            while self.sessions.get(session.key):
+                await self._end(session.key, prompt_next=False)
+        session.id = await self.storage.insert_conversation(
+            user_id, channel_id, guild_id, flow_name, 0, json.dumps(session.data), json.dumps(session.context),
+            session.step_deadline, session.expires_at
+        )
+        if not self.owns(session):
+            if self.on_remote:
+                await self.on_remote(session)
+            return session
+        await self._enqueue(session)
+        return session
+
+    async def adopt(self, session_id):
+        # Takes over a session another process saved for us
+        row = await self.storage.get_conversation(session_id)
+        if row is None or row['flow'] not in self.flows:
+            return
+        session = self._from_row(row)
+        if self.owns(session) and not any(s.id == session.id for s in self.sessions.get(session.key, ())):
+            await self._enqueue(session)
+
+    async def _enqueue(self, session):
+        queue = self.sessions.setdefault(session.key, deque())
+        queue.append(session)
+        if len(queue) == 1:
+            await self._activate(session)
+
+    async def handle(self, message):
+        channel_id = None if isinstance(message.channel, discord.DMChannel) else message.channel.id
+        queue = self.sessions.get((message.author.id, channel_id))
+        if not queue:
+            return False
+
+        session = queue[0]
+        flow = self.flows[session.flow]
+        step = flow.steps[session.step]
+        try:
+            value = step.parse(message.content) if step.parse else message.content
+        except ValueError as e:
+            await self._end(session.key)
+            await self.send(session, str(e))
+            return True
+
+        session.data[step.key] = value
+        session.step += 1
+        if session.step == len(flow.steps):
+            await self._end(session.key)
+            await flow.on_complete(session, message)
+            return True
+
+        step_timeout, _ = self._timeouts(flow)
+        session.step_deadline = datetime.now() + step_timeout
+        await self.storage.update_conversation(session.id, session.step, json.dumps(session.data), session.step_deadline)
+        await self.send(session, flow.steps[session.step].render(session))
+        return True
+
+    async def _end(self, key, prompt_next=True):
+        queue = self.sessions.get(key)
+        session = queue.popleft()
+        if not queue:
+            del self.sessions[key]
+        await self.storage.delete_conversation(session.id)
+        if prompt_next and queue:
+            await self._activate(queue[0])
+        return session
+
+    async def _activate(self, session):
+        flow = self.flows[session.flow]
+        step_timeout, _ = self._timeouts(flow)
+        session.step_deadline = datetime.now() + step_timeout
+        await self.storage.set_conversation_deadline(session.id, session.step_deadline)
+        await self.send(session, flow.steps[session.step].render(session))
+
+    async def sweep(self):
+        while True:
+            await asyncio.sleep(self.sweep_interval)
+            now = datetime.now()
+            for key in list(self.sessions):
+                queue = self.sessions.get(key)
+                if not queue:
+                    continue
+                head = queue[0]
+                if head.step_deadline > now and head.expires_at > now:
+                    continue
+                timed_out_total.inc(flow=head.flow)
+                try:
+                    session = await self._end(key)
+                    flow = self.flows[session.flow]
+                    if flow.on_timeout:
+                        await flow.on_timeout(session)
+                except Exception as e:
+                    logger.error("Conversation timeout handling failed: %s", e)
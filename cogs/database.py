@@ -0,0 +1,223 @@
+import asyncio
+import logging
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+
+import psycopg2
+from psycopg2 import pool
+from psycopg2.extras import RealDictCursor
+
+from cogs import metrics
+
+logger = logging.getLogger('matmaster.storage')
+
+query_seconds = metrics.histogram('matmaster_db_query_seconds', 'Database call latency by statement, including pool wait.')
+query_errors = metrics.counter('matmaster_db_query_errors_total', 'Database calls that raised, by statement.')
+
+TABLE_RE = re.compile(r'\b(?:FROM|INTO|UPDATE|TABLE|ON)\s+(?:IF\s+NOT\s+EXISTS\s+)?(\w+)', re.IGNORECASE)
+
+# Errors that can mean the server side of a pooled connection went away
+CONNECTION_ERRORS = (psycopg2.OperationalError, psycopg2.InterfaceError)
+
+
+@lru_cache(maxsize=512)
+def statement_label(query):
+    # "UPDATE requisitions SET ..." -> "update requisitions", used as the metric label
+    words = query.split(None, 1)
+    if not words:
+        return 'other'
+    verb = words[0].lower()
+    match = TABLE_RE.search(query)
+    return f"{verb} {match.group(1).lower()}" if match else verb
+
+
+# Counts the statements that went through, so a transaction that failed on a broken
+# connection is only retried if nothing in it can have been applied
+class CountingCursor(RealDictCursor):
+    completed = 0
+
+    def execute(self, query, vars=None):
+        result = super().execute(query, vars)
+        self.completed += 1
+        return result
+
+    def copy_expert(self, sql, file, size=8192):
+        result = super().copy_expert(sql, file, size)
+        self.completed += 1
+        return result
+
+
+# Pooled psycopg2 access that keeps blocking calls off the event loop. Every query
+# runs on an executor sized to the pool, so at most max_size statements are in flight.
+class Database:
+    def __init__(self, dsn, min_size=1, max_size=10, timeout=10.0, retries=1, **connect_kwargs):
+        self.dsn = dsn
+        self.min_size = min_size
+        self.max_size = max_size
+        self.timeout = timeout
+        self.retries = retries
+        self.connect_kwargs = connect_kwargs
+        self.pool = None
+        self.executor = ThreadPoolExecutor(max_workers=max_size, thread_name_prefix='matmaster-db')
+
+    async def open(self):
+        loop = asyncio.get_running_loop()
+        self.pool = await loop.run_in_executor(self.executor, self._create_pool)
+        logger.info("Database pool opened (%d-%d connections).", self.min_size, self.max_size)
+
+    def _create_pool(self):
+        options = f"-c statement_timeout={int(self.timeout * 1000)}"
+        return pool.ThreadedConnectionPool(
+            self.min_size, self.max_size, self.dsn,
+            cursor_factory=CountingCursor, options=options, **self.connect_kwargs
+        )
+
+    async def close(self):
+        # Lets calls in flight finish before their connections are closed, waiting on
+        # another thread so the event loop keeps running meanwhile
+        await asyncio.get_running_loop().run_in_executor(None, self.executor.shutdown)
+        if self.pool is not None:
+            self.pool.closeall()
+            self.pool = None
+        logger.info("Database pool closed.")
+
+    def _run(self, fn, timeout):
+        for attempt in range(self.retries + 1):
+            try:
+                conn = self.pool.getconn()
+            except CONNECTION_ERRORS:
+                if attempt == self.retries:
+                    raise
+                logger.warning("Could not connect to the database, retrying.")
+                continue
+            cur = None
+            try:
+                with conn:
+                    with conn.cursor() as cur:
+                        if timeout is not None:
+                            cur.execute("SET LOCAL statement_timeout = %s", (int(timeout * 1000),))
+                            # Changes nothing if lost, so it doesn't count against a retry
+                            cur.completed = 0
+                        result = fn(cur)
+            except CONNECTION_ERRORS:
+                # A broken connection is discarded. The work is retried on a fresh one only
+                # if its first statement never went through; after that - up to and
+                # including COMMIT - it may have been applied, and fn isn't always safe to
+                # repeat. Statement timeouts and other errors on a live connection are
+                # raised as-is.
+                if not conn.closed:
+                    self.pool.putconn(conn)
+                    raise
+                self.pool.putconn(conn, close=True)
+                if attempt == self.retries or (cur is not None and cur.completed):
+                    raise
+                logger.warning("Database connection lost, reconnecting.")
+            except Exception:
+                self.pool.putconn(conn)
+                raise
+            else:
+                self.pool.putconn(conn)
+                return result
+
+    async def run(self, fn, timeout=None, label='transaction'):
+        # Runs fn(cursor) inside a single transaction on a pooled connection
+        loop = asyncio.get_running_loop()
+        started = time.perf_counter()
+        try:
+            return await loop.run_in_executor(self.executor, self._run, fn, timeout)
+        except Exception:
+            query_errors.inc(statement=label)
+            raise
+        finally:
+            query_seconds.observe(time.perf_counter() - started, statement=label)
+
+    async def execute(self, query, params=None, timeout=None):
+        def op(cur):
+            cur.execute(query, params)
+            return cur.rowcount
+        return await self.run(op, timeout, statement_label(query))
+
+    async def fetch(self, query, params=None, timeout=None):
+        def op(cur):
+            cur.execute(query, params)
+            return cur.fetchall()
+        return await self.run(op, timeout, statement_label(query))
+
+    async def fetchrow(self, query, params=None, timeout=None):
+        def op(cur):
+            cur.execute(query, params)
+            return cur.fetchone()
+        return await self.run(op, timeout, statement_label(query))
+
+    async def listen(self, channel, callback):
+        listener = Listener(self, channel, callback)
+        await listener.start()
+        return listener
+
+
+# LISTEN/NOTIFY subscriber on a dedicated autocommit connection. The socket is watched
+# with loop.add_reader, so notifications are delivered without polling or a thread.
+# If the connection drops it is re-established after a short delay.
+class Listener:
+    def __init__(self, db, channel, callback, retry_delay=5.0):
+        self.db = db
+        self.channel = channel
+        self.callback = callback
+        self.retry_delay = retry_delay
+        self.conn = None
+        self.closed = False
+        self.reconnect_task = None
+
+    def _connect(self):
+        conn = psycopg2.connect(self.db.dsn, **self.db.connect_kwargs)
+        conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+        with conn.cursor() as cur:
+            cur.execute(f"LISTEN {self.channel};")
+        return conn
+
+    async def start(self):
+        loop = asyncio.get_running_loop()
+        self.conn = await loop.run_in_executor(self.db.executor, self._connect)
+        loop.add_reader(self.conn.fileno(), self._on_readable)
+        logger.info("Listening for notifications on %s.", self.channel)
+
+    def _on_readable(self):
+        try:
+            self.conn.poll()
+        except CONNECTION_ERRORS as e:
+            logger.warning("Notification connection lost: %s", e)
+            self._drop()
+            self.reconnect_task = asyncio.get_running_loop().create_task(self._reconnect())
+            return
+        while self.conn.notifies:
+            notify = self.conn.notifies.pop(0)
+            try:
+                self.callback(notify.payload)
+            except Exception as e:
+                logger.error("Notification handler failed: %s", e)
+
+    def _drop(self):
+        if self.conn is not None:
+            try:
+                asyncio.get_running_loop().remove_reader(self.conn.fileno())
+            except (ValueError, psycopg2.InterfaceError):
+                pass
+            self.conn.close()
+            self.conn = None
+
+    async def _reconnect(self):
+        while not self.closed:
+            await asyncio.sleep(self.retry_delay)
+            try:
+                await self.start()
+                return
+            except CONNECTION_ERRORS as e:
+                logger.warning("Could not re-establish notification connection: %s", e)
+
+    async def close(self):
+        self.closed = True
+        if self.reconnect_task:
+            self.reconnect_task.cancel()
+        self._drop()
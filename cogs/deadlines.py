@@ -0,0 +1,117 @@
+import asyncio
+import re
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime, timedelta
+from zoneinfo import ZoneInfo
+
+from cogs import metrics
+
+parsed_total = metrics.counter('matmaster_deadline_parses_total', 'Deadline parses by the path that answered them.')
+
+# Written formats tried with strptime once ISO dates and relative phrases have been ruled out
+FORMATS = (
+    '%Y/%m/%d',
+    '%Y/%m/%d %H:%M',
+    '%d %B %Y',
+    '%d %b %Y',
+    '%B %d %Y',
+    '%b %d %Y',
+    '%B %d, %Y',
+    '%b %d, %Y',
+)
+
+UNITS = {
+    'minute': timedelta(minutes=1),
+    'hour': timedelta(hours=1),
+    'day': timedelta(days=1),
+    'week': timedelta(weeks=1),
+}
+RELATIVE_RE = re.compile(r'^(?:in\s+)?(\d+|an?|one)\s+(minute|hour|day|week)s?(?:\s+from\s+now)?$')
+NAMED_DAYS = {'today': 0, 'tonight': 0, 'tomorrow': 1, 'next week': 7}
+
+# Fallback parses mentioning these depend on the time of day, so they are never cached
+TIME_RELATIVE_RE = re.compile(r'\b(now|ago|hours?|minutes?|seconds?|mins?|hrs?|tonight)\b')
+
+
+# Deadline parsing with a strict fast path. ISO and common written dates go through
+# fromisoformat/strptime and simple relative phrases ("tomorrow", "in 3 days") through a regex; only
+# anything else reaches dateparser, which is imported on first use, restricted to the
+# configured languages and run on its own thread so it never blocks the event loop.
+# Fallback results are cached in a bounded LRU keyed by (input, timezone, today).
+class DeadlineParser:
+    def __init__(self, languages=('en',), cache_size=1024):
+        self.languages = list(languages)
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='dateparser')
+        self._dateparser = None
+
+    def to_local(self, value, timezone=None):
+        # Deadlines are stored as naive server-local times, as dateparser always returned
+        if value.tzinfo is None:
+            if not timezone:
+                return value
+            value = value.replace(tzinfo=ZoneInfo(timezone))
+        return value.astimezone().replace(tzinfo=None)
+
+    def parse_fast(self, text, timezone=None):
+        try:
+            return self.to_local(datetime.fromisoformat(text), timezone)
+        except ValueError:
+            pass
+
+        # Relative phrases are offsets from now, so the timezone doesn't change them
+        phrase = text.lower()
+        if phrase in NAMED_DAYS:
+            return datetime.now() + timedelta(days=NAMED_DAYS[phrase])
+        match = RELATIVE_RE.match(phrase)
+        if match:
+            amount = match.group(1)
+            count = int(amount) if amount.isdigit() else 1
+            return datetime.now() + count * UNITS[match.group(2)]
+
+        for fmt in FORMATS:
+            try:
+                return self.to_local(datetime.strptime(text, fmt), timezone)
+            except ValueError:
+                pass
+        return None
+
+    def _load(self):
+        if self._dateparser is None:
+            import dateparser
+            self._dateparser = dateparser
+        return self._dateparser
+
+    def _parse_slow(self, text, timezone):
+        settings = {'TIMEZONE': timezone} if timezone else None
+        value = self._load().parse(text, languages=self.languages, settings=settings)
+        return self.to_local(value, timezone) if value else None
+
+    async def warm(self):
+        # Pays the dateparser import cost in the background instead of on the first slow parse
+        await asyncio.get_running_loop().run_in_executor(self.executor, self._load)
+
+    async def parse(self, text, timezone=None):
+        text = ' '.join(text.split())
+        value = self.parse_fast(text, timezone)
+        if value is not None:
+            parsed_total.inc(path='fast')
+            return value
+
+        normalized = text.lower()
+        cacheable = not TIME_RELATIVE_RE.search(normalized)
+        key = (normalized, timezone, date.today())
+        if cacheable and key in self.cache:
+            self.cache.move_to_end(key)
+            parsed_total.inc(path='cache')
+            return self.cache[key]
+
+        value = await asyncio.get_running_loop().run_in_executor(self.executor, self._parse_slow, text, timezone)
+        parsed_total.inc(path='dateparser')
+        if cacheable:
+            self.cache[key] = value
+            while len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+        return value
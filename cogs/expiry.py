@@ -0,0 +1,65 @@
+import asyncio
+import logging
+import time
+from datetime import datetime, timedelta
+
+from cogs import metrics
+
+logger = logging.getLogger('matmaster.expiry')
+
+expired_total = metrics.counter('matmaster_requisitions_expired_total', 'Requisitions expired by the deadline sweeper.')
+sweep_seconds = metrics.histogram('matmaster_expiry_sweep_seconds', 'Duration of deadline expiry sweeps.')
+
+# Periodic sweep for requisitions whose deadline has passed. The storage backend claims
+# the expired open and accepted requisitions of this process's guilds through a range
+# scan on the partial deadline index, so a sweep costs O(expired) no matter how many
+# requisitions are still open. Claimed rows are handed to on_expired in batches.
+class ExpirySweeper:
+    def __init__(self, bot, storage, on_expired, interval=300, grace=timedelta(0), batch_size=500, shards=None):
+        self.bot = bot
+        self.storage = storage
+        self.on_expired = on_expired
+        self.interval = interval
+        self.grace = grace
+        self.batch_size = batch_size
+        self.shards = shards
+        self.task = None
+
+    async def start(self):
+        self.task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        if self.task:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+
+    async def run(self):
+        # Expired posts are moved between channels, so wait until they can be resolved
+        await self.bot.wait_until_ready()
+        while True:
+            try:
+                await self.sweep()
+            except Exception as e:
+                logger.error("Expiry sweep failed: %s", e)
+            await asyncio.sleep(self.interval)
+
+    async def sweep(self):
+        started = time.perf_counter()
+        cutoff = datetime.now() - self.grace
+        total = 0
+        while True:
+            rows = await self.storage.expire_requisitions(cutoff, self.batch_size, self.shards)
+            if rows:
+                total += len(rows)
+                expired_total.inc(len(rows))
+                await self.on_expired(rows)
+            if len(rows) < self.batch_size:
+                break
+        sweep_seconds.observe(time.perf_counter() - started)
+        if total:
+            logger.info("Expired %d requisitions past their deadline.", total)
+        return total
@@ -0,0 +1,201 @@
+import asyncio
+import logging
+import re
+from collections import deque
+from datetime import datetime, timedelta
+
+import discord
+
+from cogs import metrics
+from cogs.logs import log_ids
+
+logger = logging.getLogger('matmaster.feedback')
+
+pending_feedback = metrics.gauge('matmaster_feedback_pending', 'Feedback requests waiting for the requester to answer.')
+received_total = metrics.counter('matmaster_feedback_received_total', 'Feedback answers recorded.')
+
+# A rating from 1 to 5 at the start of the reply, optionally written as "4/5" or
+# "4 stars", followed by free-form comments
+RATING_PATTERN = re.compile(r'\s*([1-5])\s*(?:/\s*5|stars?|⭐)?(?:\s*[-:,.!]\s*|\s+|$)(.*)', re.DOTALL | re.IGNORECASE)
+
+RATING_HINT = "Please start your feedback with a rating from 1 to 5, e.g. `5 Delivered early, great trade`."
+SAVE_FAILED = "Sorry, your feedback couldn't be saved. Please send it again in a moment."
+
+
+def feedback_prompt(material):
+    subject = f"Your requisition for **{material}**" if material else "Your requisition"
+    return (
+        f"{subject} has been completed and archived!\n"
+        "\n"
+        "**Please rate it from 1 to 5** and add a few words about your experience, e.g. `5 Delivered early, great trade`.\n"
+        "I'll add it onto the archived post and to the reputation of everyone who fulfilled it."
+    )
+
+
+def parse_feedback(content):
+    # (rating, comments), or None if the reply doesn't start with a rating
+    match = RATING_PATTERN.match(content)
+    if match is None:
+        return None
+    return int(match.group(1)), match.group(2).strip()
+
+
+def feedback_line(rating, comments):
+    return f"**Feedback:** {'⭐' * rating}{f' {comments}' if comments else ''}"
+
+
+def reputation_text(user_id, row):
+    if row is None or not row['ratings']:
+        return f"<@{user_id}> hasn't been rated in this server yet."
+    ratings = row['ratings']
+    return (f"<@{user_id}> is rated **{row['rating_total'] / ratings:.1f}/5** ⭐ "
+            f"from {ratings} rating{'s' if ratings != 1 else ''} in this server.")
+
+
+# Collects requesters' feedback on archived requisitions, apart from the archive path
+# and from interactive conversations, so an unanswered request never holds up the
+# requester's other DM conversations. Requests are rows in the feedback table; the
+# unanswered ones are also kept here, queued per requester ID, so matching an incoming
+# DM is one dict lookup. Only the head of each queue is prompted. Answers are stored
+# with the ratings they add to the fulfillers' reputation, and the archived post is
+# edited through the EditPipeline. Unanswered requests expire after ttl seconds.
+#
+# DMs arrive on shard 0, so only the process that owns it (active) holds requests;
+# others store theirs and hand them over through on_remote, which ends up in adopt().
+class FeedbackCollector:
+    def __init__(self, bot, storage, outbound, edits, ttl=86400, sweep_interval=300, active=True, on_remote=None):
+        self.bot = bot
+        self.storage = storage
+        self.outbound = outbound
+        self.edits = edits
+        self.ttl = timedelta(seconds=ttl)
+        self.sweep_interval = sweep_interval
+        self.active = active
+        self.on_remote = on_remote
+        self.pending = {}
+        self.task = None
+        pending_feedback.set_function(lambda: len(self))
+
+    def __len__(self):
+        return sum(len(queue) for queue in self.pending.values())
+
+    async def load(self):
+        self.pending = {}
+        if not self.active:
+            return
+        for row in await self.storage.load_pending_feedback():
+            self.pending.setdefault(row['requester'], deque()).append(row)
+        logger.info("Loaded %d pending feedback requests.", len(self))
+
+    async def start(self):
+        if self.active:
+            self.task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        if self.task:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+
+    async def request(self, requisition, archive_channel_id, archived_message):
+        row = await self.storage.insert_feedback({
+            'requisition_id': requisition.id,
+            'guild_id': requisition.guild_id,
+            'requester': requisition.requester,
+            'material': requisition.material,
+            'fulfilled_by': [user_id for user_id in requisition.completed_by if user_id != requisition.requester],
+            'archive_channel_id': archive_channel_id,
+            'archived_message_id': archived_message.id,
+            'archived_content': archived_message.content,
+            'requested_at': datetime.now()
+        })
+        if not self.active:
+            if self.on_remote:
+                await self.on_remote(row['id'])
+            return
+        self._enqueue(row)
+
+    async def adopt(self, feedback_id):
+        # Takes over a request another process stored for us
+        if not self.active:
+            return
+        row = await self.storage.get_feedback(feedback_id)
+        if row is None or row['received_at'] is not None:
+            return
+        if not any(entry['id'] == feedback_id for entry in self.pending.get(row['requester'], ())):
+            self._enqueue(row)
+
+    def _enqueue(self, row):
+        queue = self.pending.setdefault(row['requester'], deque())
+        queue.append(row)
+        if len(queue) == 1:
+            self._prompt(row)
+
+    def _prompt(self, row):
+        self.outbound.send_dm(row['requester'], feedback_prompt(row['material']), coalesce=False)
+
+    def _pop(self, requester, prompt_next=True):
+        queue = self.pending[requester]
+        row = queue.popleft()
+        if not queue:
+            del self.pending[requester]
+        elif prompt_next:
+            self._prompt(queue[0])
+        return row
+
+    async def handle(self, message):
+        # Returns True if the message was an answer to a feedback request
+        if not isinstance(message.channel, discord.DMChannel) or message.author.id not in self.pending:
+            return False
+        parsed = parse_feedback(message.content)
+        if parsed is None:
+            self.outbound.send_dm(message.author.id, RATING_HINT, coalesce=False)
+            return True
+        rating, comments = parsed
+        # Taken off the queue before the write, so a second quick reply answers the next request
+        row = self._pop(message.author.id, prompt_next=False)
+        try:
+            recorded = await self.storage.record_feedback(row['id'], rating, comments)
+        except Exception as e:
+            # Back at the head of the queue, so the next reply answers it again
+            self.pending.setdefault(row['requester'], deque()).appendleft(row)
+            logger.error("Could not record feedback %s: %s", row['id'], e,
+                         extra=log_ids(guild_id=row['guild_id'], requisition_id=row['requisition_id'], user_id=row['requester']))
+            self.outbound.send_dm(message.author.id, SAVE_FAILED, coalesce=False)
+            return True
+        if recorded:
+            received_total.inc()
+            content = f"{row['archived_content']}\n{feedback_line(rating, comments)}"
+            self.edits.schedule(self.bot.get_partial_messageable(row['archive_channel_id']), row['archived_message_id'],
+                                lambda: content)
+            self.outbound.send_dm(message.author.id, "Thank you for your feedback!", coalesce=False)
+        queue = self.pending.get(message.author.id)
+        if queue:
+            self._prompt(queue[0])
+        return True
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.sweep_interval)
+            try:
+                await self.expire()
+            except Exception as e:
+                logger.error("Feedback expiry failed: %s", e)
+
+    async def expire(self):
+        cutoff = datetime.now() - self.ttl
+        for requester, queue in list(self.pending.items()):
+            expired = 0
+            while expired < len(queue) and queue[expired]['requested_at'] < cutoff:
+                expired += 1
+            for _ in range(expired):
+                self._pop(requester, prompt_next=False)
+            if expired and requester in self.pending:
+                self._prompt(queue[0])
+        expired = await self.storage.expire_feedback(cutoff)
+        if expired:
+            logger.info("Expired %d unanswered feedback requests.", expired)
+        return expired
@@ -0,0 +1,32 @@
+import asyncio
+from contextlib import asynccontextmanager
+
+from cogs import metrics
+
+locks_held = metrics.gauge('matmaster_requisition_locks', 'Requisitions with a handler running or waiting.')
+
+
+# asyncio locks keyed by ID. A lock is created on first use and dropped again as soon
+# as nobody holds or waits for it, so the map only ever contains keys with work in
+# flight. Work on one key runs in arrival order; different keys never wait on each other.
+class KeyedLocks:
+    def __init__(self):
+        self.locks = {}
+        locks_held.set_function(lambda: len(self.locks))
+
+    def __len__(self):
+        return len(self.locks)
+
+    @asynccontextmanager
+    async def hold(self, key):
+        entry = self.locks.get(key)
+        if entry is None:
+            entry = self.locks[key] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                yield
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self.locks[key]
@@ -0,0 +1,163 @@
+import json
+import logging
+import queue
+import random
+import sys
+from datetime import datetime
+from functools import lru_cache
+from logging.handlers import QueueHandler, QueueListener
+
+from cogs import metrics
+
+sampled_out = metrics.counter('matmaster_log_records_sampled_out_total', 'Log records dropped by sampling, by category.')
+dropped_records = metrics.counter('matmaster_log_records_dropped_total', 'Log records dropped because the log queue was full.')
+
+TEXT_FORMAT = '%(asctime)s:%(levelname)s:%(name)s:%(message)s'
+
+# Record attributes, passed with extra=, copied into JSON output
+CONTEXT_FIELDS = ('guild_id', 'message_id', 'requisition_id', 'user_id', 'category')
+
+# Categories of high-volume records, sampled by rate. Records name theirs in extra;
+# discord.py's own loggers are mapped by name.
+CATEGORY_REACTION = 'reaction'
+CATEGORY_GATEWAY = 'gateway'
+CATEGORY_LOGGERS = {
+    'discord.gateway': CATEGORY_GATEWAY,
+    'discord.client': CATEGORY_GATEWAY,
+    'discord.state': CATEGORY_GATEWAY,
+    'discord.shard': CATEGORY_GATEWAY
+}
+
+# Sample rates by category, set by setup_logging
+category_rates = {}
+
+
+def log_ids(**ids):
+    # extra= for a record, leaving out IDs that aren't known
+    return {key: value for key, value in ids.items() if value is not None}
+
+
+def parse_pairs(text, convert=str):
+    # "a=1,b=2" -> {'a': convert('1'), 'b': convert('2')}
+    pairs = {}
+    for item in (text or '').split(','):
+        if item.strip():
+            key, value = item.split('=', 1)
+            pairs[key.strip()] = convert(value.strip())
+    return pairs
+
+
+def sampled(category):
+    # Whether to log this event of a sampled category. Call sites check it before
+    # logging, so a dropped event never builds a record; their records then pass
+    # category= in extra and aren't sampled a second time.
+    rate = category_rates.get(category)
+    if rate is None or rate >= 1 or random.random() < rate:
+        return True
+    sampled_out.inc(category=category)
+    return False
+
+
+@lru_cache(maxsize=256)
+def logger_category(name):
+    while name:
+        if name in CATEGORY_LOGGERS:
+            return CATEGORY_LOGGERS[name]
+        name = name.rpartition('.')[0]
+    return None
+
+
+# Keeps a random share of the records of loggers in a sampled category, such as
+# discord.py's gateway loggers. Records that name their category were sampled by
+# sampled() already. Warnings and errors are always kept. Kept records carry their
+# sample_rate so counts can be scaled back up.
+class SamplingFilter(logging.Filter):
+    def filter(self, record):
+        if record.levelno >= logging.WARNING:
+            return True
+        category = record.__dict__.get('category')
+        if category is None:
+            category = logger_category(record.name)
+            if not sampled(category):
+                return False
+        rate = category_rates.get(category)
+        if rate is not None and rate < 1:
+            record.sample_rate = rate
+        return True
+
+
+# One JSON object per line, with the IDs the record carries
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            'time': datetime.fromtimestamp(record.created).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage()
+        }
+        for field in CONTEXT_FIELDS:
+            value = record.__dict__.get(field)
+            if value is not None:
+                entry[field] = value
+        if 'sample_rate' in record.__dict__:
+            entry['sample_rate'] = record.sample_rate
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        if record.stack_info:
+            entry['stack'] = self.formatStack(record.stack_info)
+        return json.dumps(entry, default=str)
+
+
+# Hands records to the listener thread as they are, so formatting - including the
+# message's % arguments - and writing happen off the event loop. Never blocks: when
+# the queue is full the record is dropped and counted.
+class LoopQueueHandler(QueueHandler):
+    def prepare(self, record):
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            dropped_records.inc()
+
+
+# Stops every record in the process looking up the caller's file and line, thread and
+# process, which is most of what building a record costs and which no format here
+# uses. This changes logging module globals (one of them private), so it also affects
+# any other library logging in the same process, and %(filename)s, %(lineno)d,
+# %(funcName)s, %(thread)d and %(process)d become empty in their formats.
+def lean_log_records():
+    logging._srcfile = None
+    logging.logThreads = False
+    logging.logProcesses = False
+    logging.logMultiprocessing = False
+
+
+def setup_logging(level='INFO', levels=None, json_format=True, sample_rates=None, stream=None, queue_size=10000,
+                  lean_records=False):
+    # Routes every logger through one sampled queue handler to a writer thread. levels
+    # sets a level per logger name, e.g. {'discord.gateway': 'WARNING'}. Returns the
+    # started QueueListener; stop() it on shutdown to flush what's queued.
+    # lean_records is for the process entry point only: see lean_log_records.
+    handler = logging.StreamHandler(stream or sys.stderr)
+    handler.setFormatter(JsonFormatter() if json_format else logging.Formatter(TEXT_FORMAT))
+    records = queue.Queue(queue_size)
+    queue_handler = LoopQueueHandler(records)
+    queue_handler.addFilter(SamplingFilter())
+    category_rates.clear()
+    category_rates.update(sample_rates or {})
+    if lean_records:
+        lean_log_records()
+
+    root = logging.getLogger()
+    for existing in root.handlers[:]:
+        root.removeHandler(existing)
+    root.addHandler(queue_handler)
+    root.setLevel(level)
+    for name, logger_level in (levels or {}).items():
+        logging.getLogger(name).setLevel(logger_level)
+
+    listener = QueueListener(records, handler)
+    listener.start()
+    return listener
@@ -0,0 +1,66 @@
+import asyncio
+import logging
+import sys
+import threading
+import time
+import traceback
+
+from cogs import metrics
+
+logger = logging.getLogger('matmaster.loop')
+
+loop_lag = metrics.histogram('matmaster_event_loop_lag_seconds', 'How late the event loop ran a timer scheduled every interval.')
+blocked_total = metrics.counter('matmaster_event_loop_blocked_total', 'Times a callback held the event loop longer than the threshold.')
+
+
+# Event loop lag monitor. A task on the loop wakes every interval and records how late
+# it ran; a watchdog thread checks that the task keeps ticking, and when the loop has
+# been stuck for longer than threshold it logs the loop thread's current stack - the
+# callback that is blocking - once per stall.
+class LoopMonitor:
+    def __init__(self, threshold=0.25, interval=0.1):
+        self.threshold = threshold
+        self.interval = interval
+        self.last_tick = time.monotonic()
+        self.loop_thread_id = None
+        self.stopped = threading.Event()
+        self.task = None
+        self.thread = None
+
+    async def start(self):
+        self.loop_thread_id = threading.get_ident()
+        self.last_tick = time.monotonic()
+        self.task = asyncio.create_task(self.tick())
+        self.thread = threading.Thread(target=self.watch, name='matmaster-loop-monitor', daemon=True)
+        self.thread.start()
+
+    async def stop(self):
+        self.stopped.set()
+        if self.task:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+
+    async def tick(self):
+        while True:
+            expected = time.monotonic() + self.interval
+            await asyncio.sleep(self.interval)
+            now = time.monotonic()
+            loop_lag.observe(max(0.0, now - expected))
+            self.last_tick = now
+
+    def watch(self):
+        reported = None
+        while not self.stopped.wait(self.interval):
+            last_tick = self.last_tick
+            stalled = time.monotonic() - last_tick - self.interval
+            if stalled < self.threshold or reported == last_tick:
+                continue
+            reported = last_tick
+            blocked_total.inc()
+            frame = sys._current_frames().get(self.loop_thread_id)
+            stack = ''.join(traceback.format_stack(frame)) if frame is not None else 'unavailable'
+            logger.warning("Event loop has been blocked for %.3fs, current stack:\n%s", stalled, stack)
@@ -0,0 +1,237 @@
+import asyncio
+import itertools
+import logging
+import time
+from collections import deque
+from datetime import timedelta
+
+import discord
+
+from cogs import metrics
+from cogs.logs import log_ids
+
+logger = logging.getLogger('matmaster.outbound')
+
+# Lower values are sent first when several routes are ready at once
+PRIORITY_CHANNEL = 0
+PRIORITY_REACTION = 1
+PRIORITY_DM = 2
+
+MAX_MESSAGE_LENGTH = 2000
+
+# Bulk deletion takes 2-100 messages, none older than 14 days
+BULK_DELETE_LIMIT = 100
+BULK_DELETE_MAX_AGE = timedelta(days=14) - timedelta(minutes=5)
+
+queue_depth = metrics.gauge('matmaster_outbound_queue_depth', 'Outbound Discord calls waiting to be sent.')
+coalescing_dms = metrics.gauge('matmaster_outbound_coalescing_dms', 'Users with DMs waiting in the coalescing window.')
+sent_total = metrics.counter('matmaster_outbound_sent_total', 'Outbound Discord calls completed.')
+coalesced_total = metrics.counter('matmaster_outbound_coalesced_dms_total', 'DM notifications merged into an earlier DM.')
+rate_limited_total = metrics.counter('matmaster_discord_rate_limited_total', 'Discord calls that hit a rate limit.')
+rest_seconds = metrics.histogram('matmaster_discord_rest_seconds', 'Latency of outbound Discord REST calls.')
+
+
+# discord.py waits out 429s itself and only logs them, so they are counted from its log
+class RateLimitCounter(logging.Handler):
+    def emit(self, record):
+        if 'responded with 429' in record.getMessage():
+            rate_limited_total.inc(route='library')
+
+
+def count_library_rate_limits():
+    library_logger = logging.getLogger('discord.http')
+    if not any(isinstance(handler, RateLimitCounter) for handler in library_logger.handlers):
+        library_logger.addHandler(RateLimitCounter(logging.WARNING))
+
+
+# Token bucket for one route; reserve() returns how long to wait before the next call
+class RouteBucket:
+    def __init__(self, rate, per):
+        self.rate = rate
+        self.per = per
+        self.tokens = float(rate)
+        self.updated = time.monotonic()
+
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate / self.per)
+        self.updated = now
+
+    def reserve(self):
+        self.refill()
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) * self.per / self.rate
+
+    def idle(self):
+        self.refill()
+        return self.tokens >= self.rate
+
+
+# Central outbound dispatcher. Calls are queued per route (a channel, a user's DMs or a
+# channel's reactions) and each route sends one call at a time in FIFO order, paced by
+# its own token bucket. Ready routes are served by a small worker pool in priority
+# order, so channel posts overtake DMs. Notifications to the same user within the
+# coalescing window are merged into a single DM.
+class OutboundDispatcher:
+    def __init__(self, bot, users, workers=4, coalesce_window=2.0, route_rate=5, route_per=5.0, max_buckets=10000):
+        self.bot = bot
+        self.users = users
+        self.workers = workers
+        self.coalesce_window = coalesce_window
+        self.route_rate = route_rate
+        self.route_per = route_per
+        self.max_buckets = max_buckets
+        self.sequence = itertools.count()
+        self.ready = asyncio.PriorityQueue()
+        self.routes = {}
+        self.buckets = {}
+        self.dm_buffers = {}
+        self.tasks = []
+        queue_depth.set_function(lambda: sum(len(items) for items in self.routes.values()))
+        coalescing_dms.set_function(lambda: len(self.dm_buffers))
+
+    async def start(self):
+        count_library_rate_limits()
+        self.tasks = [asyncio.create_task(self.work()) for _ in range(self.workers)]
+
+    async def stop(self, timeout=10.0):
+        for user_id in list(self.dm_buffers):
+            self._flush_dm(user_id)
+        deadline = time.monotonic() + timeout
+        while self.routes and time.monotonic() < deadline:
+            await asyncio.sleep(0.1)
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
+
+    def submit(self, route, call, priority=PRIORITY_CHANNEL):
+        # call is a zero-argument coroutine function; the returned future resolves to its result
+        future = asyncio.get_running_loop().create_future()
+        future.add_done_callback(self._log_failure)
+        item = (priority, next(self.sequence), call, future)
+        items = self.routes.get(route)
+        if items is None:
+            self.routes[route] = deque([item])
+            self.ready.put_nowait((priority, item[1], route))
+        else:
+            items.append(item)
+        return future
+
+    def post(self, channel, content):
+        return self.submit(('channel', channel.id), lambda: channel.send(content), PRIORITY_CHANNEL)
+
+    def edit(self, channel, message_id, content):
+        message = channel.get_partial_message(message_id)
+        return self.submit(('channel', channel.id), lambda: message.edit(content=content), PRIORITY_CHANNEL)
+
+    def delete(self, channel, message_id):
+        message = channel.get_partial_message(message_id)
+        return self.submit(('channel', channel.id), message.delete, PRIORITY_CHANNEL)
+
+    def bulk_delete(self, channel, message_ids):
+        # One call per 100 recent messages; anything too old for bulk deletion goes one by one.
+        # Returns (message IDs, future) for each call.
+        cutoff = discord.utils.utcnow() - BULK_DELETE_MAX_AGE
+        recent = [message_id for message_id in message_ids if discord.utils.snowflake_time(message_id) > cutoff]
+        single = [message_id for message_id in message_ids if discord.utils.snowflake_time(message_id) <= cutoff]
+        calls = []
+        for start in range(0, len(recent), BULK_DELETE_LIMIT):
+            chunk = recent[start:start + BULK_DELETE_LIMIT]
+            if len(chunk) == 1:
+                single.extend(chunk)
+                continue
+            messages = [discord.Object(id=message_id) for message_id in chunk]
+            calls.append((chunk, self.submit(
+                ('channel', channel.id), lambda messages=messages: channel.delete_messages(messages), PRIORITY_CHANNEL
+            )))
+        for message_id in single:
+            calls.append(([message_id], self.delete(channel, message_id)))
+        return calls
+
+    def react(self, message, emoji):
+        return self.submit(('reaction', message.channel.id), lambda: message.add_reaction(emoji), PRIORITY_REACTION)
+
+    def send_dm(self, user_id, content, coalesce=True):
+        if not coalesce:
+            return self.submit(('dm', user_id), lambda: self._deliver_dm(user_id, [content]), PRIORITY_DM)
+        buffer = self.dm_buffers.get(user_id)
+        if buffer is not None:
+            buffer.append(content)
+            coalesced_total.inc()
+            return None
+        self.dm_buffers[user_id] = [content]
+        asyncio.get_running_loop().call_later(self.coalesce_window, self._flush_dm, user_id)
+        return None
+
+    def _flush_dm(self, user_id):
+        contents = self.dm_buffers.pop(user_id, None)
+        if contents:
+            self.submit(('dm', user_id), lambda: self._deliver_dm(user_id, contents), PRIORITY_DM)
+
+    async def _deliver_dm(self, user_id, contents):
+        user = await self.users.get(user_id)
+        if user is None:
+            logger.warning("Dropping DM to unknown user %s.", user_id, extra=log_ids(user_id=user_id))
+            return None
+        chunks = []
+        for content in contents:
+            if chunks and len(chunks[-1]) + len(content) + 2 <= MAX_MESSAGE_LENGTH:
+                chunks[-1] = f"{chunks[-1]}\n\n{content}"
+            else:
+                chunks.append(content)
+        message = None
+        for chunk in chunks:
+            message = await user.send(chunk)
+        return message
+
+    def _log_failure(self, future):
+        if not future.cancelled() and future.exception() is not None:
+            logger.warning("Outbound Discord call failed: %s", future.exception())
+
+    def _bucket(self, route):
+        bucket = self.buckets.get(route)
+        if bucket is None:
+            if len(self.buckets) >= self.max_buckets:
+                for key in [key for key, value in self.buckets.items() if key not in self.routes and value.idle()]:
+                    del self.buckets[key]
+            bucket = self.buckets[route] = RouteBucket(self.route_rate, self.route_per)
+        return bucket
+
+    async def work(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            priority, sequence, route = await self.ready.get()
+            delay = self._bucket(route).reserve()
+            if delay > 0:
+                loop.call_later(delay, self.ready.put_nowait, (priority, sequence, route))
+                continue
+
+            items = self.routes[route]
+            _, _, call, future = items.popleft()
+            await self._run(route, call, future)
+            if items:
+                self.ready.put_nowait((items[0][0], items[0][1], route))
+            else:
+                del self.routes[route]
+
+    async def _run(self, route, call, future):
+        started = time.perf_counter()
+        try:
+            result = await call()
+        except discord.HTTPException as e:
+            if e.status == 429:
+                rate_limited_total.inc(route=route[0])
+            if not future.done():
+                future.set_exception(e)
+        except Exception as e:
+            if not future.done():
+                future.set_exception(e)
+        else:
+            sent_total.inc(route=route[0])
+            if not future.done():
+                future.set_result(result)
+        finally:
+            rest_seconds.observe(time.perf_counter() - started, route=route[0])
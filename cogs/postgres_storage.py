@@ -0,0 +1,859 @@
+import csv
+import io
+import logging
+from datetime import datetime
+
+import psycopg2
+from psycopg2.extras import execute_values
+
+from cogs.database import Database
+from cogs.requisition import INSERT_COLUMNS
+from cogs.requisition_cache import STATUS_OPEN, STATUS_ACCEPTED, STATUS_COMPLETED, STATUS_EXPIRED, STATUS_PENDING
+from cogs.search import LISTED_STATUSES, like_pattern
+from cogs.stats import METRIC_ACCEPT, METRIC_COMPLETE, METRIC_FULFILLED, transition_stats
+
+logger = logging.getLogger('matmaster.storage')
+
+# Must match the predicate of requisitions_open_deadline_idx so the sweep can use it
+EXPIRE_SQL = """
+    UPDATE requisitions
+    SET status = %s, version = version + 1
+    WHERE id IN (
+        SELECT id FROM requisitions
+        WHERE status IN ('open', 'accepted') AND deadline < %s AND {predicate}
+        ORDER BY deadline
+        LIMIT %s
+        FOR UPDATE SKIP LOCKED
+    )
+    RETURNING *;
+"""
+
+# Removes first, then appends only the users not already present, so the arrays are
+# patched in place instead of rewritten from the in-memory copy.
+FLUSH_SQL = """
+    UPDATE requisitions AS r
+    SET accepted_by = ARRAY(SELECT u FROM unnest(COALESCE(r.accepted_by, '{}')) AS u WHERE u <> ALL(v.accepted_remove))
+                      || ARRAY(SELECT u FROM unnest(v.accepted_add) AS u WHERE u <> ALL(COALESCE(r.accepted_by, '{}'))),
+        completed_by = ARRAY(SELECT u FROM unnest(COALESCE(r.completed_by, '{}')) AS u WHERE u <> ALL(v.completed_remove))
+                       || ARRAY(SELECT u FROM unnest(v.completed_add) AS u WHERE u <> ALL(COALESCE(r.completed_by, '{}')))
+    FROM (VALUES %s) AS v(message_id, accepted_add, accepted_remove, completed_add, completed_remove)
+    WHERE r.message_id = v.message_id;
+"""
+FLUSH_TEMPLATE = "(%s, %s::bigint[], %s::bigint[], %s::bigint[], %s::bigint[])"
+
+# How requisitions are grouped in demand_stats
+DEMAND_KEY = "lower(trim(COALESCE(material, ''))), lower(trim(COALESCE(region, '')))"
+
+# Adds %s times the count and quantity of the requisitions with the given IDs to their
+# demand_stats rows. Grouped in key order, so concurrent writers lock rows in the same order.
+DEMAND_SQL = f"""
+    INSERT INTO demand_stats (guild_id, material, region, open_count, open_quantity)
+    SELECT guild_id, {DEMAND_KEY}, %s * COUNT(*), %s * COALESCE(SUM(quantity), 0)
+    FROM requisitions
+    WHERE id = ANY(%s) AND guild_id IS NOT NULL
+    GROUP BY 1, 2, 3
+    ORDER BY 1, 2, 3
+    ON CONFLICT (guild_id, material, region) DO UPDATE
+    SET open_count = demand_stats.open_count + EXCLUDED.open_count,
+        open_quantity = demand_stats.open_quantity + EXCLUDED.open_quantity;
+"""
+
+# Moves up to %s events of this process's guilds into the daily rollups
+COMPACT_SQL = """
+    WITH moved AS (
+        DELETE FROM stats_events
+        WHERE id IN (
+            SELECT id FROM stats_events
+            WHERE {predicate}
+            ORDER BY id
+            LIMIT %s
+            FOR UPDATE SKIP LOCKED
+        )
+        RETURNING guild_id, day, metric, key
+    ), folded AS (
+        INSERT INTO stats_daily (guild_id, metric, day, key, count)
+        SELECT guild_id, metric, day, key, COUNT(*) FROM moved
+        GROUP BY 1, 2, 3, 4
+        ON CONFLICT (guild_id, metric, day, key) DO UPDATE
+        SET count = stats_daily.count + EXCLUDED.count
+    )
+    SELECT COUNT(*) AS events FROM moved;
+"""
+
+# Requisitions in the order of transfer.EXPORT_COLUMNS. CSV gets the user ID arrays as
+# space-separated text; JSONL keeps them as arrays.
+EXPORT_SQL = """
+    SELECT id, message_id, guild_id, requester, material, quantity, payment, deadline, region,
+           {accepted_by} AS accepted_by, {completed_by} AS completed_by, completion_details, status, created_at
+    FROM requisitions
+    WHERE {predicate}
+    ORDER BY id
+"""
+FEEDBACK_EXPORT_SQL = """
+    SELECT id, requisition_id, guild_id, requester, material, {fulfilled_by} AS fulfilled_by, archive_channel_id,
+           archived_message_id, rating, comments, requested_at, received_at
+    FROM feedback
+    WHERE {predicate}
+    ORDER BY id
+"""
+CHANNELS_EXPORT_SQL = """
+    SELECT guild_id, requisitions_channel_id, archive_channel_id, server_name
+    FROM channels
+    WHERE {predicate}
+    ORDER BY guild_id
+"""
+EXPORT_ARRAYS = {
+    'csv': "array_to_string({column}, ' ')",
+    'jsonl': "COALESCE({column}, '{{}}')"
+}
+# JSONL is one row_to_json() per line. It goes through COPY's CSV format with quote
+# and delimiter characters that JSON never contains unescaped, so nothing is escaped twice.
+EXPORT_COPY = {
+    'csv': "COPY ({query}) TO STDOUT WITH (FORMAT csv, HEADER)",
+    'jsonl': "COPY (SELECT row_to_json(export) FROM ({query}) AS export) TO STDOUT WITH (FORMAT csv, QUOTE E'\\x01', DELIMITER E'\\x02')"
+}
+
+# Per-key counts of one guild's metric since a day, from the rollups plus the events
+# not compacted yet
+STATS_COUNTS_SQL = """
+    SELECT key, SUM(count) AS count FROM (
+        SELECT key, count FROM stats_daily WHERE guild_id = %s AND metric = %s AND day >= %s
+        UNION ALL
+        SELECT key, 1 FROM stats_events WHERE guild_id = %s AND metric = %s AND day >= %s
+    ) AS counts
+    GROUP BY key
+"""
+
+
+def initial_schema(cur):
+    # The schema from before migrations were versioned. Everything is IF NOT EXISTS,
+    # so databases created by older releases adopt it as-is.
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS requisitions (
+            id SERIAL PRIMARY KEY,
+            requester BIGINT,
+            material TEXT,
+            quantity INTEGER,
+            payment TEXT,
+            deadline TIMESTAMP,
+            accepted_by BIGINT[],
+            completed_by BIGINT[],
+            message_id BIGINT,
+            region TEXT,
+            completion_details TEXT
+        );
+    """)
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS channels (
+            guild_id BIGINT PRIMARY KEY,
+            requisitions_channel_id BIGINT,
+            archive_channel_id BIGINT,
+            server_name TEXT
+        );
+    """)
+    cur.execute("ALTER TABLE requisitions ADD COLUMN IF NOT EXISTS status TEXT NOT NULL DEFAULT 'open';")
+    cur.execute("CREATE INDEX IF NOT EXISTS requisitions_message_id_idx ON requisitions (message_id);")
+    cur.execute("CREATE INDEX IF NOT EXISTS requisitions_status_idx ON requisitions (status);")
+    cur.execute("CREATE INDEX IF NOT EXISTS requisitions_deadline_idx ON requisitions (deadline);")
+    cur.execute("""
+        CREATE INDEX IF NOT EXISTS requisitions_open_deadline_idx
+        ON requisitions (deadline)
+        WHERE status IN ('open', 'accepted');
+    """)
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS reminders (
+            id SERIAL PRIMARY KEY,
+            message_id BIGINT,
+            user_id BIGINT,
+            kind TEXT,
+            content TEXT,
+            due_at TIMESTAMP
+        );
+    """)
+    cur.execute("CREATE INDEX IF NOT EXISTS reminders_message_id_idx ON reminders (message_id);")
+    cur.execute("ALTER TABLE requisitions ADD COLUMN IF NOT EXISTS guild_id BIGINT;")
+    cur.execute("ALTER TABLE reminders ADD COLUMN IF NOT EXISTS guild_id BIGINT;")
+    cur.execute("""
+        CREATE INDEX IF NOT EXISTS requisitions_guild_region_deadline_idx
+        ON requisitions (guild_id, lower(region), deadline)
+        WHERE status IN ('open', 'accepted');
+    """)
+    # Trigram index for material searches; skipped where pg_trgm can't be installed
+    cur.execute("SAVEPOINT trigram;")
+    try:
+        cur.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm;")
+        cur.execute("""
+            CREATE INDEX IF NOT EXISTS requisitions_material_trgm_idx
+            ON requisitions USING GIN (material gin_trgm_ops);
+        """)
+    except psycopg2.Error as e:
+        cur.execute("ROLLBACK TO SAVEPOINT trigram;")
+        logger.warning("Could not create the trigram index on requisitions.material: %s", e)
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS conversations (
+            id SERIAL PRIMARY KEY,
+            user_id BIGINT,
+            channel_id BIGINT,
+            guild_id BIGINT,
+            flow TEXT,
+            step INTEGER,
+            data TEXT,
+            context TEXT,
+            step_deadline TIMESTAMP,
+            expires_at TIMESTAMP
+        );
+    """)
+
+
+def change_tracking(cur):
+    # updated_at lets a warm start fetch only the rows changed since its snapshot. An
+    # UPDATE that sets updated_at itself (e.g. an import) keeps its value.
+    cur.execute("ALTER TABLE requisitions ADD COLUMN IF NOT EXISTS updated_at TIMESTAMP NOT NULL DEFAULT LOCALTIMESTAMP;")
+    cur.execute("ALTER TABLE channels ADD COLUMN IF NOT EXISTS updated_at TIMESTAMP NOT NULL DEFAULT LOCALTIMESTAMP;")
+    cur.execute("""
+        CREATE OR REPLACE FUNCTION matmaster_touch() RETURNS trigger AS $$
+        BEGIN
+            IF NEW.updated_at IS NOT DISTINCT FROM OLD.updated_at THEN
+                NEW.updated_at := LOCALTIMESTAMP;
+            END IF;
+            RETURN NEW;
+        END;
+        $$ LANGUAGE plpgsql;
+    """)
+    for table in ('requisitions', 'channels'):
+        cur.execute(f"DROP TRIGGER IF EXISTS {table}_touch ON {table};")
+        cur.execute(f"CREATE TRIGGER {table}_touch BEFORE UPDATE ON {table} FOR EACH ROW EXECUTE PROCEDURE matmaster_touch();")
+    cur.execute("CREATE INDEX IF NOT EXISTS requisitions_updated_at_idx ON requisitions (updated_at);")
+
+
+def requisition_versions(cur):
+    # Bumped by every status change and edit, so a process holding a copy of a
+    # requisition can update it only if nobody else changed it since
+    cur.execute("ALTER TABLE requisitions ADD COLUMN IF NOT EXISTS version INTEGER NOT NULL DEFAULT 0;")
+
+
+def guild_stats(cur):
+    # Existing rows keep a NULL created_at and so never count towards timings
+    cur.execute("ALTER TABLE requisitions ADD COLUMN IF NOT EXISTS created_at TIMESTAMP;")
+    cur.execute("ALTER TABLE requisitions ALTER COLUMN created_at SET DEFAULT LOCALTIMESTAMP;")
+    cur.execute("ALTER TABLE requisitions ADD COLUMN IF NOT EXISTS accepted_at TIMESTAMP;")
+    cur.execute("ALTER TABLE requisitions ADD COLUMN IF NOT EXISTS completed_at TIMESTAMP;")
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS demand_stats (
+            guild_id BIGINT NOT NULL,
+            material TEXT NOT NULL,
+            region TEXT NOT NULL,
+            open_count INTEGER NOT NULL DEFAULT 0,
+            open_quantity BIGINT NOT NULL DEFAULT 0,
+            PRIMARY KEY (guild_id, material, region)
+        );
+    """)
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS stats_events (
+            id BIGSERIAL PRIMARY KEY,
+            guild_id BIGINT NOT NULL,
+            metric TEXT NOT NULL,
+            day DATE NOT NULL,
+            key BIGINT NOT NULL
+        );
+    """)
+    cur.execute("CREATE INDEX IF NOT EXISTS stats_events_guild_idx ON stats_events (guild_id, metric, day);")
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS stats_daily (
+            guild_id BIGINT NOT NULL,
+            metric TEXT NOT NULL,
+            day DATE NOT NULL,
+            key BIGINT NOT NULL,
+            count INTEGER NOT NULL,
+            PRIMARY KEY (guild_id, metric, day, key)
+        );
+    """)
+    cur.execute(f"""
+        INSERT INTO demand_stats (guild_id, material, region, open_count, open_quantity)
+        SELECT guild_id, {DEMAND_KEY}, COUNT(*), COALESCE(SUM(quantity), 0)
+        FROM requisitions
+        WHERE status IN ('open', 'accepted') AND guild_id IS NOT NULL
+        GROUP BY 1, 2, 3
+        ON CONFLICT DO NOTHING;
+    """)
+
+
+def feedback(cur):
+    # Feedback requests and answers, and each user's ratings per guild as fulfiller.
+    # Feedback requests still waiting in the old conversation flow carry over.
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS feedback (
+            id SERIAL PRIMARY KEY,
+            requisition_id INTEGER,
+            guild_id BIGINT,
+            requester BIGINT NOT NULL,
+            material TEXT,
+            fulfilled_by BIGINT[] NOT NULL DEFAULT '{}',
+            archive_channel_id BIGINT,
+            archived_message_id BIGINT,
+            archived_content TEXT,
+            rating SMALLINT,
+            comments TEXT,
+            requested_at TIMESTAMP NOT NULL DEFAULT LOCALTIMESTAMP,
+            received_at TIMESTAMP
+        );
+    """)
+    cur.execute("CREATE INDEX IF NOT EXISTS feedback_pending_idx ON feedback (requester, id) WHERE received_at IS NULL;")
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS reputation (
+            guild_id BIGINT NOT NULL,
+            user_id BIGINT NOT NULL,
+            ratings INTEGER NOT NULL DEFAULT 0,
+            rating_total INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (guild_id, user_id)
+        );
+    """)
+    cur.execute("""
+        INSERT INTO feedback (guild_id, requester, archive_channel_id, archived_message_id, archived_content)
+        SELECT guild_id, user_id, (context::json->>'archive_channel_id')::bigint,
+               (context::json->>'archived_message_id')::bigint, context::json->>'archived_content'
+        FROM conversations
+        WHERE flow = 'feedback'
+        ORDER BY id;
+    """)
+    cur.execute("DELETE FROM conversations WHERE flow = 'feedback';")
+
+
+def legacy_statuses(cur):
+    # Requisitions from before statuses were tracked all came out of the initial schema
+    # as 'open', finished or not. Completion details were only asked for once everyone
+    # had completed, so those rows are completed; whether the requester then confirmed
+    # and the post was archived is only known from Discord. Rows without a guild ID are
+    # checked there by the bot once it is up (see RequisitionFlow.reconcile_legacy).
+    cur.execute("""
+        UPDATE requisitions SET status = 'completed', version = version + 1
+        WHERE guild_id IS NULL AND status = 'open' AND completion_details IS NOT NULL;
+    """)
+
+
+# Applied in order, each once, recorded in schema_migrations. Never edit a released
+# migration; append a new one.
+MIGRATIONS = (
+    (1, 'initial schema', initial_schema),
+    (2, 'change tracking', change_tracking),
+    (3, 'requisition versions', requisition_versions),
+    (4, 'guild stats', guild_stats),
+    (5, 'feedback', feedback),
+    (6, 'legacy statuses', legacy_statuses),
+)
+
+# pg_advisory_xact_lock key, so workers starting together migrate one at a time
+MIGRATION_LOCK = 0x6d61746d
+
+
+def shard_filter(column, shards):
+    # SQL predicate (and params) restricting a query to the guilds of (shard_count, shard_ids).
+    # Rows without a guild belong to whichever process runs shard 0.
+    if shards is None:
+        return "TRUE", ()
+    shard_count, shard_ids = shards
+    return (f"((({column} >> 22) %% %s) = ANY(%s) OR ({column} IS NULL AND %s))",
+            (shard_count, sorted(shard_ids), 0 in shard_ids))
+
+
+def copy_value(value):
+    # A value in COPY's CSV format, where an empty field is NULL
+    if isinstance(value, (list, tuple)):
+        return '{' + ','.join(map(str, value)) + '}'
+    if isinstance(value, datetime):
+        return value.isoformat(' ')
+    return value
+
+
+def record_stats(cur, row, events, leaves_demand):
+    # Applies transition_stats() for row inside the caller's transaction
+    if row['guild_id'] is None:
+        return
+    if events:
+        execute_values(cur, "INSERT INTO stats_events (guild_id, metric, day, key) VALUES %s;",
+                       [(row['guild_id'], metric, row['now'].date(), key) for metric, key in events])
+    if leaves_demand:
+        cur.execute(DEMAND_SQL, (-1, -1, [row['id']]))
+
+
+# Storage backend for Postgres, over the pooled Database. Used for multi-process
+# deployments: workers share the tables and talk to each other with LISTEN/NOTIFY.
+class PostgresStorage:
+    shared = True
+
+    def __init__(self, dsn, min_size=1, max_size=10, timeout=10.0, **connect_kwargs):
+        self.db = Database(dsn, min_size=min_size, max_size=max_size, timeout=timeout, **connect_kwargs)
+
+    async def open(self):
+        await self.db.open()
+
+    async def close(self):
+        await self.db.close()
+
+
+    async def migrate(self):
+        # Returns the versions applied. Index builds can take a while on big tables,
+        # so the statement timeout is lifted for the migration transaction.
+        def op(cur):
+            cur.execute("SELECT pg_advisory_xact_lock(%s);", (MIGRATION_LOCK,))
+            cur.execute("""
+                CREATE TABLE IF NOT EXISTS schema_migrations (
+                    version INTEGER PRIMARY KEY,
+                    description TEXT,
+                    applied_at TIMESTAMP NOT NULL DEFAULT LOCALTIMESTAMP
+                );
+            """)
+            cur.execute("SELECT version FROM schema_migrations;")
+            done = {row['version'] for row in cur.fetchall()}
+            applied = []
+            for version, description, migration in MIGRATIONS:
+                if version in done:
+                    continue
+                migration(cur)
+                cur.execute("INSERT INTO schema_migrations (version, description) VALUES (%s, %s);", (version, description))
+                applied.append(version)
+            return applied
+        applied = await self.db.run(op, timeout=0, label='migrate')
+        for version in applied:
+            logger.info("Applied schema migration %d.", version)
+        return applied
+
+    async def clock(self):
+        # The database's current time, as used for updated_at
+        row = await self.db.fetchrow("SELECT LOCALTIMESTAMP AS now;")
+        return row['now']
+
+    async def notify(self, channel, payload):
+        await self.db.execute("SELECT pg_notify(%s, %s);", (channel, payload))
+
+    async def listen(self, channel, callback):
+        return await self.db.listen(channel, callback)
+
+    async def load_channels(self, shards=None):
+        predicate, params = shard_filter('guild_id', shards)
+        return await self.db.fetch(f"SELECT * FROM channels WHERE {predicate}", params)
+
+    async def channels_changed_since(self, since, shards=None):
+        predicate, params = shard_filter('guild_id', shards)
+        return await self.db.fetch(f"SELECT * FROM channels WHERE updated_at >= %s AND {predicate};", (since, *params))
+
+    async def get_channel_config(self, guild_id):
+        return await self.db.fetchrow("SELECT * FROM channels WHERE guild_id = %s;", (guild_id,))
+
+    async def save_channel_config(self, guild_id, requisitions_channel_id, archive_channel_id, server_name):
+        await self.db.execute("""
+            INSERT INTO channels (guild_id, requisitions_channel_id, archive_channel_id, server_name)
+            VALUES (%s, %s, %s, %s)
+            ON CONFLICT (guild_id) DO UPDATE
+            SET requisitions_channel_id = EXCLUDED.requisitions_channel_id,
+                archive_channel_id = EXCLUDED.archive_channel_id,
+                server_name = EXCLUDED.server_name;
+        """, (guild_id, requisitions_channel_id, archive_channel_id, server_name))
+
+    async def insert_requisition(self, row):
+        def op(cur):
+            cur.execute(f"""
+                INSERT INTO requisitions ({', '.join(INSERT_COLUMNS)})
+                VALUES ({', '.join(['%s'] * len(INSERT_COLUMNS))})
+                RETURNING id;
+            """, [row[column] for column in INSERT_COLUMNS])
+            requisition_id = cur.fetchone()['id']
+            if row['status'] in LISTED_STATUSES:
+                cur.execute(DEMAND_SQL, (1, 1, [requisition_id]))
+            return requisition_id
+        return await self.db.run(op, label='insert requisitions')
+
+    async def insert_requisitions(self, rows):
+        # Bulk insert: COPY into a staging table, then one INSERT ... SELECT so the new
+        # IDs come back for demand_stats. Returns the number of rows inserted.
+        buffer = io.StringIO()
+        csv.writer(buffer).writerows([copy_value(row[column]) for column in INSERT_COLUMNS] for row in rows)
+        columns = ', '.join(INSERT_COLUMNS)
+
+        def op(cur):
+            buffer.seek(0)
+            cur.execute(f"CREATE TEMP TABLE requisitions_import ON COMMIT DROP AS SELECT {columns} FROM requisitions WITH NO DATA;")
+            cur.copy_expert(f"COPY requisitions_import ({columns}) FROM STDIN WITH (FORMAT csv);", buffer)
+            cur.execute(f"INSERT INTO requisitions ({columns}) SELECT {columns} FROM requisitions_import RETURNING id, status;")
+            inserted = cur.fetchall()
+            cur.execute(DEMAND_SQL, (1, 1, [row['id'] for row in inserted if row['status'] in LISTED_STATUSES]))
+            return len(inserted)
+        return await self.db.run(op, timeout=0, label='insert requisitions')
+
+    async def export_requisitions(self, out, file_format, guild_id=None):
+        # Streams the requisitions of a guild, or of every guild, to the text file out
+        # through COPY, so they are never all in memory. Returns the number of rows.
+        arrays = {column: EXPORT_ARRAYS[file_format].format(column=column) for column in ('accepted_by', 'completed_by')}
+        return await self.export(EXPORT_SQL, arrays, out, file_format, guild_id, 'export requisitions')
+
+    async def export_feedback(self, out, file_format, guild_id=None):
+        arrays = {'fulfilled_by': EXPORT_ARRAYS[file_format].format(column='fulfilled_by')}
+        return await self.export(FEEDBACK_EXPORT_SQL, arrays, out, file_format, guild_id, 'export feedback')
+
+    async def export_channels(self, out, file_format, guild_id=None):
+        return await self.export(CHANNELS_EXPORT_SQL, {}, out, file_format, guild_id, 'export channels')
+
+    async def export(self, sql, arrays, out, file_format, guild_id, label):
+        def op(cur):
+            predicate = cur.mogrify("guild_id = %s", (guild_id,)).decode() if guild_id else "TRUE"
+            query = sql.format(predicate=predicate, **arrays)
+            cur.copy_expert(EXPORT_COPY[file_format].format(query=query), out)
+            return cur.rowcount
+        return await self.db.run(op, timeout=0, label=label)
+
+    async def import_channels(self, rows):
+        # Upserts channel configuration rows; returns the number written
+        def op(cur):
+            execute_values(cur, """
+                INSERT INTO channels (guild_id, requisitions_channel_id, archive_channel_id, server_name)
+                VALUES %s
+                ON CONFLICT (guild_id) DO UPDATE
+                SET requisitions_channel_id = EXCLUDED.requisitions_channel_id,
+                    archive_channel_id = EXCLUDED.archive_channel_id,
+                    server_name = EXCLUDED.server_name;
+            """, [(row['guild_id'], row['requisitions_channel_id'], row['archive_channel_id'], row['server_name'])
+                  for row in rows])
+            return len(rows)
+        return await self.db.run(op, label='insert channels')
+
+    async def pending_guilds(self, shards=None):
+        predicate, params = shard_filter('guild_id', shards)
+        rows = await self.db.fetch(f"""
+            SELECT DISTINCT guild_id FROM requisitions
+            WHERE status = %s AND {predicate};
+        """, (STATUS_PENDING, *params))
+        return [row['guild_id'] for row in rows]
+
+    async def claim_pending(self, guild_id, limit):
+        # Moves up to limit imported requisitions of a guild from pending to open so
+        # they can be posted, soonest deadline first. Two claimers never get the same row.
+        def op(cur):
+            cur.execute("""
+                UPDATE requisitions
+                SET status = %s, version = version + 1
+                WHERE id IN (
+                    SELECT id FROM requisitions
+                    WHERE guild_id = %s AND status = %s
+                    ORDER BY deadline
+                    LIMIT %s
+                    FOR UPDATE SKIP LOCKED
+                )
+                RETURNING *;
+            """, (STATUS_OPEN, guild_id, STATUS_PENDING, limit))
+            rows = cur.fetchall()
+            cur.execute(DEMAND_SQL, (1, 1, [row['id'] for row in rows]))
+            return rows
+        return await self.db.run(op, label='update requisitions')
+
+    async def set_message_id(self, requisition_id, message_id):
+        await self.db.execute("""
+            UPDATE requisitions
+            SET message_id = %s
+            WHERE id = %s;
+        """, (message_id, requisition_id))
+
+    async def load_open_requisitions(self, statuses, limit, shards=None):
+        predicate, params = shard_filter('guild_id', shards)
+        return await self.db.fetch(f"""
+            SELECT * FROM requisitions
+            WHERE status = ANY(%s) AND message_id IS NOT NULL AND {predicate}
+            ORDER BY id DESC
+            LIMIT %s;
+        """, (list(statuses), *params, limit))
+
+    async def requisitions_changed_since(self, since, shards=None):
+        predicate, params = shard_filter('guild_id', shards)
+        return await self.db.fetch(f"""
+            SELECT * FROM requisitions
+            WHERE updated_at >= %s AND message_id IS NOT NULL AND {predicate};
+        """, (since, *params))
+
+    async def legacy_requisitions(self, statuses):
+        # Requisitions with a post but no guild ID, from before guild IDs were recorded
+        return await self.db.fetch("""
+            SELECT * FROM requisitions
+            WHERE guild_id IS NULL AND status = ANY(%s) AND message_id IS NOT NULL
+            ORDER BY id;
+        """, (list(statuses),))
+
+    async def adopt_legacy_requisition(self, requisition_id, guild_id):
+        # Records the guild a legacy requisition's post was found in, for it and its
+        # reminders. Returns the new version, or None if it already had one.
+        def op(cur):
+            cur.execute("""
+                UPDATE requisitions SET guild_id = %s, version = version + 1
+                WHERE id = %s AND guild_id IS NULL
+                RETURNING message_id, status, version;
+            """, (guild_id, requisition_id))
+            row = cur.fetchone()
+            if row is None:
+                return None
+            if row['status'] in LISTED_STATUSES:
+                cur.execute(DEMAND_SQL, (1, 1, [requisition_id]))
+            cur.execute("UPDATE reminders SET guild_id = %s WHERE message_id = %s AND guild_id IS NULL;",
+                        (guild_id, row['message_id']))
+            return row['version']
+        return await self.db.run(op, label='update requisitions')
+
+    async def close_legacy_requisitions(self, requisition_ids, status, from_statuses):
+        # Closes legacy requisitions whose post is gone; returns their message IDs
+        rows = await self.db.fetch("""
+            UPDATE requisitions SET status = %s, version = version + 1
+            WHERE id = ANY(%s) AND guild_id IS NULL AND status = ANY(%s)
+            RETURNING message_id;
+        """, (status, list(requisition_ids), list(from_statuses)))
+        return [row['message_id'] for row in rows]
+
+    async def get_requisition(self, message_id, statuses):
+        return await self.db.fetchrow("""
+            SELECT * FROM requisitions
+            WHERE message_id = %s AND status = ANY(%s);
+        """, (message_id, list(statuses)))
+
+    async def transition(self, message_id, status, from_statuses, fulfilled_by=()):
+        # Compare-and-set on the status: returns the new version, or None if the
+        # requisition was no longer in any of from_statuses. Guild stats are updated in
+        # the same transaction; fulfilled_by are the users credited when archiving.
+        def op(cur):
+            cur.execute("""
+                SELECT id, guild_id, status, created_at, accepted_at, completed_at, LOCALTIMESTAMP AS now
+                FROM requisitions
+                WHERE message_id = %s AND status = ANY(%s)
+                FOR UPDATE;
+            """, (message_id, list(from_statuses)))
+            row = cur.fetchone()
+            if row is None:
+                return None
+            cur.execute("""
+                UPDATE requisitions
+                SET status = %s, version = version + 1,
+                    accepted_at = COALESCE(accepted_at, %s), completed_at = COALESCE(completed_at, %s)
+                WHERE id = %s
+                RETURNING version;
+            """, (status, row['now'] if status == STATUS_ACCEPTED else None,
+                  row['now'] if status == STATUS_COMPLETED else None, row['id']))
+            version = cur.fetchone()['version']
+            record_stats(cur, row, *transition_stats(row, status, fulfilled_by))
+            return version
+        return await self.db.run(op, label='update requisitions')
+
+    async def set_completion_details(self, message_id, completion_details, status):
+        # Only while the requisition is in status; returns the new version or None
+        row = await self.db.fetchrow("""
+            UPDATE requisitions
+            SET completion_details = %s, version = version + 1
+            WHERE message_id = %s AND status = %s
+            RETURNING version;
+        """, (completion_details, message_id, status))
+        return None if row is None else row['version']
+
+    async def update_requisition(self, message_id, version, quantity, payment, deadline):
+        # Optimistic update: applied only if the row is still at version. Returns the
+        # new version, or None if it changed in the meantime.
+        def op(cur):
+            cur.execute("""
+                SELECT id, status FROM requisitions
+                WHERE message_id = %s AND version = %s
+                FOR UPDATE;
+            """, (message_id, version))
+            row = cur.fetchone()
+            if row is None:
+                return None
+            listed = row['status'] in LISTED_STATUSES
+            if listed:
+                cur.execute(DEMAND_SQL, (-1, -1, [row['id']]))
+            cur.execute("""
+                UPDATE requisitions
+                SET quantity = %s, payment = %s, deadline = %s, version = version + 1
+                WHERE id = %s
+                RETURNING version;
+            """, (quantity, payment, deadline, row['id']))
+            new_version = cur.fetchone()['version']
+            if listed:
+                cur.execute(DEMAND_SQL, (1, 1, [row['id']]))
+            return new_version
+        return await self.db.run(op, label='update requisitions')
+
+    async def expire_requisitions(self, cutoff, limit, shards=None):
+        # Claims up to limit open or accepted requisitions with a deadline before cutoff
+        predicate, params = shard_filter('guild_id', shards)
+
+        def op(cur):
+            cur.execute(EXPIRE_SQL.format(predicate=predicate), (STATUS_EXPIRED, cutoff, *params, limit))
+            rows = cur.fetchall()
+            cur.execute(DEMAND_SQL, (-1, -1, [row['id'] for row in rows]))
+            return rows
+        return await self.db.run(op, label='update requisitions')
+
+    async def compact_stats(self, limit, shards=None):
+        # Returns the number of events folded; fewer than limit means none are left
+        predicate, params = shard_filter('guild_id', shards)
+
+        def op(cur):
+            cur.execute(COMPACT_SQL.format(predicate=predicate), (*params, limit))
+            events = cur.fetchone()['events']
+            cur.execute(f"DELETE FROM demand_stats WHERE open_count = 0 AND {predicate};", params)
+            return events
+        return await self.db.run(op, label='compact stats')
+
+    async def guild_stats(self, guild_id, since, demand_limit, fulfiller_limit):
+        # (top open demand rows, {metric: {bucket: count}} for the timings, [(user_id, count)]
+        # of the top fulfillers) for a guild, counting events on or after the day since
+        def op(cur):
+            cur.execute("""
+                SELECT material, region, open_count, open_quantity FROM demand_stats
+                WHERE guild_id = %s AND open_count > 0
+                ORDER BY open_quantity DESC, material, region
+                LIMIT %s;
+            """, (guild_id, demand_limit))
+            demand = cur.fetchall()
+            timings = {}
+            for metric in (METRIC_ACCEPT, METRIC_COMPLETE):
+                cur.execute(STATS_COUNTS_SQL + ";", (guild_id, metric, since) * 2)
+                timings[metric] = {row['key']: row['count'] for row in cur.fetchall()}
+            cur.execute(STATS_COUNTS_SQL + "ORDER BY count DESC, key LIMIT %s;",
+                        (*(guild_id, METRIC_FULFILLED, since) * 2, fulfiller_limit))
+            fulfillers = [(row['key'], row['count']) for row in cur.fetchall()]
+            return demand, timings, fulfillers
+        return await self.db.run(op, label='guild stats')
+
+    async def insert_feedback(self, row):
+        # Returns the stored row
+        columns = list(row)
+        return await self.db.fetchrow(f"""
+            INSERT INTO feedback ({', '.join(columns)})
+            VALUES ({', '.join(['%s'] * len(columns))})
+            RETURNING *;
+        """, [row[column] for column in columns])
+
+    async def get_feedback(self, feedback_id):
+        return await self.db.fetchrow("SELECT * FROM feedback WHERE id = %s;", (feedback_id,))
+
+    async def load_pending_feedback(self):
+        return await self.db.fetch("SELECT * FROM feedback WHERE received_at IS NULL ORDER BY id;")
+
+    async def record_feedback(self, feedback_id, rating, comments):
+        # Stores the answer and adds the rating to every fulfiller's reputation. Returns
+        # False if the request was already answered or has expired.
+        def op(cur):
+            cur.execute("""
+                UPDATE feedback
+                SET rating = %s, comments = %s, received_at = LOCALTIMESTAMP
+                WHERE id = %s AND received_at IS NULL
+                RETURNING guild_id, fulfilled_by;
+            """, (rating, comments, feedback_id))
+            row = cur.fetchone()
+            if row is None:
+                return False
+            if row['guild_id'] is not None and row['fulfilled_by']:
+                cur.execute("""
+                    INSERT INTO reputation (guild_id, user_id, ratings, rating_total)
+                    SELECT DISTINCT %s::bigint, user_id, 1, %s FROM unnest(%s::bigint[]) AS user_id
+                    ORDER BY 2
+                    ON CONFLICT (guild_id, user_id) DO UPDATE
+                    SET ratings = reputation.ratings + 1,
+                        rating_total = reputation.rating_total + EXCLUDED.rating_total;
+                """, (row['guild_id'], rating, row['fulfilled_by']))
+            return True
+        return await self.db.run(op, label='update feedback')
+
+    async def expire_feedback(self, before):
+        # Drops the requests requested before and never answered; returns how many
+        rows = await self.db.fetch("""
+            DELETE FROM feedback
+            WHERE received_at IS NULL AND requested_at < %s
+            RETURNING id;
+        """, (before,))
+        return len(rows)
+
+    async def reputation(self, guild_id, user_id):
+        return await self.db.fetchrow("SELECT ratings, rating_total FROM reputation WHERE guild_id = %s AND user_id = %s;",
+                                      (guild_id, user_id))
+
+    async def search_requisitions(self, guild_id, statuses, query, limit, offset):
+        conditions = ["guild_id = %s", "status = ANY(%s)", "message_id IS NOT NULL"]
+        params = [guild_id, list(statuses)]
+        for column, terms in (('material', query.material), ('payment', query.payment)):
+            for term in terms:
+                conditions.append(f"{column} ILIKE %s")
+                params.append(like_pattern(term))
+        if query.region:
+            conditions.append("lower(region) = %s")
+            params.append(query.region)
+        if query.after:
+            conditions.append("deadline >= %s")
+            params.append(query.after)
+        if query.before:
+            conditions.append("deadline <= %s")
+            params.append(query.before)
+        rows = await self.db.fetch(f"""
+            SELECT *, COUNT(*) OVER () AS total FROM requisitions
+            WHERE {' AND '.join(conditions)}
+            ORDER BY deadline, message_id
+            LIMIT %s OFFSET %s;
+        """, (*params, limit, offset))
+        return rows, rows[0]['total'] if rows else 0
+
+    async def apply_reactions(self, rows):
+        # rows of (message_id, accepted_add, accepted_remove, completed_add, completed_remove)
+        def op(cur):
+            execute_values(cur, FLUSH_SQL, rows, template=FLUSH_TEMPLATE, page_size=len(rows))
+        await self.db.run(op, label='journal flush')
+
+    async def load_reminders(self):
+        return await self.db.fetch("SELECT id, message_id, guild_id, user_id, content, due_at FROM reminders")
+
+    async def reminder_ids(self):
+        return await self.db.fetch("SELECT id, guild_id FROM reminders;")
+
+    async def get_reminders(self, reminder_ids):
+        return await self.db.fetch("SELECT id, message_id, guild_id, user_id, content, due_at FROM reminders WHERE id = ANY(%s);",
+                                   (list(reminder_ids),))
+
+    async def insert_reminder(self, message_id, guild_id, user_id, kind, content, due_at):
+        row = await self.db.fetchrow("""
+            INSERT INTO reminders (message_id, guild_id, user_id, kind, content, due_at)
+            VALUES (%s, %s, %s, %s, %s, %s)
+            RETURNING id;
+        """, (message_id, guild_id, user_id, kind, content, due_at))
+        return row['id']
+
+    async def delete_reminders(self, message_ids, kind=None):
+        # Returns the IDs of the reminders deleted
+        if kind is None:
+            rows = await self.db.fetch("DELETE FROM reminders WHERE message_id = ANY(%s) RETURNING id;",
+                                       (list(message_ids),))
+        else:
+            rows = await self.db.fetch("DELETE FROM reminders WHERE message_id = ANY(%s) AND kind = %s RETURNING id;",
+                                       (list(message_ids), kind))
+        return [row['id'] for row in rows]
+
+    async def delete_reminders_by_id(self, reminder_ids):
+        await self.db.execute("DELETE FROM reminders WHERE id = ANY(%s);", (list(reminder_ids),))
+
+    async def load_conversations(self):
+        return await self.db.fetch("SELECT * FROM conversations ORDER BY id")
+
+    async def get_conversation(self, session_id):
+        return await self.db.fetchrow("SELECT * FROM conversations WHERE id = %s;", (session_id,))
+
+    async def insert_conversation(self, user_id, channel_id, guild_id, flow, step, data, context, step_deadline, expires_at):
+        row = await self.db.fetchrow("""
+            INSERT INTO conversations (user_id, channel_id, guild_id, flow, step, data, context, step_deadline, expires_at)
+            VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)
+            RETURNING id;
+        """, (user_id, channel_id, guild_id, flow, step, data, context, step_deadline, expires_at))
+        return row['id']
+
+    async def update_conversation(self, session_id, step, data, step_deadline):
+        await self.db.execute("""
+            UPDATE conversations
+            SET step = %s, data = %s, step_deadline = %s
+            WHERE id = %s;
+        """, (step, data, step_deadline, session_id))
+
+    async def set_conversation_deadline(self, session_id, step_deadline):
+        await self.db.execute("UPDATE conversations SET step_deadline = %s WHERE id = %s;", (step_deadline, session_id))
+
+    async def delete_conversation(self, session_id):
+        await self.db.execute("DELETE FROM conversations WHERE id = %s;", (session_id,))
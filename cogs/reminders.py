@@ -0,0 +1,208 @@
+import asyncio
+import heapq
+import logging
+from datetime import datetime, timedelta
+
+import discord
+
+from cogs import metrics
+from cogs.logs import log_ids
+
+logger = logging.getLogger('matmaster.reminders')
+
+pending_reminders = metrics.gauge('matmaster_reminders_pending', 'Reminders waiting to be delivered.')
+
+KIND_OPEN = 'open'
+KIND_DEADLINE = 'deadline'
+
+# Longest the scheduler sleeps without re-checking the clock
+MAX_SLEEP = 300
+
+# Failed deliveries are retried after RETRY_DELAY seconds, doubling up to MAX_RETRY_DELAY.
+# A DM that keeps failing is given up on after MAX_ATTEMPTS.
+RETRY_DELAY = 30
+MAX_RETRY_DELAY = 3600
+MAX_ATTEMPTS = 5
+
+
+# Persistent reminder scheduler. Pending reminders live in storage and in a
+# single in-process min-heap ordered by due time; one task sleeps until the earliest
+# entry is due and delivers everything due at that point in batches. Cancelled
+# reminders are dropped lazily when they reach the top of the heap. In a sharded
+# cluster each process only loads the reminders of the guilds it owns.
+class ReminderScheduler:
+    def __init__(self, bot, storage, outbound, batch_size=50, owns=lambda guild_id: True):
+        self.bot = bot
+        self.storage = storage
+        self.outbound = outbound
+        self.owns = owns
+        self.batch_size = batch_size
+        self.heap = []
+        self.pending = {}
+        self.by_message = {}
+        self.attempts = {}
+        # Sent or given up on, but not yet deleted from storage
+        self.finished = set()
+        self.wake = asyncio.Event()
+        self.task = None
+        pending_reminders.set_function(lambda: len(self.pending))
+
+    def __len__(self):
+        return len(self.pending)
+
+    async def load(self, snapshot=None):
+        # Loads every pending reminder, or restores a snapshot of them and fetches only
+        # reminders added since; those deleted since, or finished but not yet deleted,
+        # are dropped
+        self.heap, self.pending, self.by_message, self.attempts = [], {}, {}, {}
+        if snapshot is None:
+            rows = await self.storage.load_reminders()
+        else:
+            owned = {row['id'] for row in await self.storage.reminder_ids() if self.owns(row['guild_id'])}
+            for reminder_id, message_id, user_id, content, due_at in snapshot:
+                if reminder_id in owned and reminder_id not in self.finished:
+                    self._push(reminder_id, message_id, user_id, content, datetime.fromisoformat(due_at))
+            missing = owned - self.pending.keys() - self.finished
+            rows = await self.storage.get_reminders(missing) if missing else []
+        for row in rows:
+            if self.owns(row['guild_id']) and row['id'] not in self.finished:
+                self._push(row['id'], row['message_id'], row['user_id'], row['content'], row['due_at'])
+        logger.info("Loaded %d pending reminders.", len(self.pending))
+
+    def snapshot(self):
+        entries = {reminder_id: due_at for due_at, reminder_id in self.heap if reminder_id in self.pending}
+        return [[reminder_id, *self.pending[reminder_id], due_at] for reminder_id, due_at in entries.items()]
+
+    async def start(self):
+        self.task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        if self.task:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+
+    def _push(self, reminder_id, message_id, user_id, content, due_at):
+        self.pending[reminder_id] = (message_id, user_id, content)
+        self.by_message.setdefault(message_id, set()).add(reminder_id)
+        heapq.heappush(self.heap, (due_at, reminder_id))
+
+    def _forget(self, reminder_id):
+        self.attempts.pop(reminder_id, None)
+        entry = self.pending.pop(reminder_id, None)
+        if entry is None:
+            return
+        ids = self.by_message.get(entry[0])
+        if ids is not None:
+            ids.discard(reminder_id)
+            if not ids:
+                del self.by_message[entry[0]]
+
+    async def schedule(self, message_id, guild_id, user_id, content, due_at, kind=KIND_OPEN):
+        reminder_id = await self.storage.insert_reminder(message_id, guild_id, user_id, kind, content, due_at)
+        self._push(reminder_id, message_id, user_id, content, due_at)
+        if self.heap[0][1] == reminder_id:
+            self.wake.set()
+        logger.info("Scheduled %s reminder %s for user %s at %s", kind, reminder_id, user_id, due_at,
+                    extra=log_ids(guild_id=guild_id, message_id=message_id, user_id=user_id))
+
+    async def cancel(self, message_id, kind=None):
+        return self._cancelled(await self.storage.delete_reminders([message_id], kind))
+
+    async def cancel_many(self, message_ids):
+        return self._cancelled(await self.storage.delete_reminders(message_ids))
+
+    def _cancelled(self, reminder_ids):
+        for reminder_id in reminder_ids:
+            self._forget(reminder_id)
+        if len(self.heap) > 2 * len(self.pending) + 64:
+            self.heap = [entry for entry in self.heap if entry[1] in self.pending]
+            heapq.heapify(self.heap)
+        return len(reminder_ids)
+
+    def _pop_due(self, now):
+        due = []
+        while self.heap and self.heap[0][0] <= now and len(due) < self.batch_size:
+            _, reminder_id = heapq.heappop(self.heap)
+            if reminder_id in self.pending:
+                due.append((reminder_id, self.pending[reminder_id]))
+        return due
+
+    def _retry(self, reminder_ids):
+        # Puts popped reminders back on the heap, each attempt waiting twice as long
+        now = datetime.now()
+        for reminder_id in reminder_ids:
+            if reminder_id not in self.pending:
+                continue
+            attempts = self.attempts.get(reminder_id, 0) + 1
+            self.attempts[reminder_id] = attempts
+            delay = min(RETRY_DELAY * 2 ** (attempts - 1), MAX_RETRY_DELAY)
+            heapq.heappush(self.heap, (now + timedelta(seconds=delay), reminder_id))
+
+    async def run(self):
+        while True:
+            self.wake.clear()
+            now = datetime.now()
+            due = self._pop_due(now)
+            if not due:
+                timeout = MAX_SLEEP
+                if self.heap:
+                    timeout = min(MAX_SLEEP, max(0, (self.heap[0][0] - now).total_seconds()))
+                try:
+                    await asyncio.wait_for(self.wake.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            try:
+                await self.deliver(due)
+            except Exception as e:
+                # Some of the batch may have been sent, so it isn't retried; it is
+                # delivered again only after a restart
+                logger.error("Reminder delivery failed for %d reminders: %s", len(due), e)
+
+    async def deliver(self, due):
+        results = await asyncio.gather(
+            *(self.outbound.send_dm(user_id, content, coalesce=False) for _, (_, user_id, content) in due),
+            return_exceptions=True
+        )
+        delivered, closed, given_up, failed = [], [], [], []
+        for (reminder_id, (message_id, user_id, _)), result in zip(due, results):
+            if not isinstance(result, Exception):
+                delivered.append(reminder_id)
+            elif isinstance(result, discord.Forbidden):
+                # DMs closed; retrying won't help
+                logger.warning("Could not deliver reminder %s: %s", reminder_id, result,
+                               extra=log_ids(message_id=message_id, user_id=user_id))
+                closed.append(reminder_id)
+            elif self.attempts.get(reminder_id, 0) + 1 >= MAX_ATTEMPTS:
+                logger.warning("Giving up on reminder %s after %d attempts: %s", reminder_id, MAX_ATTEMPTS, result,
+                               extra=log_ids(message_id=message_id, user_id=user_id))
+                given_up.append(reminder_id)
+            else:
+                failed.append(reminder_id)
+        # Finished reminders leave the heap whether or not the delete below succeeds,
+        # so none is sent twice; deleting only after sending means a crash mid-batch
+        # redelivers rather than drops
+        for reminder_id in delivered + closed + given_up:
+            self._forget(reminder_id)
+            self.finished.add(reminder_id)
+        await self.delete_finished()
+        self._retry(failed)
+        logger.info("Delivered %d reminders; %d to closed DMs, %d given up on, %d retrying later.",
+                    len(delivered), len(closed), len(given_up), len(failed))
+
+    async def delete_finished(self):
+        # Deletes finished reminders from storage, keeping them for the next batch if
+        # that fails
+        if not self.finished:
+            return
+        reminder_ids = list(self.finished)
+        try:
+            await self.storage.delete_reminders_by_id(reminder_ids)
+        except Exception as e:
+            logger.error("Could not delete %d finished reminders, retrying with the next batch: %s", len(reminder_ids), e)
+            return
+        self.finished.difference_update(reminder_ids)
@@ -0,0 +1,126 @@
+import asyncio
+from collections import OrderedDict
+
+from cogs import metrics
+
+edits_requested = metrics.counter('matmaster_post_edits_requested_total', 'Requisition post edits requested.')
+edits_coalesced = metrics.counter('matmaster_post_edits_coalesced_total', 'Post edits merged into an already pending edit.')
+edits_unchanged = metrics.counter('matmaster_post_edits_unchanged_total', 'Post edits skipped because the content was unchanged.')
+
+POST_TEMPLATE = (
+    "**{server_name} - {{region}}**\n"
+    "**Request from <@{{requester}}>:**\n"
+    "**Material:** {{material}}\n"
+    "**Quantity:** {{quantity}}\n"
+    "**Payment:** {{payment}}\n"
+    "**Deadline:** {{deadline}}\n"
+    "{{progress}}"
+    "React with ✋ to accept this job. React with ✅ when completed.\n"
+    "Requestor or admin can react with ❌ to cancel this job.\n"
+)
+
+ARCHIVE_TEMPLATE = (
+    "**{server_name} - {{region}}**\n"
+    "**Archived Request from <@{{requester}}>:**\n"
+    "**Material:** {{material}}\n"
+    "**Quantity:** {{quantity}}\n"
+    "**Payment:** {{payment}}\n"
+    "**Deadline:** {{deadline}}\n"
+    "**Completed by:** {{completed_by}}\n"
+    "**Completion Details:** {{completion_details}}\n"
+)
+
+
+def mentions(user_ids):
+    return ', '.join(f"<@{user_id}>" for user_id in user_ids)
+
+
+# Renders requisition posts from per-guild templates. The server name is baked into a
+# guild's templates once, so each render is a single format_map over the requisition.
+class Renderer:
+    def __init__(self):
+        self.templates = {}
+
+    def invalidate(self, guild_id):
+        self.templates.pop(guild_id, None)
+
+    def _templates(self, guild_id, config):
+        server_name = config['SERVER_NAME']
+        cached = self.templates.get(guild_id)
+        if cached is None or cached[0] != server_name:
+            escaped = server_name.replace('{', '{{').replace('}', '}}')
+            cached = self.templates[guild_id] = (
+                server_name,
+                POST_TEMPLATE.format(server_name=escaped),
+                ARCHIVE_TEMPLATE.format(server_name=escaped)
+            )
+        return cached
+
+    def post(self, guild_id, config, requisition):
+        accepted = len(requisition.accepted_by)
+        progress = ''
+        if accepted:
+            progress = f"**Accepted:** {accepted} | **Completed:** {len(requisition.completed_by)}/{accepted}\n"
+        return self._templates(guild_id, config)[1].format_map({**requisition.fields(), 'progress': progress})
+
+    def archive(self, guild_id, config, requisition, completion_details=None):
+        fields = {**requisition.fields(), 'completed_by': mentions(requisition.completed_by)}
+        if completion_details is not None:
+            fields['completion_details'] = completion_details
+        return self._templates(guild_id, config)[2].format_map(fields)
+
+
+# Debounced edits for requisition posts. State changes schedule a render; all changes to
+# the same message inside the window collapse into one edit, rendered from the latest
+# state when the window closes, and the edit is dropped if the text hasn't changed.
+class EditPipeline:
+    def __init__(self, outbound, window=1.5, max_tracked=10000):
+        self.outbound = outbound
+        self.window = window
+        self.max_tracked = max_tracked
+        self.pending = {}
+        self.contents = OrderedDict()
+
+    def __len__(self):
+        return len(self.pending)
+
+    def remember(self, message_id, content):
+        self.contents[message_id] = content
+        self.contents.move_to_end(message_id)
+        while len(self.contents) > self.max_tracked:
+            self.contents.popitem(last=False)
+
+    def forget(self, message_id):
+        self.pending.pop(message_id, None)
+        self.contents.pop(message_id, None)
+
+    def schedule(self, channel, message_id, render):
+        edits_requested.inc()
+        if message_id in self.pending:
+            edits_coalesced.inc()
+            self.pending[message_id] = (channel, render)
+            return
+        self.pending[message_id] = (channel, render)
+        asyncio.get_running_loop().call_later(self.window, self._flush, message_id)
+
+    def edit_now(self, channel, message_id, content):
+        # For edits whose outcome the caller reports back, e.g. !mm_update_request
+        self.pending.pop(message_id, None)
+        self.remember(message_id, content)
+        return self.outbound.edit(channel, message_id, content)
+
+    def _flush(self, message_id):
+        entry = self.pending.pop(message_id, None)
+        if entry is None:
+            return
+        channel, render = entry
+        content = render()
+        if self.contents.get(message_id) == content:
+            edits_unchanged.inc()
+            return
+        self.remember(message_id, content)
+        self.outbound.edit(channel, message_id, content)
+
+    def flush_all(self):
+        for message_id in list(self.pending):
+            self._flush(message_id)
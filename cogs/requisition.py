@@ -0,0 +1,85 @@
+import sys
+from array import array
+
+from cogs.requisition_cache import STATUS_OPEN
+
+# How deadlines are shown in posts and reminders
+DEADLINE_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+# Columns written when a requisition is inserted
+INSERT_COLUMNS = (
+    'requester', 'material', 'quantity', 'payment', 'deadline', 'accepted_by', 'completed_by',
+    'message_id', 'region', 'guild_id', 'completion_details', 'status'
+)
+
+
+# One requisition as held in the working set. Slotted, with the deadline kept as a
+# datetime, participants as packed int64 arrays and the highly repetitive material,
+# payment, region and status strings interned, so each open requisition costs a few
+# hundred bytes instead of a dict of lists and strings. from_row() and to_row() are
+# the only conversions to and from the requisitions table.
+class Requisition:
+    __slots__ = ('id', 'message_id', 'guild_id', 'requester', 'material', 'quantity', 'payment',
+                 'deadline', 'region', 'accepted_by', 'completed_by', 'completion_details', 'status', 'version')
+
+    def __init__(self, requester, material, quantity, payment, deadline, region, guild_id=None,
+                 accepted_by=(), completed_by=(), completion_details='', status=STATUS_OPEN,
+                 id=None, message_id=None, version=0):
+        self.id = id
+        self.message_id = message_id
+        self.guild_id = guild_id
+        self.requester = requester
+        self.material = sys.intern(material)
+        self.quantity = quantity
+        self.payment = sys.intern(payment)
+        self.deadline = deadline
+        self.region = sys.intern(region)
+        self.accepted_by = array('q', accepted_by)
+        self.completed_by = array('q', completed_by)
+        self.completion_details = completion_details
+        self.status = sys.intern(status)
+        self.version = version
+
+    def __repr__(self):
+        return f"<Requisition id={self.id} message_id={self.message_id} status={self.status}>"
+
+    @classmethod
+    def from_row(cls, row):
+        return cls(
+            row['requester'], row['material'], row['quantity'], row['payment'], row['deadline'],
+            row['region'], row['guild_id'], row['accepted_by'] or (), row['completed_by'] or (),
+            row.get('completion_details') or '', row['status'], row['id'], row['message_id'],
+            row.get('version') or 0
+        )
+
+    def to_row(self):
+        return {
+            'requester': self.requester,
+            'material': self.material,
+            'quantity': self.quantity,
+            'payment': self.payment,
+            'deadline': self.deadline,
+            'accepted_by': self.accepted_by.tolist(),
+            'completed_by': self.completed_by.tolist(),
+            'message_id': self.message_id,
+            'region': self.region,
+            'guild_id': self.guild_id,
+            'completion_details': self.completion_details,
+            'status': self.status
+        }
+
+    @property
+    def deadline_text(self):
+        return self.deadline.strftime(DEADLINE_FORMAT)
+
+    def fields(self):
+        # Template fields for the requisition post and archive renderers
+        return {
+            'requester': self.requester,
+            'material': self.material,
+            'quantity': self.quantity,
+            'payment': self.payment,
+            'deadline': self.deadline_text,
+            'region': self.region,
+            'completion_details': self.completion_details
+        }
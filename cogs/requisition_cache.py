@@ -0,0 +1,99 @@
+from collections import OrderedDict
+
+from cogs import metrics
+
+cache_size = metrics.gauge('matmaster_requisition_cache_size', 'Open requisitions held in the working set.')
+cache_evictions = metrics.gauge('matmaster_requisition_cache_evictions', 'Requisitions evicted from the working set since startup.')
+
+# Requisition lifecycle states stored in requisitions.status
+STATUS_OPEN = 'open'
+STATUS_ACCEPTED = 'accepted'
+STATUS_COMPLETED = 'completed'
+STATUS_ARCHIVED = 'archived'
+STATUS_CANCELLED = 'cancelled'
+STATUS_EXPIRED = 'expired'
+# Imported but not posted yet; the bot posts it and moves it to open
+STATUS_PENDING = 'pending'
+
+# States that still have a live post in the requisitions channel
+OPEN_STATUSES = (STATUS_OPEN, STATUS_ACCEPTED, STATUS_COMPLETED)
+
+# The states a requisition may enter each state from. Storage applies a transition only
+# while the row is still in one of them, so of two racing transitions - two handlers,
+# two processes, or a handler and the expiry sweep - exactly one takes effect.
+TRANSITIONS = {
+    STATUS_ACCEPTED: (STATUS_OPEN,),
+    STATUS_OPEN: (STATUS_ACCEPTED,),
+    STATUS_COMPLETED: (STATUS_ACCEPTED,),
+    STATUS_ARCHIVED: (STATUS_COMPLETED,),
+    STATUS_CANCELLED: OPEN_STATUSES,
+    STATUS_EXPIRED: (STATUS_OPEN, STATUS_ACCEPTED)
+}
+
+
+# Bounded LRU working set of open requisitions keyed by message ID. Message IDs that
+# were looked up and found not to be open requisitions are remembered separately so
+# repeated reactions on unrelated messages don't turn into repeated DB lookups.
+#
+# An optional search index is kept in step with the entries. complete is set by the
+# loader when every open requisition fit in the working set and cleared on the first
+# eviction; only while it is set can searches be answered from memory alone.
+class RequisitionCache:
+    def __init__(self, max_size=5000, max_misses=1000, index=None):
+        self.max_size = max_size
+        self.max_misses = max_misses
+        self.index = index
+        self.entries = OrderedDict()
+        self.misses = OrderedDict()
+        self.evictions = 0
+        self.complete = False
+        cache_size.set_function(lambda: len(self.entries))
+        cache_evictions.set_function(lambda: self.evictions)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, message_id):
+        return message_id in self.entries
+
+    def __iter__(self):
+        return iter(self.entries)
+
+    def get(self, message_id):
+        requisition = self.entries.get(message_id)
+        if requisition is not None:
+            self.entries.move_to_end(message_id)
+        return requisition
+
+    def put(self, message_id, requisition):
+        self.misses.pop(message_id, None)
+        self.entries[message_id] = requisition
+        self.entries.move_to_end(message_id)
+        if self.index is not None:
+            self.index.add(message_id, requisition)
+        while len(self.entries) > self.max_size:
+            evicted_id, evicted = self.entries.popitem(last=False)
+            if self.index is not None:
+                self.index.remove(evicted_id, evicted)
+            self.evictions += 1
+            self.complete = False
+
+    def pop(self, message_id, default=None):
+        requisition = self.entries.pop(message_id, None)
+        if requisition is None:
+            return default
+        if self.index is not None:
+            self.index.remove(message_id, requisition)
+        return requisition
+
+    def is_known_miss(self, message_id):
+        return message_id in self.misses
+
+    def mark_miss(self, message_id):
+        self.misses[message_id] = True
+        self.misses.move_to_end(message_id)
+        while len(self.misses) > self.max_misses:
+            self.misses.popitem(last=False)
+
+    def values(self):
+        return self.entries.values()
@@ -1,131 +1,418 @@
 import discord
 from discord.ext import commands
-from cerberus import Validator
 import asyncio
+import gzip
 import logging
-from datetime import datetime
-from dateparser import parse
-from psycopg2.extras import RealDictCursor
+from datetime import datetime, timedelta
+import json
+import os
 import random
+import tempfile
+import time
+import uuid
+from cogs.requisition import Requisition
+from cogs.requisition_cache import (
+    RequisitionCache, OPEN_STATUSES, STATUS_OPEN, STATUS_ACCEPTED, STATUS_COMPLETED,
+    STATUS_ARCHIVED, STATUS_CANCELLED, STATUS_EXPIRED, TRANSITIONS
+)
+from cogs.reminders import ReminderScheduler, KIND_OPEN, KIND_DEADLINE
+from cogs.write_behind import ReactionJournal
+from cogs.outbound import OutboundDispatcher
+from cogs.rendering import Renderer, EditPipeline
+from cogs.conversations import ConversationManager, Flow, Step
+from cogs.feedback import FeedbackCollector, reputation_text
+from cogs.validation import validate_requisition, error_text
+from cogs.logs import log_ids, sampled, CATEGORY_REACTION
+from cogs.deadlines import DeadlineParser
+from cogs.expiry import ExpirySweeper
+from cogs.stats import StatsCompactor, stats_embed, DEFAULT_DAYS, MAX_DAYS, TOP_DEMAND, TOP_FULFILLERS
+from cogs.users import UserCache
+from cogs.keyed_locks import KeyedLocks
+from cogs.transfer import FORMATS, TABLES
+from cogs.snapshot import read_snapshot, write_snapshot, requisition_entry, requisition_row
+from cogs import metrics
+from cogs.search import (
+    SearchIndex, SearchQuery, ResultPages, LISTED_STATUSES, PAGE_SIZE, parse_search
+)
 
-logger = logging.getLogger('discord')
+logger = logging.getLogger('matmaster.requisitions')
 
-# Validation schema
-schema = {
-    'material': {'type': 'string', 'required': True},
-    'quantity': {'type': 'integer', 'min': 1, 'required': True},
-    'payment': {'type': 'string', 'required': True},
-    'deadline': {'type': 'string', 'required': True},
-    'region': {'type': 'string', 'required': True}
-}
-v = Validator(schema)
+search_seconds = metrics.histogram('matmaster_search_seconds', 'Latency of !mm_list and !mm_search lookups.')
+command_seconds = metrics.histogram('matmaster_command_seconds', 'Command handler latency by command.')
+reaction_seconds = metrics.histogram('matmaster_reaction_handler_seconds', 'Raw reaction handler latency.')
+
+# Notification channel used to keep the processes of a sharded cluster in sync
+NOTIFY_CHANNEL = 'matmaster'
+
+OPEN_REMINDER_DELAY = timedelta(hours=1)
+DEADLINE_REMINDER_LEAD = timedelta(hours=24)
+EXPIRED_DETAILS = "Expired - the deadline passed before the requisition was completed."
+
+# How long a command issued during startup waits for state to load before giving up
+STARTUP_WAIT = 15
+STARTUP_RETRY_DELAY = 10
+# Imported requisitions are claimed for posting this many at a time
+PENDING_BATCH = 50
+# A warm start re-reads rows changed this long before its snapshot was taken, which
+# covers transactions still in flight at that moment
+RECONCILE_MARGIN = timedelta(minutes=5)
+# Most message lookups one start spends on legacy requisitions; the rest wait for the
+# next start
+LEGACY_LOOKUPS = 500
+
+def parse_quantity(message):
+    def parse(content):
+        if not content.isdigit():
+            raise ValueError(message)
+        return int(content)
+    return parse
+
+class NotReady(commands.CheckFailure):
+    pass
 
 class RequisitionFlow(commands.Cog):
-    def __init__(self, bot, conn):
+    def __init__(self, bot, storage, cache_size=5000, journal_interval=2.0, outbound_workers=4, dm_coalesce_window=2.0,
+                 edit_window=1.5, conversation_timeout=300, conversation_ttl=1800,
+                 deadline_languages=('en',), deadline_timezone=None, shard_ids=None, shard_count=None,
+                 user_cache_size=2000, expiry_interval=300, expiry_grace_hours=0, snapshot_path=None,
+                 snapshot_max_age=86400, stats_interval=3600, feedback_ttl=86400):
         self.bot = bot
-        self.conn = conn
+        self.storage = storage
+        self.shard_ids = set(shard_ids) if shard_ids is not None else None
+        self.shard_count = shard_count
+        self.instance_id = uuid.uuid4().hex
+        self.listener = None
+        self.snapshot_path = snapshot_path
+        self.snapshot_max_age = snapshot_max_age
+        self.ready = asyncio.Event()
+        self.loading = None
         self.channel_ids = {}
-        self.active_requisitions = {}
-        self.reminder_tasks = {}
+        self.search_index = SearchIndex()
+        self.active_requisitions = RequisitionCache(max_size=cache_size, index=self.search_index)
+        # Serializes the handlers touching one requisition, keyed by message ID
+        self.locks = KeyedLocks()
+        self.users = UserCache(bot, max_size=user_cache_size)
+        self.outbound = OutboundDispatcher(bot, self.users, workers=outbound_workers, coalesce_window=dm_coalesce_window)
+        self.reminders = ReminderScheduler(bot, storage, self.outbound, owns=self.owns_guild)
+        self.renderer = Renderer()
+        self.edits = EditPipeline(self.outbound, window=edit_window)
+        self.conversations = ConversationManager(
+            storage, self.send_prompt, step_timeout=conversation_timeout, ttl=conversation_ttl,
+            owns=self.owns_session, on_remote=self.hand_off_session
+        )
+        self.register_flows()
+        self.feedback = FeedbackCollector(
+            bot, storage, self.outbound, self.edits, ttl=feedback_ttl,
+            active=self.owns_guild(None), on_remote=lambda feedback_id: self.publish('feedback', feedback_id)
+        )
+        self.deadlines = DeadlineParser(languages=deadline_languages)
+        self.deadline_timezone = deadline_timezone
+        self.journal = ReactionJournal(storage, interval=journal_interval)
+        self.expiry = ExpirySweeper(
+            bot, storage, self.expire_requisitions, interval=expiry_interval,
+            grace=timedelta(hours=expiry_grace_hours), shards=self.shards
+        )
+        self.stats = StatsCompactor(storage, interval=stats_interval, shards=self.shards)
         logger.info("RequisitionFlow cog initialized.")
-        self.create_tables()
-        self.load_channel_ids()
-        self.load_active_requisitions()
-
-    def create_tables(self):
-        with self.conn.cursor() as cur:
-            cur.execute("""
-                CREATE TABLE IF NOT EXISTS requisitions (
-                    id SERIAL PRIMARY KEY,
-                    requester BIGINT,
-                    material TEXT,
-                    quantity INTEGER,
-                    payment TEXT,
-                    deadline TIMESTAMP,
-                    accepted_by BIGINT[],
-                    completed_by BIGINT[],
-                    message_id BIGINT,
-                    region TEXT,
-                    completion_details TEXT
-                );
-            """)
-            cur.execute("""
-                CREATE TABLE IF NOT EXISTS channels (
-                    guild_id BIGINT PRIMARY KEY,
-                    requisitions_channel_id BIGINT,
-                    archive_channel_id BIGINT,
-                    server_name TEXT
-                );
-            """)
-            self.conn.commit()
-
-    def load_channel_ids(self):
-        with self.conn.cursor(cursor_factory=RealDictCursor) as cur:
-            cur.execute("SELECT * FROM channels")
-            rows = cur.fetchall()
-            for row in rows:
-                self.channel_ids[row['guild_id']] = {
-                    'REQUISITIONS_CHANNEL_ID': row['requisitions_channel_id'],
-                    'ARCHIVE_CHANNEL_ID': row['archive_channel_id'],
-                    'SERVER_NAME': row['server_name']
-                }
-        logger.info(f"Loaded channel IDs for {len(self.channel_ids)} guilds.")
-
-    def load_active_requisitions(self):
-        with self.conn.cursor(cursor_factory=RealDictCursor) as cur:
-            cur.execute("SELECT * FROM requisitions WHERE message_id IS NOT NULL")
-            rows = cur.fetchall()
-            for row in rows:
-                self.active_requisitions[row['message_id']] = {
-                    'requester': row['requester'],
-                    'material': row['material'],
-                    'quantity': row['quantity'],
-                    'payment': row['payment'],
-                    'deadline': row['deadline'].strftime('%Y-%m-%d %H:%M:%S'),
-                    'accepted_by': row['accepted_by'],
-                    'completed_by': row['completed_by'],
-                    'region': row['region'],
-                    'completion_details': row.get('completion_details', "")
-                }
-        logger.info(f"Loaded active requisitions for {len(self.active_requisitions)} messages.")
+
+    async def cog_load(self):
+        # State is loaded in the background so the gateway connects in the meantime;
+        # commands and events wait for self.ready. The schema is migrated by
+        # storage.migrate() before the bot starts.
+        self.loading = asyncio.create_task(self.load_state())
+
+    async def cog_unload(self):
+        if self.loading and not self.loading.done():
+            self.loading.cancel()
+        if self.listener:
+            await self.listener.close()
+        await self.expiry.stop()
+        await self.stats.stop()
+        await self.conversations.stop()
+        await self.feedback.stop()
+        await self.reminders.stop()
+        await self.journal.stop()
+        self.edits.flush_all()
+        await self.outbound.stop()
+        if self.ready.is_set() and self.snapshot_path:
+            try:
+                await self.save_snapshot()
+            except Exception as e:
+                logger.error("Could not write snapshot: %s", e)
+
+    async def cog_check(self, ctx):
+        if not self.ready.is_set():
+            try:
+                await asyncio.wait_for(self.ready.wait(), STARTUP_WAIT)
+            except asyncio.TimeoutError:
+                raise NotReady("MatMaster is still starting up. Please try again in a minute.")
+        return True
+
+    async def cog_before_invoke(self, ctx):
+        ctx.started = time.perf_counter()
+
+    async def cog_after_invoke(self, ctx):
+        command_seconds.observe(time.perf_counter() - ctx.started, command=ctx.command.name)
+
+    async def load_state(self):
+        started = time.perf_counter()
+        while True:
+            try:
+                snapshot = await self.read_snapshot()
+                if snapshot is None:
+                    await self.load_channel_ids()
+                    await self.load_active_requisitions()
+                    await self.reminders.load()
+                else:
+                    await self.warm_start(snapshot)
+                await self.conversations.load()
+                await self.feedback.load()
+                self.listener = await self.storage.listen(NOTIFY_CHANNEL, self.on_notification)
+                break
+            except Exception as e:
+                logger.error("Loading requisition state failed, retrying in %ss: %s", STARTUP_RETRY_DELAY, e)
+                await asyncio.sleep(STARTUP_RETRY_DELAY)
+        await self.outbound.start()
+        await self.reminders.start()
+        await self.journal.start()
+        await self.conversations.start()
+        await self.feedback.start()
+        await self.expiry.start()
+        await self.stats.start()
+        asyncio.create_task(self.deadlines.warm())
+        asyncio.create_task(self.publish_all_pending())
+        if self.owns_guild(None):
+            asyncio.create_task(self.reconcile_legacy())
+        self.ready.set()
+        logger.info("RequisitionFlow ready after %.2fs (%s start).", time.perf_counter() - started, 'warm' if snapshot else 'cold')
+
+    @property
+    def snapshot_shards(self):
+        return None if self.shard_ids is None else [self.shard_count, sorted(self.shard_ids)]
+
+    async def read_snapshot(self):
+        if not self.snapshot_path:
+            return None
+        return await asyncio.get_running_loop().run_in_executor(
+            None, read_snapshot, self.snapshot_path, self.snapshot_shards, self.snapshot_max_age
+        )
+
+    async def save_snapshot(self):
+        state = {
+            'shards': self.snapshot_shards,
+            'clock': await self.storage.clock(),
+            'channels': [
+                [guild_id, config['REQUISITIONS_CHANNEL_ID'], config['ARCHIVE_CHANNEL_ID'], config['SERVER_NAME']]
+                for guild_id, config in self.channel_ids.items()
+            ],
+            'complete': self.active_requisitions.complete,
+            'requisitions': [requisition_entry(requisition) for requisition in self.active_requisitions.values()],
+            'reminders': self.reminders.snapshot()
+        }
+        await asyncio.get_running_loop().run_in_executor(None, write_snapshot, self.snapshot_path, state)
+
+    async def warm_start(self, snapshot):
+        # Restores the snapshot, then applies whatever changed in storage since it was taken
+        since = datetime.fromisoformat(snapshot['clock']) - RECONCILE_MARGIN
+        for guild_id, requisitions_channel_id, archive_channel_id, server_name in snapshot['channels']:
+            self.store_channel_config({
+                'guild_id': guild_id,
+                'requisitions_channel_id': requisitions_channel_id,
+                'archive_channel_id': archive_channel_id,
+                'server_name': server_name
+            })
+        for row in await self.storage.channels_changed_since(since, self.shards):
+            self.store_channel_config(row)
+
+        for entry in snapshot['requisitions']:
+            row = requisition_row(entry)
+            self.active_requisitions.put(row['message_id'], Requisition.from_row(row))
+        self.active_requisitions.complete = snapshot['complete']
+        changed = await self.storage.requisitions_changed_since(since, self.shards)
+        for row in changed:
+            if row['status'] in OPEN_STATUSES:
+                self.active_requisitions.put(row['message_id'], Requisition.from_row(row))
+            else:
+                self.active_requisitions.pop(row['message_id'])
+
+        await self.reminders.load(snapshot['reminders'])
+        logger.info("Restored %d requisitions from snapshot, %d changed since.", len(snapshot['requisitions']), len(changed))
+
+    def owns_guild(self, guild_id):
+        # Same formula Discord uses to route a guild to a shard. Rows from before guild IDs
+        # were recorded, and DMs, belong to whichever process runs shard 0.
+        if self.shard_ids is None:
+            return True
+        if guild_id is None:
+            return 0 in self.shard_ids
+        return (guild_id >> 22) % self.shard_count in self.shard_ids
+
+    def owns_session(self, session):
+        return self.owns_guild(None if session.channel_id is None else session.guild_id)
+
+    @property
+    def shards(self):
+        # (shard_count, shard_ids) for storage queries limited to the guilds this process owns
+        if self.shard_ids is None:
+            return None
+        return self.shard_count, self.shard_ids
+
+    def store_channel_config(self, row):
+        self.channel_ids[row['guild_id']] = {
+            'REQUISITIONS_CHANNEL_ID': row['requisitions_channel_id'],
+            'ARCHIVE_CHANNEL_ID': row['archive_channel_id'],
+            'SERVER_NAME': row['server_name']
+        }
+        self.renderer.invalidate(row['guild_id'])
+
+    async def load_channel_ids(self):
+        rows = await self.storage.load_channels(self.shards)
+        for row in rows:
+            self.store_channel_config(row)
+        logger.info("Loaded channel IDs for %d guilds.", len(self.channel_ids))
+
+    async def reload_channel_config(self, guild_id):
+        row = await self.storage.get_channel_config(guild_id)
+        if row is not None:
+            self.store_channel_config(row)
+            logger.info("Reloaded channel configuration for guild %s.", guild_id, extra=log_ids(guild_id=guild_id))
+
+    async def publish(self, kind, target):
+        payload = json.dumps({'kind': kind, 'id': target, 'origin': self.instance_id})
+        await self.storage.notify(NOTIFY_CHANNEL, payload)
+
+    def on_notification(self, payload):
+        message = json.loads(payload)
+        if message['origin'] == self.instance_id:
+            return
+        kind, target = message['kind'], message['id']
+        if kind == 'config' and self.owns_guild(target):
+            asyncio.create_task(self.reload_channel_config(target))
+        elif kind == 'requisition':
+            # Dropped rather than patched and reloaded from the DB, so searches still see it
+            if self.active_requisitions.pop(target) is not None:
+                asyncio.create_task(self.get_requisition(target))
+        elif kind == 'conversation':
+            asyncio.create_task(self.conversations.adopt(target))
+        elif kind == 'feedback':
+            asyncio.create_task(self.feedback.adopt(target))
+        elif kind == 'pending' and self.owns_guild(target):
+            asyncio.create_task(self.publish_pending(target))
+
+    async def hand_off_session(self, session):
+        await self.publish('conversation', session.id)
+
+    async def load_active_requisitions(self):
+        # Warm the working set with the most recent open requisitions only; anything
+        # older is looked up on demand the first time it is reacted to.
+        rows = await self.storage.load_open_requisitions(OPEN_STATUSES, self.active_requisitions.max_size, self.shards)
+        for row in reversed(rows):
+            self.active_requisitions.put(row['message_id'], Requisition.from_row(row))
+        self.active_requisitions.complete = len(rows) < self.active_requisitions.max_size
+        logger.info("Loaded active requisitions for %d messages.", len(self.active_requisitions))
+
+    async def get_requisition(self, message_id):
+        requisition = self.active_requisitions.get(message_id)
+        if requisition is not None or self.active_requisitions.is_known_miss(message_id):
+            return requisition
+        row = await self.storage.get_requisition(message_id, OPEN_STATUSES)
+        if row is None:
+            self.active_requisitions.mark_miss(message_id)
+            return None
+        requisition = self.journal.overlay(message_id, Requisition.from_row(row))
+        self.active_requisitions.put(message_id, requisition)
+        return requisition
+
+    async def transition(self, requisition, message_id, status, fulfilled_by=()):
+        # Moves the requisition to status in storage first. Returns False, dropping the
+        # stale copy, if it had already left the states status may follow - another
+        # process or the expiry sweep got there first - and the caller skips its side effects.
+        version = await self.storage.transition(message_id, status, TRANSITIONS[status], fulfilled_by)
+        if version is None:
+            logger.info("Requisition %s is no longer %s; not moving it to %s.", message_id, requisition.status, status,
+                        extra=log_ids(guild_id=requisition.guild_id, message_id=message_id, requisition_id=requisition.id))
+            self.active_requisitions.pop(message_id)
+            return False
+        requisition.status = status
+        requisition.version = version
+        return True
 
     def validate_request(self, data):
-        logger.debug(f"Validating request data: {data}")
-        is_valid = v.validate(data)
-        if not is_valid:
-            logger.warning(f"Validation failed: {v.errors}")
-        return is_valid
-
-    async def send_reminder(self, user, message, message_id):
-        logger.info(f"Scheduling reminder for user {user} with message: {message}")
-        task = asyncio.create_task(self.remind_later(user, message, 3600))
-        self.reminder_tasks[message_id] = task
-
-    async def remind_later(self, user, message, delay):
-        await asyncio.sleep(delay)
-        await user.send(message)
-        logger.info(f"Reminder sent to user {user}")
+        # Returns the errors, empty if data is valid
+        errors = validate_requisition(data)
+        if errors:
+            logger.warning("Validation failed: %s", errors)
+        return errors
+
+    def register_flows(self):
+        self.conversations.register(Flow('request', [
+            Step('material', "What material do you need?"),
+            Step('quantity', "How many do you need?", parse_quantity("Quantity must be a number.")),
+            Step('payment', "What is the payment method?"),
+            Step('deadline', "What is the deadline?"),
+            Step('region', "What is the region?")
+        ], self.finish_request_flow, on_timeout=self.conversation_timed_out))
+        self.conversations.register(Flow('update_request', [
+            Step('message_id', "Please enter the message ID of the requisition you want to update:"),
+            Step('quantity', "Enter the new quantity:", parse_quantity("Quantity must be a number. Try again.")),
+            Step('payment', "Enter the new payment method:"),
+            Step('deadline', "Enter the new deadline:")
+        ], self.finish_update_flow, on_timeout=self.conversation_timed_out))
+        self.conversations.register(Flow('completion_details', [
+            Step('details', lambda session: (
+                f"Please provide completion details for the requisition `{session.context['material']}` "
+                "(e.g., where the resources are left, meeting arrangements, etc.)."
+            ))
+        ], self.finish_completion_details, on_timeout=self.completion_details_timed_out, step_timeout=3600, ttl=3600))
+
+    async def send_prompt(self, session, text):
+        if session.channel_id is None:
+            await self.outbound.send_dm(session.user_id, text, coalesce=False)
+            return
+        await self.outbound.post(self.bot.get_partial_messageable(session.channel_id), text)
+
+    async def conversation_timed_out(self, session):
+        await self.send_prompt(session, f"<@{session.user_id}> timed out waiting for a reply. Run the command again to start over.")
+
+    @commands.Cog.listener()
+    async def on_message(self, message):
+        if message.author.bot:
+            return
+        await self.ready.wait()
+        if not await self.conversations.handle(message):
+            await self.feedback.handle(message)
+
+    async def send_reminder(self, user, message, message_id, guild_id):
+        logger.info("Scheduling reminder for user %s with message: %s", user, message,
+                    extra=log_ids(guild_id=guild_id, message_id=message_id, user_id=user.id))
+        await self.reminders.schedule(message_id, guild_id, user.id, message, datetime.now() + OPEN_REMINDER_DELAY, KIND_OPEN)
+
+    async def schedule_deadline_reminder(self, requisition, message_id):
+        due_at = requisition.deadline - DEADLINE_REMINDER_LEAD
+        if due_at <= datetime.now():
+            return
+        await self.reminders.schedule(
+            message_id,
+            requisition.guild_id,
+            requisition.requester,
+            f"Reminder: Your requisition for {requisition.material} is due on {requisition.deadline_text}.",
+            due_at,
+            KIND_DEADLINE
+        )
 
     @commands.command(name='mm_config')
     @commands.has_permissions(administrator=True)
     async def mm_config(self, ctx, requisitions_channel_id: int, archive_channel_id: int, *, server_name: str):
         guild_id = ctx.guild.id
-        with self.conn.cursor() as cur:
-            cur.execute("""
-                INSERT INTO channels (guild_id, requisitions_channel_id, archive_channel_id, server_name)
-                VALUES (%s, %s, %s, %s)
-                ON CONFLICT (guild_id) DO UPDATE
-                SET requisitions_channel_id = EXCLUDED.requisitions_channel_id,
-                    archive_channel_id = EXCLUDED.archive_channel_id,
-                    server_name = EXCLUDED.server_name;
-            """, (guild_id, requisitions_channel_id, archive_channel_id, server_name))
-            self.conn.commit()
-
-        self.channel_ids[guild_id] = {
-            'REQUISITIONS_CHANNEL_ID': requisitions_channel_id,
-            'ARCHIVE_CHANNEL_ID': archive_channel_id,
-            'SERVER_NAME': server_name
-        }
+        await self.storage.save_channel_config(guild_id, requisitions_channel_id, archive_channel_id, server_name)
+        await self.publish('config', guild_id)
+
+        self.store_channel_config({
+            'guild_id': guild_id,
+            'requisitions_channel_id': requisitions_channel_id,
+            'archive_channel_id': archive_channel_id,
+            'server_name': server_name
+        })
 
         await ctx.send(f"Requisition channel set to <#{requisitions_channel_id}>, archive channel set to <#{archive_channel_id}>, and server name set to `{server_name}` for {ctx.guild.name}")
 
@@ -147,42 +434,19 @@ class RequisitionFlow(commands.Cog):
                     return
             await ctx.send("Invalid format. Use: `!mm_request [material, quantity, payment, deadline, region]` or follow the interactive prompts.")
         else:
-            def check(author):
-                return lambda message: message.author == author and message.channel == ctx.channel
+            await self.conversations.begin('request', ctx.author.id, ctx.channel.id, ctx.guild.id, replace=True)
 
-            await ctx.send("What material do you need?")
-            material = await self.bot.wait_for('message', check=check(ctx.author))
-            
-            await ctx.send("How many do you need?")
-            quantity_msg = await self.bot.wait_for('message', check=check(ctx.author))
-            if not quantity_msg.content.isdigit():
-                await ctx.send("Quantity must be a number.")
-                return
-            
-            await ctx.send("What is the payment method?")
-            payment = await self.bot.wait_for('message', check=check(ctx.author))
-            
-            await ctx.send("What is the deadline?")
-            deadline = await self.bot.wait_for('message', check=check(ctx.author))
-            
-            await ctx.send("What is the region?")
-            region = await self.bot.wait_for('message', check=check(ctx.author))
-
-            data = {
-                'material': material.content,
-                'quantity': int(quantity_msg.content),
-                'payment': payment.content,
-                'deadline': deadline.content,
-                'region': region.content
-            }
-
-            if self.validate_request(data):
-                await self.create_requisition(ctx, data['material'], data['quantity'], data['payment'], data['deadline'], data['region'])
-            else:
-                await ctx.send(f"Validation failed: {v.errors}")
+    async def finish_request_flow(self, session, message):
+        ctx = await self.bot.get_context(message)
+        data = session.data
+        errors = self.validate_request(data)
+        if errors:
+            await ctx.send(f"Validation failed: {error_text(errors)}")
+            return
+        await self.create_requisition(ctx, data['material'], data['quantity'], data['payment'], data['deadline'], data['region'])
 
     async def create_requisition(self, ctx, material, quantity, payment, deadline, region):
-        parsed_deadline = parse(deadline)
+        parsed_deadline = await self.deadlines.parse(deadline, self.deadline_timezone)
         if not parsed_deadline:
             await ctx.send("Could not understand the deadline. Please enter a specific date.")
             return
@@ -197,192 +461,393 @@ class RequisitionFlow(commands.Cog):
             'region': region
         }
         
-        if self.validate_request(data):
+        errors = self.validate_request(data)
+        if not errors:
             guild_id = ctx.guild.id
-            with self.conn.cursor() as cur:
-                cur.execute("""
-                    INSERT INTO requisitions (requester, material, quantity, payment, deadline, accepted_by, completed_by, message_id, region)
-                    VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)
-                    RETURNING id;
-                """, (ctx.author.id, material, quantity, payment, formatted_deadline, [], [], None, region))
-                requisition_id = cur.fetchone()['id']
-                self.conn.commit()
+            requisition = Requisition(ctx.author.id, material, quantity, payment, parsed_deadline.replace(microsecond=0), region, guild_id)
+            requisition.id = await self.storage.insert_requisition(requisition.to_row())
 
             if guild_id in self.channel_ids and 'REQUISITIONS_CHANNEL_ID' in self.channel_ids[guild_id]:
-                channel_id = self.channel_ids[guild_id]['REQUISITIONS_CHANNEL_ID']
-                server_name = self.channel_ids[guild_id]['SERVER_NAME']
-                channel = self.bot.get_channel(channel_id)
+                config = self.channel_ids[guild_id]
+                channel = self.bot.get_channel(config['REQUISITIONS_CHANNEL_ID'])
                 if channel:
-                    message_content = (
-                        f"**{server_name} - {region}**\n"
-                        f"**Request from {ctx.author.mention}:**\n"
-                        f"**Material:** {material}\n"
-                        f"**Quantity:** {quantity}\n"
-                        f"**Payment:** {payment}\n"
-                        f"**Deadline:** {formatted_deadline}\n"
-                        "React with ✋ to accept this job. React with ✅ when completed.\n"
-                        "Requestor or admin can react with ❌ to cancel this job.\n"
-                    )
-                    message = await channel.send(message_content)
-                    with self.conn.cursor() as cur:
-                        cur.execute("""
-                            UPDATE requisitions
-                            SET message_id = %s
-                            WHERE id = %s;
-                        """, (message.id, requisition_id))
-                        self.conn.commit()
-                    self.active_requisitions[message.id] = {
-                        'requester': ctx.author.id,
-                        'material': material,
-                        'quantity': quantity,
-                        'payment': payment,
-                        'deadline': formatted_deadline,
-                        'region': region,
-                        'accepted_by': [],
-                        'completed_by': [],
-                        'completion_details': ""
-                    }
-                    await message.add_reaction('✋')
-                    await message.add_reaction('✅')
-                    await self.send_reminder(ctx.author, f"Reminder: Your requisition for {material} is still open.", message.id)
+                    message = await self.post_requisition(requisition, channel, config)
+                    await self.send_reminder(ctx.author, f"Reminder: Your requisition for {material} is still open.", message.id, guild_id)
                 else:
                     await ctx.send("Invalid requisitions channel ID.")
             else:
                 await ctx.send("Requisitions channel ID has not been set. Use the `!mm_config` command to set it.")
         else:
-            await ctx.send(f"Validation failed: {v.errors}")
+            await ctx.send(f"Validation failed: {error_text(errors)}")
+
+    async def post_requisition(self, requisition, channel, config):
+        message_content = self.renderer.post(requisition.guild_id, config, requisition)
+        message = await self.outbound.post(channel, message_content)
+        await self.storage.set_message_id(requisition.id, message.id)
+        requisition.message_id = message.id
+        self.active_requisitions.put(message.id, requisition)
+        self.edits.remember(message.id, message_content)
+        self.outbound.react(message, '✋')
+        self.outbound.react(message, '✅')
+        await self.schedule_deadline_reminder(requisition, message.id)
+        return message
+
+    async def publish_all_pending(self):
+        try:
+            for guild_id in await self.storage.pending_guilds(self.shards):
+                await self.publish_pending(guild_id)
+        except Exception as e:
+            logger.error("Posting imported requisitions failed: %s", e)
+
+    async def reconcile_legacy(self):
+        # Requisitions from before guild IDs were recorded are looked for in each server's
+        # requisitions channel. One that is found gets its guild ID, so it is sharded,
+        # counted and expired like any other. One whose post is gone everywhere was
+        # archived back then if it had been completed, and cancelled otherwise. Rows
+        # left when LEGACY_LOOKUPS runs out, or whose channels couldn't all be checked,
+        # are tried again on the next start.
+        await self.bot.wait_until_ready()
+        try:
+            rows = await self.storage.legacy_requisitions(OPEN_STATUSES)
+            if not rows:
+                return
+            channels = [(row['guild_id'], row['requisitions_channel_id']) for row in await self.storage.load_channels()]
+            adopted, gone, lookups_left = 0, {STATUS_ARCHIVED: [], STATUS_CANCELLED: []}, LEGACY_LOOKUPS
+            for row in rows:
+                if lookups_left <= 0:
+                    break
+                guild_id, checked, lookups = await self.find_legacy_post(row['message_id'], channels)
+                lookups_left -= lookups
+                if guild_id is not None:
+                    version = await self.storage.adopt_legacy_requisition(row['id'], guild_id)
+                    requisition = self.active_requisitions.get(row['message_id'])
+                    if version is not None and requisition is not None:
+                        requisition.guild_id = guild_id
+                        requisition.version = version
+                        if not self.owns_guild(guild_id):
+                            self.active_requisitions.pop(row['message_id'])
+                    adopted += 1
+                elif checked:
+                    gone[STATUS_ARCHIVED if row['status'] == STATUS_COMPLETED else STATUS_CANCELLED].append(row['id'])
+            closed = {}
+            for status, from_statuses in ((STATUS_ARCHIVED, (STATUS_COMPLETED,)), (STATUS_CANCELLED, (STATUS_OPEN, STATUS_ACCEPTED))):
+                if gone[status]:
+                    closed[status] = await self.storage.close_legacy_requisitions(gone[status], status, from_statuses)
+            message_ids = [message_id for ids in closed.values() for message_id in ids]
+            for message_id in message_ids:
+                self.active_requisitions.pop(message_id)
+            if message_ids:
+                await self.reminders.cancel_many(message_ids)
+            logger.info("Reconciled %d legacy requisitions: %d found, %d archived, %d cancelled, %d left for later.",
+                        len(rows), adopted, len(closed.get(STATUS_ARCHIVED, ())), len(closed.get(STATUS_CANCELLED, ())),
+                        len(rows) - adopted - len(message_ids))
+        except Exception as e:
+            logger.error("Reconciling legacy requisitions failed: %s", e)
+
+    async def find_legacy_post(self, message_id, channels):
+        # (guild ID whose requisitions channel holds the post or None, whether every
+        # channel could be checked, number of lookups made). The channel that matched
+        # last is tried first. Channels the bot can't see or read, and those created
+        # after the post (snowflakes grow with time), can't hold it and cost nothing.
+        checked, lookups = True, 0
+        for index, (guild_id, channel_id) in enumerate(channels):
+            if channel_id > message_id or self.bot.get_channel(channel_id) is None:
+                continue
+            lookups += 1
+            try:
+                await self.bot.get_partial_messageable(channel_id).fetch_message(message_id)
+            except (discord.NotFound, discord.Forbidden):
+                continue
+            except discord.HTTPException as e:
+                logger.warning("Could not look for legacy requisition %s in channel %s: %s", message_id, channel_id, e,
+                               extra=log_ids(guild_id=guild_id, message_id=message_id))
+                checked = False
+                continue
+            channels.insert(0, channels.pop(index))
+            return guild_id, True, lookups
+        return None, checked, lookups
+
+    async def publish_pending(self, guild_id):
+        # Posts the requisitions imported for a guild. Rows are claimed before posting,
+        # so a guild announced twice, or by several processes, is still posted once.
+        config = self.channel_ids.get(guild_id)
+        channel = self.bot.get_channel(config['REQUISITIONS_CHANNEL_ID']) if config else None
+        if channel is None:
+            logger.warning("Not posting imported requisitions for guild %s: no requisitions channel.", guild_id,
+                           extra=log_ids(guild_id=guild_id))
+            return
+        posted = 0
+        while True:
+            rows = await self.storage.claim_pending(guild_id, PENDING_BATCH)
+            for row in rows:
+                try:
+                    await self.post_requisition(Requisition.from_row(row), channel, config)
+                except Exception as e:
+                    logger.error("Could not post imported requisition %s: %s", row['id'], e,
+                                 extra=log_ids(guild_id=guild_id, requisition_id=row['id']))
+            posted += len(rows)
+            if len(rows) < PENDING_BATCH:
+                break
+        if posted:
+            logger.info("Posted %d imported requisitions in guild %s.", posted, guild_id, extra=log_ids(guild_id=guild_id))
+
+    async def resolve_user(self, user_id):
+        return await self.users.get(user_id)
+
+    async def requisition_for_payload(self, payload):
+        # Cheap filters first so reactions elsewhere never reach the requisition store
+        if payload.guild_id is None or str(payload.emoji) not in ('✋', '✅', '❌'):
+            return None
+        if payload.user_id == self.bot.user.id:
+            return None
+        if self.channel_ids.get(payload.guild_id, {}).get('REQUISITIONS_CHANNEL_ID') != payload.channel_id:
+            return None
+        return await self.get_requisition(payload.message_id)
+
+    @commands.Cog.listener()
+    async def on_raw_reaction_add(self, payload):
+        await self.ready.wait()
+        started = time.perf_counter()
+        try:
+            async with self.locks.hold(payload.message_id):
+                await self.handle_reaction_add(payload)
+        finally:
+            reaction_seconds.observe(time.perf_counter() - started, event='add')
 
     @commands.Cog.listener()
-    async def on_reaction_add(self, reaction, user):
-        if user.bot:
+    async def on_raw_reaction_remove(self, payload):
+        await self.ready.wait()
+        started = time.perf_counter()
+        try:
+            async with self.locks.hold(payload.message_id):
+                await self.handle_reaction_remove(payload)
+        finally:
+            reaction_seconds.observe(time.perf_counter() - started, event='remove')
+
+    async def handle_reaction_add(self, payload):
+        if payload.member is not None and payload.member.bot:
             return
 
-        message_id = reaction.message.id
-        guild_id = reaction.message.guild.id
+        requisition = await self.requisition_for_payload(payload)
+        if requisition is None:
+            return
 
-        if message_id not in self.active_requisitions:
+        message_id = payload.message_id
+        guild_id = payload.guild_id
+        emoji = str(payload.emoji)
+        if payload.member is not None:
+            # Reactors are likely to be DMed about this requisition, so keep them around
+            self.users.put(payload.member)
+        user = payload.member or await self.resolve_user(payload.user_id)
+        if user is None:
             return
+        if logger.isEnabledFor(logging.DEBUG) and sampled(CATEGORY_REACTION):
+            logger.debug("Reaction %s added to requisition %s by %s", emoji, message_id, user.id, extra=log_ids(
+                category=CATEGORY_REACTION, guild_id=guild_id, message_id=message_id, user_id=user.id
+            ))
 
-        requisition = self.active_requisitions[message_id]
-        requester = self.bot.get_user(requisition['requester'])
+        if emoji in ('✋', '✅'):
+            self.refresh_post(requisition, message_id, guild_id)
 
-        if reaction.emoji == '✋':
-            if user.id not in requisition['accepted_by']:
-                requisition['accepted_by'].append(user.id)
-                await user.send(f"You have accepted the requisition for {requisition['material']}.")
-                if requester:
-                    await requester.send(f"{user.mention} has accepted your requisition for {requisition['material']}.")
+        if emoji == '✅' and user.id == requisition.requester and requisition.status == STATUS_COMPLETED:
+            # The requester confirms once completion details are in (or timed out)
+            if requisition.completion_details:
+                await self.archive_requisition(requisition, message_id, guild_id)
 
-        elif reaction.emoji == '✅' and user.id in requisition['accepted_by']:
-            if user.id not in requisition['completed_by']:
-                requisition['completed_by'].append(user.id)
-                if len(requisition['completed_by']) == len(requisition['accepted_by']):
-                    if requester:
-                        await requester.send(f"All parties have completed the requisition for {requisition['material']}. Please confirm by reacting with ✅.")
-                    await self.get_completion_details(requisition, user, requester, message_id, guild_id)
+        elif emoji == '✋':
+            if user.id not in requisition.accepted_by:
+                requisition.accepted_by.append(user.id)
+                self.journal.record(message_id, 'accepted_by', user.id, True)
+                if requisition.status == STATUS_OPEN:
+                    await self.transition(requisition, message_id, STATUS_ACCEPTED)
+                self.outbound.send_dm(user.id, f"You have accepted the requisition for {requisition.material}.")
+                self.outbound.send_dm(requisition.requester, f"<@{user.id}> has accepted your requisition for {requisition.material}.")
 
-        elif reaction.emoji == '❌' and (user.id == requisition['requester'] or reaction.message.channel.permissions_for(user).administrator):
-            await self.cancel_requisition(requisition, message_id, guild_id)
+        elif emoji == '✅' and user.id in requisition.accepted_by:
+            if user.id not in requisition.completed_by:
+                requisition.completed_by.append(user.id)
+                self.journal.record(message_id, 'completed_by', user.id, True)
+                if len(requisition.completed_by) == len(requisition.accepted_by) and requisition.status == STATUS_ACCEPTED:
+                    if not await self.transition(requisition, message_id, STATUS_COMPLETED):
+                        return
+                    self.outbound.send_dm(requisition.requester, f"All parties have completed the requisition for {requisition.material}. Please confirm by reacting with ✅.")
+                    await self.get_completion_details(requisition, user, message_id, guild_id)
 
-    async def get_completion_details(self, requisition, user, requester, message_id, guild_id):
-        try:
-            await user.send(f"Please provide completion details for the requisition `{requisition['material']}` (e.g., where the resources are left, meeting arrangements, etc.).")
-            completion_details = await self.bot.wait_for(
-                'message',
-                check=lambda message: message.author == user and isinstance(message.channel, discord.DMChannel)
-            )
-            completion_details_text = completion_details.content
-        except asyncio.TimeoutError:
-            completion_details_text = "No details provided."
+        elif emoji == '❌':
+            channel = self.bot.get_channel(payload.channel_id)
+            is_admin = payload.member is not None and channel is not None and channel.permissions_for(payload.member).administrator
+            if user.id == requisition.requester or is_admin:
+                await self.cancel_requisition(requisition, message_id, guild_id)
 
-        requisition['completion_details'] = completion_details_text
+    async def handle_reaction_remove(self, payload):
+        requisition = await self.requisition_for_payload(payload)
+        if requisition is None:
+            return
 
-        with self.conn.cursor() as cur:
-            cur.execute("""
-                UPDATE requisitions
-                SET completion_details = %s
-                WHERE message_id = %s;
-            """, (completion_details_text, message_id))
-            self.conn.commit()
+        emoji = str(payload.emoji)
+        if logger.isEnabledFor(logging.DEBUG) and sampled(CATEGORY_REACTION):
+            logger.debug("Reaction %s removed from requisition %s by %s", emoji, payload.message_id, payload.user_id,
+                         extra=log_ids(category=CATEGORY_REACTION, guild_id=payload.guild_id,
+                                       message_id=payload.message_id, user_id=payload.user_id))
+        self.refresh_post(requisition, payload.message_id, payload.guild_id)
+        if emoji == '✋' and payload.user_id in requisition.accepted_by:
+            requisition.accepted_by.remove(payload.user_id)
+            self.journal.record(payload.message_id, 'accepted_by', payload.user_id, False)
+            if payload.user_id in requisition.completed_by:
+                requisition.completed_by.remove(payload.user_id)
+                self.journal.record(payload.message_id, 'completed_by', payload.user_id, False)
+            if not requisition.accepted_by and requisition.status == STATUS_ACCEPTED:
+                await self.transition(requisition, payload.message_id, STATUS_OPEN)
 
-        await requester.send(f"Completion details for your requisition `{requisition['material']}`: {completion_details_text}. Please confirm the completion by reacting with ✅.")
-        
-        try:
-            confirm = await self.bot.wait_for(
-                'reaction_add',
-                check=lambda reaction, user: user == requester and str(reaction.emoji) == '✅' and reaction.message.id == message_id
-            )
-            await self.archive_requisition(requisition, message_id, guild_id)
-        except asyncio.TimeoutError:
-            await requester.send("Confirmation timeout. Please manually confirm the completion.")
+        elif emoji == '✅' and payload.user_id in requisition.completed_by:
+            requisition.completed_by.remove(payload.user_id)
+            self.journal.record(payload.message_id, 'completed_by', payload.user_id, False)
+
+    def refresh_post(self, requisition, message_id, guild_id):
+        # Rendered when the edit window closes, so it picks up every change made until then
+        config = self.channel_ids[guild_id]
+        channel = self.bot.get_channel(config['REQUISITIONS_CHANNEL_ID'])
+        if channel:
+            self.edits.schedule(channel, message_id, lambda: self.renderer.post(guild_id, config, requisition))
+
+    async def get_completion_details(self, requisition, user, message_id, guild_id):
+        await self.conversations.begin('completion_details', user.id, None, guild_id, context={
+            'message_id': message_id,
+            'material': requisition.material
+        })
+
+    async def finish_completion_details(self, session, message):
+        await self.record_completion_details(session.context, session.data['details'])
+
+    async def completion_details_timed_out(self, session):
+        await self.record_completion_details(session.context, "No details provided.")
+
+    async def record_completion_details(self, context, completion_details_text):
+        message_id = context['message_id']
+        async with self.locks.hold(message_id):
+            requisition = await self.get_requisition(message_id)
+            version = await self.storage.set_completion_details(message_id, completion_details_text, STATUS_COMPLETED)
+            if version is None:
+                logger.info("Requisition %s is no longer completed; dropping its completion details.", message_id,
+                            extra=log_ids(message_id=message_id))
+                return
+            if requisition is not None:
+                requisition.completion_details = completion_details_text
+                requisition.version = version
+
+        # DM replies may land in a different process than the one owning the guild
+        await self.publish('requisition', message_id)
+        if requisition is not None and not self.owns_guild(requisition.guild_id):
+            self.active_requisitions.pop(message_id)
+
+        if requisition is not None:
+            self.outbound.send_dm(requisition.requester, f"Completion details for your requisition `{context['material']}`: {completion_details_text}. Please confirm the completion by reacting with ✅.")
 
     async def cancel_requisition(self, requisition, message_id, guild_id):
         requisitions_channel_id = self.channel_ids[guild_id]['REQUISITIONS_CHANNEL_ID']
         requisitions_channel = self.bot.get_channel(requisitions_channel_id)
+        if requisitions_channel is None:
+            logger.error("Requisitions channel %s not found; not cancelling.", requisitions_channel_id,
+                         extra=log_ids(guild_id=guild_id, message_id=message_id))
+            return
 
         try:
-            message = await requisitions_channel.fetch_message(message_id)
-            await message.delete()
-            del self.active_requisitions[message_id]
+            if not await self.transition(requisition, message_id, STATUS_CANCELLED):
+                return
+            self.edits.forget(message_id)
+            self.active_requisitions.pop(message_id)
+            await self.cancel_reminder(message_id)
 
-            requester = self.bot.get_user(requisition['requester'])
-            await requester.send(f"Your requisition for {requisition['material']} has been cancelled.")
+            self.outbound.send_dm(requisition.requester, f"Your requisition for {requisition.material} has been cancelled.")
+            # Last, so a failed delete is reported below without skipping the rest
+            await self.outbound.delete(requisitions_channel, message_id)
         except discord.NotFound:
-            logger.error("Message or channel not found")
+            logger.error("Message or channel not found", extra=log_ids(guild_id=guild_id, message_id=message_id))
         except discord.Forbidden:
-            logger.error("Bot lacks permissions to delete messages in the requisitions channel")
+            logger.error("Bot lacks permissions to delete messages in the requisitions channel",
+                         extra=log_ids(guild_id=guild_id, message_id=message_id))
         except Exception as e:
-            logger.error(f"An unexpected error occurred: {str(e)}")
+            logger.error("An unexpected error occurred: %s", e, extra=log_ids(guild_id=guild_id, message_id=message_id))
 
     async def archive_requisition(self, requisition, message_id, guild_id):
         archive_channel_id = self.channel_ids[guild_id]['ARCHIVE_CHANNEL_ID']
         archive_channel = self.bot.get_channel(archive_channel_id)
         requisitions_channel_id = self.channel_ids[guild_id]['REQUISITIONS_CHANNEL_ID']
         requisitions_channel = self.bot.get_channel(requisitions_channel_id)
+        if archive_channel is None or requisitions_channel is None:
+            logger.error("Archive or requisitions channel not found; not archiving.",
+                         extra=log_ids(guild_id=guild_id, message_id=message_id))
+            return
 
         try:
-            message = await requisitions_channel.fetch_message(message_id)
-            server_name = self.channel_ids[guild_id]['SERVER_NAME']
-            archived_message_content = (
-                f"**{server_name} - {requisition['region']}**\n"
-                f"**Archived Request from {self.bot.get_user(requisition['requester']).mention}:**\n"
-                f"**Material:** {requisition['material']}\n"
-                f"**Quantity:** {requisition['quantity']}\n"
-                f"**Payment:** {requisition['payment']}\n"
-                f"**Deadline:** {requisition['deadline']}\n"
-                f"**Completed by:** {', '.join([self.bot.get_user(uid).mention for uid in requisition['completed_by']])}\n"
-                f"**Completion Details:** {requisition['completion_details']}\n"
-            )
+            # Claimed before anything is posted, so a repeated confirmation archives once
+            if not await self.transition(requisition, message_id, STATUS_ARCHIVED, requisition.completed_by.tolist()):
+                return
+            archived_message_content = self.renderer.archive(guild_id, self.channel_ids[guild_id], requisition)
             if random.random() < 0.1:  # 10% chance to include the donation link
                 donate_message = "\n\nIf you find this bot helpful, please consider donating to support its development: https://ko-fi.com/jedespo"
                 archived_message_content += donate_message
 
-            archived_message = await archive_channel.send(archived_message_content)
-            await message.delete()
-            del self.active_requisitions[message_id]
-
-            requester = self.bot.get_user(requisition['requester'])
-            dm_channel = await requester.create_dm()
-            await dm_channel.send(
-                f"Your requisition has been completed and archived!\n"
-                f"\n"
-                f"**Please provide feedback** on your experience in a few sentences.\n"
-                f"I'll add it onto the archived post. Provide feedback here:"
-            )
-
-            def check(m):
-                return m.author == requester and isinstance(m.channel, discord.DMChannel)
+            archived_message = await self.outbound.post(archive_channel, archived_message_content)
+            self.edits.forget(message_id)
+            self.active_requisitions.pop(message_id)
+            await self.cancel_reminder(message_id)
 
-            feedback_message = await self.bot.wait_for('message', check=check)
-            if feedback_message:
-                await archived_message.edit(content=f"{archived_message.content}\n**Feedback:** {feedback_message.content}")
-                await dm_channel.send("Thank you for your feedback!")
+            await self.feedback.request(requisition, archive_channel_id, archived_message)
+            # Last, so a failed delete is reported below without skipping the rest
+            await self.outbound.delete(requisitions_channel, message_id)
         except discord.NotFound:
-            logger.error("Message or channel not found")
+            logger.error("Message or channel not found", extra=log_ids(guild_id=guild_id, message_id=message_id))
         except discord.Forbidden:
-            logger.error("Bot lacks permissions to fetch/delete messages or send messages in the archive channel")
+            logger.error("Bot lacks permissions to fetch/delete messages or send messages in the archive channel",
+                         extra=log_ids(guild_id=guild_id, message_id=message_id))
         except Exception as e:
-            logger.error(f"An unexpected error occurred: {str(e)}")
+            logger.error("An unexpected error occurred: %s", e, extra=log_ids(guild_id=guild_id, message_id=message_id))
+
+    async def expire_requisitions(self, rows):
+        # Rows the sweeper has already marked expired: archive their posts in bulk
+        by_guild = {}
+        for row in rows:
+            message_id = row['message_id']
+            if message_id is None:
+                continue
+            async with self.locks.hold(message_id):
+                requisition = self.active_requisitions.pop(message_id)
+                if requisition is None:
+                    requisition = self.journal.overlay(message_id, Requisition.from_row(row))
+                requisition.status = STATUS_EXPIRED
+                requisition.version = row['version']
+                self.edits.forget(message_id)
+            by_guild.setdefault(row['guild_id'], []).append(requisition)
+        if not by_guild:
+            return
+        await self.reminders.cancel_many([
+            requisition.message_id for requisitions in by_guild.values() for requisition in requisitions
+        ])
+
+        # (what, guild ID, message IDs, future) for every Discord call, checked once all are queued
+        calls = []
+        for guild_id, requisitions in by_guild.items():
+            config = self.channel_ids.get(guild_id)
+            if config is None:
+                continue
+            archive_channel = self.bot.get_channel(config['ARCHIVE_CHANNEL_ID'])
+            requisitions_channel = self.bot.get_channel(config['REQUISITIONS_CHANNEL_ID'])
+            for requisition in requisitions:
+                if archive_channel:
+                    future = self.outbound.post(archive_channel, self.renderer.archive(guild_id, config, requisition, EXPIRED_DETAILS))
+                    calls.append(('post the archive copy of', guild_id, [requisition.message_id], future))
+                self.outbound.send_dm(requisition.requester, f"Your requisition for {requisition.material} passed its deadline ({requisition.deadline_text}) and has been archived as expired.")
+            if requisitions_channel:
+                for message_ids, future in self.outbound.bulk_delete(requisitions_channel, [requisition.message_id for requisition in requisitions]):
+                    calls.append(('delete', guild_id, message_ids, future))
+            logger.info("Archived %d expired requisitions in guild %s.", len(requisitions), guild_id, extra=log_ids(guild_id=guild_id))
+
+        results = await asyncio.gather(*(future for *_, future in calls), return_exceptions=True)
+        for (action, guild_id, message_ids, _), result in zip(calls, results):
+            if isinstance(result, Exception):
+                logger.error("Could not %s expired requisition %s: %s", action, ', '.join(map(str, message_ids)), result,
+                             extra=log_ids(guild_id=guild_id, message_id=message_ids[0] if len(message_ids) == 1 else None))
 
     @commands.command(name='mm_update_request')
     async def mm_update_request(self, ctx, *, user_input: str = None):
@@ -399,22 +864,12 @@ class RequisitionFlow(commands.Cog):
             else:
                 await ctx.send("Invalid format. Use: `!mm_update_request <message_id>, <new_quantity>, <new_payment>, <new_deadline>`")
         else:
-            def check(author):
-                return lambda message: message.author == author and message.channel == ctx.channel
-
-            await ctx.send("Please enter the message ID of the requisition you want to update:")
-            message_id = await self.bot.wait_for('message', check=check(ctx.author))
-            await ctx.send("Enter the new quantity:")
-            quantity_msg = await self.bot.wait_for('message', check=check(ctx.author))
-            if not quantity_msg.content.isdigit():
-                await ctx.send("Quantity must be a number. Try again.")
-                return
-            await ctx.send("Enter the new payment method:")
-            payment = await self.bot.wait_for('message', check=check(ctx.author))
-            await ctx.send("Enter the new deadline:")
-            deadline = await self.bot.wait_for('message', check=check(ctx.author))
-            
-            await self.update_requisition(ctx, message_id.content, int(quantity_msg.content), payment.content, deadline.content)
+            await self.conversations.begin('update_request', ctx.author.id, ctx.channel.id, ctx.guild.id, replace=True)
+
+    async def finish_update_flow(self, session, message):
+        ctx = await self.bot.get_context(message)
+        data = session.data
+        await self.update_requisition(ctx, data['message_id'], data['quantity'], data['payment'], data['deadline'])
 
     async def update_requisition(self, ctx, message_id, new_quantity, new_payment, new_deadline):
         if not message_id.isdigit():
@@ -423,13 +878,12 @@ class RequisitionFlow(commands.Cog):
         
         message_id = int(message_id)
         
-        if message_id not in self.active_requisitions:
+        requisition = await self.get_requisition(message_id)
+        if requisition is None:
             await ctx.send("Requisition not found.")
             return
 
-        requisition = self.active_requisitions[message_id]
-
-        parsed_deadline = parse(new_deadline)
+        parsed_deadline = await self.deadlines.parse(new_deadline, self.deadline_timezone)
         if not parsed_deadline:
             await ctx.send("Could not understand the deadline. Please enter a specific date.")
             return
@@ -437,21 +891,37 @@ class RequisitionFlow(commands.Cog):
         formatted_deadline = parsed_deadline.strftime('%Y-%m-%d %H:%M:%S')
         
         data = {
-            'material': requisition['material'],
+            'material': requisition.material,
             'quantity': new_quantity,
             'payment': new_payment,
-            'deadline': formatted_deadline
+            'deadline': formatted_deadline,
+            'region': requisition.region
         }
         
-        if not self.validate_request(data):
-            await ctx.send(f"Validation failed: {v.errors}")
+        errors = self.validate_request(data)
+        if errors:
+            await ctx.send(f"Validation failed: {error_text(errors)}")
             return
         
-        requisition.update({
-            'quantity': new_quantity,
-            'payment': new_payment,
-            'deadline': formatted_deadline
-        })
+        deadline = parsed_deadline.replace(microsecond=0)
+        async with self.locks.hold(message_id):
+            # The copy may be stale if another process changed the requisition since it was loaded
+            requisition = await self.get_requisition(message_id)
+            version = None if requisition is None else await self.storage.update_requisition(
+                message_id, requisition.version, new_quantity, new_payment, deadline
+            )
+            if version is None:
+                self.active_requisitions.pop(message_id)
+                await ctx.send("The requisition changed while you were editing it, or is no longer open. Please try again.")
+                return
+            requisition.quantity = new_quantity
+            requisition.payment = new_payment
+            requisition.deadline = deadline
+            requisition.version = version
+            self.active_requisitions.put(message_id, requisition)
+        await self.publish('requisition', message_id)
+        await self.cancel_reminder(message_id, KIND_DEADLINE)
+        await self.schedule_deadline_reminder(requisition, message_id)
         
         guild_id = ctx.guild.id
         requisitions_channel_id = self.channel_ids[guild_id]['REQUISITIONS_CHANNEL_ID']
@@ -462,18 +932,10 @@ class RequisitionFlow(commands.Cog):
             return
         
         try:
-            message = await requisitions_channel.fetch_message(message_id)
-            
-            await message.edit(
-                content=(
-                    f"**Request from {self.bot.get_user(requisition['requester']).mention}:**\n"
-                    f"**Material:** {requisition['material']}\n"
-                    f"**Quantity:** {new_quantity}\n"
-                    f"**Payment:** {new_payment}\n"
-                    f"**Deadline:** {formatted_deadline}\n"
-                    "React with ✋ to accept this job. React with ✅ when completed.\n"
-                    "Requestor or admin can react with ❌ to cancel this job.\n"
-                )
+            await self.edits.edit_now(
+                requisitions_channel,
+                message_id,
+                self.renderer.post(guild_id, self.channel_ids[guild_id], requisition)
             )
             
             await ctx.send(f"Requisition {message_id} updated successfully.")
@@ -488,16 +950,118 @@ class RequisitionFlow(commands.Cog):
         
         except Exception as e:
             await ctx.send("An unexpected error occurred while updating the requisition message.")
-            logger.error(f"Unexpected error: {str(e)}")
+            logger.error("Unexpected error: %s", e, extra=log_ids(message_id=message_id))
     
-    def cancel_reminder(self, message_id):
-        task = self.reminder_tasks.get(message_id)
-        if task:
-            task.cancel()
-            logger.info(f"Cancelled reminder for message ID: {message_id}")
-            del self.reminder_tasks[message_id]
+    @commands.command(name='mm_export')
+    @commands.guild_only()
+    @commands.has_permissions(administrator=True)
+    async def mm_export(self, ctx, export_format: str = 'csv', table: str = 'requisitions'):
+        export_format, table = export_format.lower(), table.lower()
+        if export_format not in FORMATS or table not in TABLES:
+            await ctx.send(f"Use: `!mm_export [{'|'.join(FORMATS)}] [{'|'.join(TABLES)}]`")
+            return
+        # Streamed from the database into a compressed temporary file, never held in memory
+        handle, path = tempfile.mkstemp(suffix='.gz')
+        os.close(handle)
+        try:
+            with gzip.open(path, 'wt', encoding='utf-8', newline='') as out:
+                count = await getattr(self.storage, f"export_{table}")(out, export_format, ctx.guild.id)
+            if os.path.getsize(path) > ctx.guild.filesize_limit:
+                await ctx.send("The export is too large to upload here. Ask the bot operator to run `python admin.py export`.")
+                return
+            await ctx.send(
+                f"Exported {count} {table}.",
+                file=discord.File(path, filename=f"{table}-{ctx.guild.id}.{export_format}.gz")
+            )
+        finally:
+            os.remove(path)
+
+    @mm_export.error
+    async def mm_export_error(self, ctx, error):
+        if isinstance(error, commands.MissingPermissions):
+            await ctx.send("You do not have the necessary permissions to use this command.")
+        else:
+            await ctx.send("An error occurred while exporting.")
+
+    @commands.command(name='mm_stats')
+    @commands.guild_only()
+    async def mm_stats(self, ctx, days: int = DEFAULT_DAYS):
+        days = max(1, min(days, MAX_DAYS))
+        since = datetime.now().date() - timedelta(days=days - 1)
+        demand, timings, fulfillers = await self.storage.guild_stats(ctx.guild.id, since, TOP_DEMAND, TOP_FULFILLERS)
+        await ctx.send(embed=stats_embed(ctx.guild.name, days, demand, timings, fulfillers))
+
+    @commands.command(name='mm_reputation')
+    @commands.guild_only()
+    async def mm_reputation(self, ctx, user: discord.User = None):
+        user = user or ctx.author
+        row = await self.storage.reputation(ctx.guild.id, user.id)
+        await ctx.send(reputation_text(user.id, row), allowed_mentions=discord.AllowedMentions.none())
+
+    @commands.command(name='mm_list')
+    @commands.guild_only()
+    async def mm_list(self, ctx, *, region: str = None):
+        query = SearchQuery(region=region)
+        await self.send_results(ctx, "Open requisitions", query)
+
+    @commands.command(name='mm_search')
+    @commands.guild_only()
+    async def mm_search(self, ctx, *, user_input: str = None):
+        terms = parse_search(user_input)
+        if not terms:
+            await ctx.send("Use: `!mm_search [material] region=<region> payment=<keyword> after=<date> before=<date>`")
+            return
+        bounds = {}
+        for key in ('after', 'before'):
+            if key in terms:
+                bounds[key] = await self.deadlines.parse(terms[key], self.deadline_timezone)
+                if bounds[key] is None:
+                    await ctx.send(f"Could not understand the `{key}` date.")
+                    return
+        query = SearchQuery(terms.get('material'), terms.get('payment'), terms.get('region'), **bounds)
+        await self.send_results(ctx, "Matching requisitions", query)
+
+    async def send_results(self, ctx, title, query):
+        guild_id = ctx.guild.id
+        config = self.channel_ids.get(guild_id)
+        if config is None:
+            await ctx.send("Requisitions channel ID has not been set. Use the `!mm_config` command to set it.")
+            return
+        requisitions, total = await self.search_requisitions(guild_id, query, 0)
+        if not total:
+            await ctx.send(f"No open requisitions found ({query.describe()}).")
+            return
+        view = ResultPages(
+            ctx.author.id, title, f"Filters: {query.describe()}", config['REQUISITIONS_CHANNEL_ID'],
+            lambda page: self.search_requisitions(guild_id, query, page), total
+        )
+        if view.pages == 1:
+            await ctx.send(embed=view.embed(requisitions))
+        else:
+            view.message = await ctx.send(embed=view.embed(requisitions), view=view)
+
+    async def search_requisitions(self, guild_id, query, page):
+        # Answered from the in-memory index while the working set holds every open
+        # requisition, otherwise by an indexed storage query
+        offset = page * PAGE_SIZE
+        started = time.perf_counter()
+        if self.active_requisitions.complete:
+            results = self.search_index.search(guild_id, query, offset, PAGE_SIZE)
+            search_seconds.observe(time.perf_counter() - started, source='memory')
+            return results
+        results = await self.search_database(guild_id, query, offset)
+        search_seconds.observe(time.perf_counter() - started, source='database')
+        return results
+
+    async def search_database(self, guild_id, query, offset):
+        rows, total = await self.storage.search_requisitions(guild_id, LISTED_STATUSES, query, PAGE_SIZE, offset)
+        return [self.journal.overlay(row['message_id'], Requisition.from_row(row)) for row in rows], total
+
+    async def cancel_reminder(self, message_id, kind=None):
+        if await self.reminders.cancel(message_id, kind):
+            logger.info("Cancelled reminder for message ID: %s", message_id, extra=log_ids(message_id=message_id))
         else:
-            logger.warning(f"No active reminder task found for message ID: {message_id}")
+            logger.warning("No pending reminder found for message ID: %s", message_id, extra=log_ids(message_id=message_id))
 
 async def setup(bot):
     await bot.add_cog(RequisitionFlow(bot))
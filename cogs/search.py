@@ -0,0 +1,237 @@
+import heapq
+import re
+from operator import attrgetter
+
+import discord
+
+from cogs.requisition_cache import STATUS_OPEN, STATUS_ACCEPTED
+
+# Requisitions that are still looking for (more) people
+LISTED_STATUSES = (STATUS_OPEN, STATUS_ACCEPTED)
+
+PAGE_SIZE = 5
+
+SEARCH_KEYS = ('material', 'region', 'payment', 'after', 'before')
+KEY_RE = re.compile(r'\b(' + '|'.join(SEARCH_KEYS) + r')\s*[=:]', re.IGNORECASE)
+WORD_RE = re.compile(r'\w+')
+SORT_KEY = attrgetter('deadline', 'message_id')
+
+
+def words(text):
+    return WORD_RE.findall(text.lower()) if text else []
+
+
+def like_pattern(term):
+    # ILIKE pattern matching term anywhere; terms are single words, so only _ needs escaping
+    return '%' + term.replace('_', '\\_') + '%'
+
+
+def parse_search(text):
+    # "iron ore region=EU before=2024-07-01" -> {'material': 'iron ore', 'region': 'EU', ...}
+    # Text before the first key is taken as the material.
+    terms = {}
+    matches = list(KEY_RE.finditer(text or ''))
+    head = (text or '')[:matches[0].start()] if matches else (text or '')
+    if head.strip():
+        terms['material'] = head.strip()
+    for index, match in enumerate(matches):
+        end = matches[index + 1].start() if index + 1 < len(matches) else len(text)
+        value = text[match.end():end].strip()
+        if value:
+            terms[match.group(1).lower()] = value
+    return terms
+
+
+# A parsed !mm_search query. Material and payment terms match any word containing
+# them, the region matches exactly (ignoring case), and after/before bound the deadline.
+class SearchQuery:
+    __slots__ = ('material', 'payment', 'region', 'after', 'before')
+
+    def __init__(self, material=None, payment=None, region=None, after=None, before=None):
+        self.material = tuple(words(material))
+        self.payment = tuple(words(payment))
+        self.region = region.lower() if region else None
+        self.after = after
+        self.before = before
+
+    def describe(self):
+        parts = []
+        if self.material:
+            parts.append(f"material: {' '.join(self.material)}")
+        if self.region:
+            parts.append(f"region: {self.region}")
+        if self.payment:
+            parts.append(f"payment: {' '.join(self.payment)}")
+        if self.after:
+            parts.append(f"after {self.after:%Y-%m-%d %H:%M}")
+        if self.before:
+            parts.append(f"before {self.before:%Y-%m-%d %H:%M}")
+        return ', '.join(parts) or 'all'
+
+
+class GuildIndex:
+    __slots__ = ('entries', 'material', 'payment', 'region')
+
+    def __init__(self):
+        self.entries = {}
+        self.material = {}
+        self.payment = {}
+        self.region = {}
+
+
+# Per-guild inverted index over the requisitions in the working set, kept in step by
+# RequisitionCache. Material and payment words and the region map to sets of message
+# IDs, so a query intersects a few small sets instead of scanning every requisition.
+class SearchIndex:
+    def __init__(self):
+        self.guilds = {}
+
+    def _postings(self, requisition):
+        return (
+            ('material', words(requisition.material)),
+            ('payment', words(requisition.payment)),
+            ('region', [requisition.region.lower()])
+        )
+
+    def add(self, message_id, requisition):
+        if requisition.guild_id is None:
+            return
+        guild = self.guilds.get(requisition.guild_id)
+        if guild is None:
+            guild = self.guilds[requisition.guild_id] = GuildIndex()
+        elif message_id in guild.entries:
+            self._unlink(guild, message_id, guild.entries[message_id][1])
+        postings = self._postings(requisition)
+        guild.entries[message_id] = (requisition, postings)
+        for field, tokens in postings:
+            table = getattr(guild, field)
+            for token in tokens:
+                table.setdefault(token, set()).add(message_id)
+
+    def remove(self, message_id, requisition):
+        guild = self.guilds.get(requisition.guild_id)
+        if guild is None or message_id not in guild.entries:
+            return
+        self._unlink(guild, message_id, guild.entries.pop(message_id)[1])
+        if not guild.entries:
+            del self.guilds[requisition.guild_id]
+
+    def _unlink(self, guild, message_id, postings):
+        for field, tokens in postings:
+            table = getattr(guild, field)
+            for token in tokens:
+                ids = table.get(token)
+                if ids is not None:
+                    ids.discard(message_id)
+                    if not ids:
+                        del table[token]
+
+    def _matching(self, table, terms, candidates):
+        for term in terms:
+            ids = set()
+            for token, token_ids in table.items():
+                if term in token:
+                    ids |= token_ids
+            candidates = ids if candidates is None else candidates & ids
+            if not candidates:
+                break
+        return candidates
+
+    def search(self, guild_id, query, offset=0, limit=PAGE_SIZE, statuses=LISTED_STATUSES):
+        # One page of matches ordered by deadline, and the total number of matches
+        guild = self.guilds.get(guild_id)
+        if guild is None:
+            return [], 0
+        candidates = None
+        if query.region:
+            candidates = set(guild.region.get(query.region, ()))
+        candidates = self._matching(guild.material, query.material, candidates)
+        candidates = self._matching(guild.payment, query.payment, candidates)
+        if candidates is None:
+            candidates = guild.entries.keys()
+
+        results = []
+        for message_id in candidates:
+            requisition = guild.entries[message_id][0]
+            if requisition.status not in statuses:
+                continue
+            if query.after and requisition.deadline < query.after:
+                continue
+            if query.before and requisition.deadline > query.before:
+                continue
+            results.append(requisition)
+        page = heapq.nsmallest(offset + limit, results, key=SORT_KEY)[offset:]
+        return page, len(results)
+
+
+def jump_url(guild_id, channel_id, message_id):
+    return f"https://discord.com/channels/{guild_id}/{channel_id}/{message_id}"
+
+
+def results_embed(title, description, requisitions, channel_id, page, pages, total):
+    embed = discord.Embed(title=title, description=description, color=discord.Color.blurple())
+    for requisition in requisitions:
+        link = jump_url(requisition.guild_id, channel_id, requisition.message_id)
+        embed.add_field(
+            name=f"{requisition.material} x{requisition.quantity}",
+            value=(
+                f"**Region:** {requisition.region} | **Payment:** {requisition.payment}\n"
+                f"**Deadline:** {requisition.deadline_text} | **Accepted:** {len(requisition.accepted_by)}\n"
+                f"Requested by <@{requisition.requester}> - [view post]({link})"
+            ),
+            inline=False
+        )
+    embed.set_footer(text=f"Page {page + 1}/{pages} - {total} requisitions")
+    return embed
+
+
+# Previous/next buttons for a result list. fetch(page) returns (requisitions, total) for
+# a zero-based page and may hit the database, so only the author can turn pages.
+class ResultPages(discord.ui.View):
+    def __init__(self, author_id, title, description, channel_id, fetch, total, timeout=180):
+        super().__init__(timeout=timeout)
+        self.author_id = author_id
+        self.title = title
+        self.description = description
+        self.channel_id = channel_id
+        self.fetch = fetch
+        self.total = total
+        self.page = 0
+        self.message = None
+        self.update_buttons()
+
+    @property
+    def pages(self):
+        return max(1, -(-self.total // PAGE_SIZE))
+
+    def update_buttons(self):
+        self.previous_page.disabled = self.page == 0
+        self.next_page.disabled = self.page >= self.pages - 1
+
+    def embed(self, requisitions):
+        return results_embed(self.title, self.description, requisitions, self.channel_id,
+                             self.page, self.pages, self.total)
+
+    async def interaction_check(self, interaction):
+        return interaction.user.id == self.author_id
+
+    async def turn(self, interaction, step):
+        self.page = min(max(self.page + step, 0), self.pages - 1)
+        requisitions, self.total = await self.fetch(self.page)
+        self.update_buttons()
+        await interaction.response.edit_message(embed=self.embed(requisitions), view=self)
+
+    @discord.ui.button(label='Previous', style=discord.ButtonStyle.secondary)
+    async def previous_page(self, interaction, button):
+        await self.turn(interaction, -1)
+
+    @discord.ui.button(label='Next', style=discord.ButtonStyle.secondary)
+    async def next_page(self, interaction, button):
+        await self.turn(interaction, 1)
+
+    async def on_timeout(self):
+        if self.message is not None:
+            try:
+                await self.message.edit(view=None)
+            except discord.HTTPException:
+                pass
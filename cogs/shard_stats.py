@@ -0,0 +1,66 @@
+import logging
+import time
+
+from discord.ext import commands, tasks
+
+from cogs import metrics
+
+logger = logging.getLogger('matmaster.shards')
+
+shard_latency = metrics.gauge('matmaster_shard_latency_seconds', 'Gateway heartbeat latency per shard.')
+shard_event_rate = metrics.gauge('matmaster_shard_events_per_second', 'Gateway dispatch events per second per shard.')
+gateway_events = metrics.counter('matmaster_gateway_events_total', 'Gateway events received by this process, by type.')
+
+
+# Periodic per-shard latency and event-rate report for this process's shard range.
+# Per-shard rates come from each shard's gateway sequence number, which Discord
+# increments once per dispatched event.
+class ShardStats(commands.Cog):
+    def __init__(self, bot, interval=60):
+        self.bot = bot
+        self.sequences = {}
+        self.last_report = time.monotonic()
+        self.report.change_interval(seconds=interval)
+
+    async def cog_load(self):
+        self.report.start()
+
+    async def cog_unload(self):
+        self.report.cancel()
+
+    @commands.Cog.listener()
+    async def on_socket_event_type(self, event_type):
+        gateway_events.inc(event=event_type)
+
+    def shard_sequences(self):
+        sequences = {}
+        for shard_id, info in getattr(self.bot, 'shards', {}).items():
+            ws = getattr(getattr(info, '_parent', None), 'ws', None)
+            if ws is not None and ws.sequence is not None:
+                sequences[shard_id] = ws.sequence
+        return sequences
+
+    @tasks.loop(seconds=60)
+    async def report(self):
+        now = time.monotonic()
+        elapsed = max(now - self.last_report, 1e-6)
+        self.last_report = now
+
+        sequences = self.shard_sequences()
+        lines = []
+        for shard_id, latency in self.bot.latencies:
+            current = sequences.get(shard_id)
+            previous = self.sequences.get(shard_id)
+            rate = 0.0
+            if current is not None and previous is not None:
+                # A new gateway session restarts the sequence from zero
+                rate = (current - previous if current >= previous else current) / elapsed
+            shard_latency.set(latency, shard=shard_id)
+            shard_event_rate.set(rate, shard=shard_id)
+            lines.append(f"shard {shard_id}: {latency * 1000:.0f}ms, {rate:.1f} events/s")
+        self.sequences = sequences
+        logger.info("Shard report - %s", '; '.join(lines))
+
+    @report.before_loop
+    async def before_report(self):
+        await self.bot.wait_until_ready()
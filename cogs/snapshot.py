@@ -0,0 +1,75 @@
+import gzip
+import json
+import logging
+import os
+import time
+from datetime import datetime
+
+logger = logging.getLogger('matmaster.snapshot')
+
+# 3: SQLite's clock, which the snapshot records, moved from UTC to local time
+SNAPSHOT_VERSION = 3
+
+# Column order of a requisition entry in the snapshot
+REQUISITION_FIELDS = (
+    'id', 'message_id', 'guild_id', 'requester', 'material', 'quantity', 'payment', 'deadline',
+    'region', 'accepted_by', 'completed_by', 'completion_details', 'status', 'version'
+)
+
+
+# Compact on-disk copy of a process's working set - channel config, open requisitions
+# and pending reminders - written on graceful shutdown so the next boot can start from
+# it and fetch only what changed since. Stored as gzipped JSON with entries as plain
+# lists, and replaced atomically so a crash mid-write leaves the previous file intact.
+def write_snapshot(path, state):
+    started = time.perf_counter()
+    state = dict(state, version=SNAPSHOT_VERSION, saved_at=time.time())
+    temporary = f"{path}.tmp"
+    with gzip.open(temporary, 'wt', encoding='utf-8', compresslevel=6) as f:
+        json.dump(state, f, separators=(',', ':'), default=encode)
+    os.replace(temporary, path)
+    logger.info("Wrote snapshot %s (%d bytes) in %.3fs.", path, os.path.getsize(path), time.perf_counter() - started)
+
+
+def read_snapshot(path, shards, max_age):
+    # Returns the snapshot, or None if there isn't a usable one for these shards
+    try:
+        with gzip.open(path, 'rt', encoding='utf-8') as f:
+            state = json.load(f)
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError) as e:
+        logger.warning("Ignoring unreadable snapshot %s: %s", path, e)
+        return None
+    if state.get('version') != SNAPSHOT_VERSION:
+        logger.info("Ignoring snapshot %s from another version.", path)
+        return None
+    if state.get('shards') != shards:
+        logger.info("Ignoring snapshot %s taken for other shards.", path)
+        return None
+    if time.time() - state['saved_at'] > max_age:
+        logger.info("Ignoring snapshot %s older than %ss.", path, max_age)
+        return None
+    return state
+
+
+def encode(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    raise TypeError(f"Can't store {type(value).__name__} in a snapshot")
+
+
+def requisition_entry(requisition):
+    return [
+        requisition.id, requisition.message_id, requisition.guild_id, requisition.requester, requisition.material,
+        requisition.quantity, requisition.payment, requisition.deadline, requisition.region,
+        requisition.accepted_by.tolist(), requisition.completed_by.tolist(), requisition.completion_details,
+        requisition.status, requisition.version
+    ]
+
+
+def requisition_row(entry):
+    # Shaped like a requisitions row, for Requisition.from_row()
+    row = dict(zip(REQUISITION_FIELDS, entry))
+    row['deadline'] = datetime.fromisoformat(row['deadline'])
+    return row
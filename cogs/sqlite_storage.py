@@ -0,0 +1,955 @@
+import asyncio
+import json
+import logging
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+from cogs.database import query_seconds, query_errors, statement_label
+from cogs.requisition import INSERT_COLUMNS
+from cogs.requisition_cache import STATUS_OPEN, STATUS_ACCEPTED, STATUS_COMPLETED, STATUS_EXPIRED, STATUS_PENDING
+from cogs.search import LISTED_STATUSES, like_pattern
+from cogs.stats import METRIC_ACCEPT, METRIC_COMPLETE, METRIC_FULFILLED, transition_stats
+from cogs.transfer import EXPORT_COLUMNS, FEEDBACK_COLUMNS, CHANNEL_COLUMNS, write_rows
+
+logger = logging.getLogger('matmaster.storage')
+
+# Timestamps are stored as ISO 8601 text, which sorts and compares like the datetimes
+sqlite3.register_adapter(datetime, lambda value: value.isoformat(' '))
+sqlite3.register_converter('TIMESTAMP', lambda value: datetime.fromisoformat(value.decode()))
+
+# Columns holding lists of user IDs, stored as JSON arrays
+ARRAY_COLUMNS = ('accepted_by', 'completed_by')
+
+INITIAL_SCHEMA = (
+    """
+    CREATE TABLE IF NOT EXISTS requisitions (
+        id INTEGER PRIMARY KEY,
+        requester INTEGER,
+        material TEXT,
+        quantity INTEGER,
+        payment TEXT,
+        deadline TIMESTAMP,
+        accepted_by TEXT NOT NULL DEFAULT '[]',
+        completed_by TEXT NOT NULL DEFAULT '[]',
+        message_id INTEGER,
+        region TEXT,
+        completion_details TEXT,
+        status TEXT NOT NULL DEFAULT 'open',
+        guild_id INTEGER
+    );
+    """,
+    "CREATE INDEX IF NOT EXISTS requisitions_message_id_idx ON requisitions (message_id);",
+    "CREATE INDEX IF NOT EXISTS requisitions_status_idx ON requisitions (status);",
+    "CREATE INDEX IF NOT EXISTS requisitions_deadline_idx ON requisitions (deadline);",
+    """
+    CREATE INDEX IF NOT EXISTS requisitions_open_deadline_idx
+    ON requisitions (deadline)
+    WHERE status IN ('open', 'accepted');
+    """,
+    """
+    CREATE INDEX IF NOT EXISTS requisitions_guild_region_deadline_idx
+    ON requisitions (guild_id, lower(region), deadline)
+    WHERE status IN ('open', 'accepted');
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS channels (
+        guild_id INTEGER PRIMARY KEY,
+        requisitions_channel_id INTEGER,
+        archive_channel_id INTEGER,
+        server_name TEXT
+    );
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS reminders (
+        id INTEGER PRIMARY KEY,
+        message_id INTEGER,
+        guild_id INTEGER,
+        user_id INTEGER,
+        kind TEXT,
+        content TEXT,
+        due_at TIMESTAMP
+    );
+    """,
+    "CREATE INDEX IF NOT EXISTS reminders_message_id_idx ON reminders (message_id);",
+    """
+    CREATE TABLE IF NOT EXISTS conversations (
+        id INTEGER PRIMARY KEY,
+        user_id INTEGER,
+        channel_id INTEGER,
+        guild_id INTEGER,
+        flow TEXT,
+        step INTEGER,
+        data TEXT,
+        context TEXT,
+        step_deadline TIMESTAMP,
+        expires_at TIMESTAMP
+    );
+    """
+)
+
+# Local time, like Postgres' LOCALTIMESTAMP and the bot's datetime.now(). Migrations
+# up to 6 stamped UTC_NOW.
+NOW = "strftime('%Y-%m-%d %H:%M:%f', 'now', 'localtime')"
+UTC_NOW = "strftime('%Y-%m-%d %H:%M:%f', 'now')"
+
+
+def touch_triggers(now):
+    return tuple(
+        f"""
+        CREATE TRIGGER {table}_touch_{event.lower()} AFTER {event} ON {table} FOR EACH ROW
+        WHEN {condition}
+        BEGIN
+            UPDATE {table} SET updated_at = {now} WHERE {key} = NEW.{key};
+        END;
+        """
+        for table, key in (('requisitions', 'id'), ('channels', 'guild_id'))
+        for event, condition in (('INSERT', 'NEW.updated_at IS NULL'), ('UPDATE', 'NEW.updated_at IS OLD.updated_at'))
+    )
+
+
+def created_trigger(now):
+    return f"""
+    CREATE TRIGGER requisitions_created AFTER INSERT ON requisitions FOR EACH ROW
+    WHEN NEW.created_at IS NULL
+    BEGIN
+        UPDATE requisitions SET created_at = {now} WHERE id = NEW.id;
+    END;
+    """
+
+
+# updated_at lets a warm start fetch only the rows changed since its snapshot. SQLite
+# can't add a column with a non-constant default, so triggers stamp inserts too. A
+# statement that sets updated_at itself (e.g. an import) keeps its value.
+CHANGE_TRACKING = (
+    "ALTER TABLE requisitions ADD COLUMN updated_at TIMESTAMP;",
+    "ALTER TABLE channels ADD COLUMN updated_at TIMESTAMP;",
+    f"UPDATE requisitions SET updated_at = {UTC_NOW};",
+    f"UPDATE channels SET updated_at = {UTC_NOW};",
+    "CREATE INDEX requisitions_updated_at_idx ON requisitions (updated_at);",
+    *touch_triggers(UTC_NOW)
+)
+
+# Bumped by every status change and edit, so a process holding a copy of a
+# requisition can update it only if nobody else changed it since
+REQUISITION_VERSIONS = (
+    "ALTER TABLE requisitions ADD COLUMN version INTEGER NOT NULL DEFAULT 0;",
+)
+
+# How requisitions are grouped in demand_stats
+DEMAND_KEY = "lower(trim(COALESCE(material, ''))), lower(trim(COALESCE(region, '')))"
+
+# Existing rows keep a NULL created_at and so never count towards timings. Days are
+# stored as ISO 8601 text.
+GUILD_STATS = (
+    "ALTER TABLE requisitions ADD COLUMN created_at TIMESTAMP;",
+    "ALTER TABLE requisitions ADD COLUMN accepted_at TIMESTAMP;",
+    "ALTER TABLE requisitions ADD COLUMN completed_at TIMESTAMP;",
+    created_trigger(UTC_NOW),
+    """
+    CREATE TABLE demand_stats (
+        guild_id INTEGER NOT NULL,
+        material TEXT NOT NULL,
+        region TEXT NOT NULL,
+        open_count INTEGER NOT NULL DEFAULT 0,
+        open_quantity INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (guild_id, material, region)
+    );
+    """,
+    """
+    CREATE TABLE stats_events (
+        id INTEGER PRIMARY KEY,
+        guild_id INTEGER NOT NULL,
+        metric TEXT NOT NULL,
+        day TEXT NOT NULL,
+        key INTEGER NOT NULL
+    );
+    """,
+    "CREATE INDEX stats_events_guild_idx ON stats_events (guild_id, metric, day);",
+    """
+    CREATE TABLE stats_daily (
+        guild_id INTEGER NOT NULL,
+        metric TEXT NOT NULL,
+        day TEXT NOT NULL,
+        key INTEGER NOT NULL,
+        count INTEGER NOT NULL,
+        PRIMARY KEY (guild_id, metric, day, key)
+    );
+    """,
+    f"""
+    INSERT INTO demand_stats (guild_id, material, region, open_count, open_quantity)
+    SELECT guild_id, {DEMAND_KEY}, COUNT(*), COALESCE(SUM(quantity), 0)
+    FROM requisitions
+    WHERE status IN ('open', 'accepted') AND guild_id IS NOT NULL
+    GROUP BY 1, 2, 3;
+    """
+)
+
+# Feedback requests and answers, and each user's ratings per guild as fulfiller.
+# Feedback requests still waiting in the old conversation flow carry over.
+FEEDBACK = (
+    """
+    CREATE TABLE feedback (
+        id INTEGER PRIMARY KEY,
+        requisition_id INTEGER,
+        guild_id INTEGER,
+        requester INTEGER NOT NULL,
+        material TEXT,
+        fulfilled_by TEXT NOT NULL DEFAULT '[]',
+        archive_channel_id INTEGER,
+        archived_message_id INTEGER,
+        archived_content TEXT,
+        rating INTEGER,
+        comments TEXT,
+        requested_at TIMESTAMP NOT NULL,
+        received_at TIMESTAMP
+    );
+    """,
+    "CREATE INDEX feedback_pending_idx ON feedback (requester, id) WHERE received_at IS NULL;",
+    """
+    CREATE TABLE reputation (
+        guild_id INTEGER NOT NULL,
+        user_id INTEGER NOT NULL,
+        ratings INTEGER NOT NULL DEFAULT 0,
+        rating_total INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (guild_id, user_id)
+    );
+    """,
+    f"""
+    INSERT INTO feedback (guild_id, requester, archive_channel_id, archived_message_id, archived_content, requested_at)
+    SELECT guild_id, user_id, json_extract(context, '$.archive_channel_id'),
+           json_extract(context, '$.archived_message_id'), json_extract(context, '$.archived_content'), {UTC_NOW}
+    FROM conversations
+    WHERE flow = 'feedback'
+    ORDER BY id;
+    """,
+    "DELETE FROM conversations WHERE flow = 'feedback';"
+)
+
+# Requisitions from before statuses were tracked all came out of the initial schema
+# as 'open'. Those with completion details had been completed, and may have been
+# archived since; all are checked against Discord by the bot once it is up.
+LEGACY_STATUSES = (
+    """
+    UPDATE requisitions SET status = 'completed', version = version + 1
+    WHERE guild_id IS NULL AND status = 'open' AND completion_details IS NOT NULL;
+    """,
+)
+
+# Recreates the triggers with NOW, and moves the stamps SQLite wrote in UTC to local
+# time at today's offset. Feedback requests carried over by migration 5 keep theirs.
+LOCAL_TIMESTAMPS = (
+    *(f"DROP TRIGGER {table}_touch_{event};" for table in ('requisitions', 'channels') for event in ('insert', 'update')),
+    "DROP TRIGGER requisitions_created;",
+    *touch_triggers(NOW),
+    created_trigger(NOW),
+    """
+    UPDATE requisitions
+    SET created_at = strftime('%Y-%m-%d %H:%M:%f', created_at, 'localtime'),
+        accepted_at = strftime('%Y-%m-%d %H:%M:%f', accepted_at, 'localtime'),
+        completed_at = strftime('%Y-%m-%d %H:%M:%f', completed_at, 'localtime'),
+        updated_at = strftime('%Y-%m-%d %H:%M:%f', updated_at, 'localtime');
+    """,
+    "UPDATE channels SET updated_at = strftime('%Y-%m-%d %H:%M:%f', updated_at, 'localtime');",
+    "UPDATE feedback SET received_at = strftime('%Y-%m-%d %H:%M:%f', received_at, 'localtime');",
+    "UPDATE schema_migrations SET applied_at = strftime('%Y-%m-%d %H:%M:%f', applied_at, 'localtime');"
+)
+
+# Applied in order, each once, recorded in schema_migrations. Never edit a released
+# migration; append a new one.
+MIGRATIONS = (
+    (1, 'initial schema', INITIAL_SCHEMA),
+    (2, 'change tracking', CHANGE_TRACKING),
+    (3, 'requisition versions', REQUISITION_VERSIONS),
+    (4, 'guild stats', GUILD_STATS),
+    (5, 'feedback', FEEDBACK),
+    (6, 'legacy statuses', LEGACY_STATUSES),
+    (7, 'local timestamps', LOCAL_TIMESTAMPS),
+)
+
+# Must match the predicate of requisitions_open_deadline_idx so the sweep can use it
+EXPIRED_IDS_SQL = """
+    SELECT id FROM requisitions
+    WHERE status IN ('open', 'accepted') AND deadline < ? AND {predicate}
+    ORDER BY deadline
+    LIMIT ?;
+"""
+
+# Adds ? times the count and quantity of the requisitions with the given IDs to their
+# demand_stats rows
+DEMAND_SQL = f"""
+    INSERT INTO demand_stats (guild_id, material, region, open_count, open_quantity)
+    SELECT guild_id, {DEMAND_KEY}, ? * COUNT(*), ? * COALESCE(SUM(quantity), 0)
+    FROM requisitions
+    WHERE id IN (SELECT value FROM json_each(?)) AND guild_id IS NOT NULL
+    GROUP BY 1, 2, 3
+    ON CONFLICT (guild_id, material, region) DO UPDATE
+    SET open_count = open_count + excluded.open_count,
+        open_quantity = open_quantity + excluded.open_quantity;
+"""
+
+FOLD_STATS_SQL = """
+    INSERT INTO stats_daily (guild_id, metric, day, key, count)
+    SELECT guild_id, metric, day, key, COUNT(*) FROM stats_events
+    WHERE id IN (SELECT value FROM json_each(?))
+    GROUP BY 1, 2, 3, 4
+    ON CONFLICT (guild_id, metric, day, key) DO UPDATE
+    SET count = count + excluded.count;
+"""
+
+STATS_COUNTS_SQL = """
+    SELECT key, SUM(count) AS count FROM (
+        SELECT key, count FROM stats_daily WHERE guild_id = ? AND metric = ? AND day >= ?
+        UNION ALL
+        SELECT key, 1 FROM stats_events WHERE guild_id = ? AND metric = ? AND day >= ?
+    )
+    GROUP BY key
+"""
+
+INSERT_REQUISITION_SQL = f"""
+    INSERT INTO requisitions ({', '.join(INSERT_COLUMNS)})
+    VALUES ({', '.join(['?'] * len(INSERT_COLUMNS))});
+"""
+
+
+def dict_row(cursor, row):
+    return {column[0]: value for column, value in zip(cursor.description, row)}
+
+
+def ids_param(values):
+    # Lists are bound as one JSON parameter and expanded with json_each, so every
+    # statement has a fixed text and is compiled once per connection
+    return json.dumps(list(values))
+
+
+def requisition_row(row):
+    if row is not None:
+        for column in ARRAY_COLUMNS:
+            row[column] = json.loads(row[column]) if row[column] else []
+    return row
+
+
+def feedback_row(row):
+    row['fulfilled_by'] = json.loads(row['fulfilled_by'])
+    return row
+
+
+def requisition_values(row):
+    return tuple(json.dumps(row[column]) if column in ARRAY_COLUMNS else row[column] for column in INSERT_COLUMNS)
+
+
+def current_version(conn, message_id):
+    # UPDATE ... RETURNING needs SQLite 3.35, so it is read back in the same transaction
+    return conn.execute("SELECT version FROM requisitions WHERE message_id = ?;", (message_id,)).fetchone()['version']
+
+
+def record_stats(conn, row, events, leaves_demand):
+    if row['guild_id'] is None:
+        return
+    day = row['now'].date().isoformat()
+    conn.executemany("INSERT INTO stats_events (guild_id, metric, day, key) VALUES (?, ?, ?, ?);",
+                     [(row['guild_id'], metric, day, key) for metric, key in events])
+    if leaves_demand:
+        conn.execute(DEMAND_SQL, (-1, -1, ids_param([row['id']])))
+
+
+def patch(user_ids, added, removed):
+    # Same semantics as the Postgres journal flush
+    return [user_id for user_id in user_ids if user_id not in removed] + [user_id for user_id in added if user_id not in user_ids]
+
+
+def shard_filter(column, shards):
+    if shards is None:
+        return "1", ()
+    shard_count, shard_ids = shards
+    return (f"((({column} >> 22) % ?) IN (SELECT value FROM json_each(?)) OR ({column} IS NULL AND ?))",
+            (shard_count, ids_param(sorted(shard_ids)), int(0 in shard_ids)))
+
+
+# A single SQLite connection in WAL mode, owned by one worker thread. Every call runs
+# as one transaction on that thread, so writes are serialized without lock contention
+# and reads never block the event loop. Statements are prepared once and reused from
+# the connection's statement cache. synchronous=NORMAL makes a commit an append to the
+# WAL without an fsync; the database stays consistent but the last transactions before
+# a power loss may be rolled back. Long reads such as exports use a second, read-only
+# connection on its own thread, so they hold up neither the event loop nor writes.
+class SqliteDatabase:
+    def __init__(self, path, timeout=10.0, cached_statements=256):
+        self.path = path
+        self.timeout = timeout
+        self.cached_statements = cached_statements
+        self.conn = None
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='matmaster-sqlite')
+        # Opened on first use
+        self.read_conn = None
+        self.read_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='matmaster-sqlite-read')
+
+    async def open(self):
+        loop = asyncio.get_running_loop()
+        self.conn = await loop.run_in_executor(self.executor, self._connect)
+        logger.info("SQLite database %s opened.", self.path)
+
+    def _connect(self, query_only=False):
+        conn = sqlite3.connect(
+            self.path, timeout=self.timeout, detect_types=sqlite3.PARSE_DECLTYPES,
+            isolation_level=None, cached_statements=self.cached_statements
+        )
+        conn.row_factory = dict_row
+        if query_only:
+            conn.execute("PRAGMA query_only = ON;")
+        else:
+            conn.execute("PRAGMA journal_mode = WAL;")
+            conn.execute("PRAGMA synchronous = NORMAL;")
+        conn.execute("PRAGMA temp_store = MEMORY;")
+        return conn
+
+    async def close(self):
+        loop = asyncio.get_running_loop()
+        if self.read_conn is not None:
+            await loop.run_in_executor(self.read_executor, self.read_conn.close)
+            self.read_conn = None
+        if self.conn is not None:
+            await loop.run_in_executor(self.executor, self.conn.close)
+            self.conn = None
+        self.read_executor.shutdown(wait=True)
+        self.executor.shutdown(wait=True)
+        logger.info("SQLite database closed.")
+
+    def _run(self, fn):
+        # IMMEDIATE takes the write lock up front, so a transaction never fails
+        # half-way because another process (e.g. an admin script) started writing
+        self.conn.execute("BEGIN IMMEDIATE;")
+        try:
+            result = fn(self.conn)
+        except BaseException:
+            self.conn.execute("ROLLBACK;")
+            raise
+        self.conn.execute("COMMIT;")
+        return result
+
+    def _read(self, fn):
+        # A deferred transaction only reads: in WAL mode it sees one snapshot of the
+        # database and takes no lock that writers wait on
+        if self.read_conn is None:
+            self.read_conn = self._connect(query_only=True)
+        self.read_conn.execute("BEGIN;")
+        try:
+            return fn(self.read_conn)
+        finally:
+            self.read_conn.execute("ROLLBACK;")
+
+    async def run(self, fn, label='transaction'):
+        # Runs fn(connection) inside a single transaction
+        return await self._submit(self.executor, self._run, fn, label)
+
+    async def read(self, fn, label='read'):
+        # Runs fn(connection) inside a read-only transaction on the read connection
+        return await self._submit(self.read_executor, self._read, fn, label)
+
+    async def _submit(self, executor, run, fn, label):
+        loop = asyncio.get_running_loop()
+        started = time.perf_counter()
+        try:
+            return await loop.run_in_executor(executor, run, fn)
+        except Exception:
+            query_errors.inc(statement=label)
+            raise
+        finally:
+            query_seconds.observe(time.perf_counter() - started, statement=label)
+
+    async def execute(self, query, params=()):
+        return await self.run(lambda conn: conn.execute(query, params).rowcount, statement_label(query))
+
+    async def fetch(self, query, params=()):
+        return await self.run(lambda conn: conn.execute(query, params).fetchall(), statement_label(query))
+
+    async def fetchrow(self, query, params=()):
+        return await self.run(lambda conn: conn.execute(query, params).fetchone(), statement_label(query))
+
+
+# Embedded storage backend for single-process deployments. Same interface as
+# PostgresStorage; there is no cross-process notification, so it can't be shared by
+# several workers.
+class SqliteStorage:
+    shared = False
+
+    def __init__(self, path, timeout=10.0):
+        self.db = SqliteDatabase(path, timeout=timeout)
+
+    async def open(self):
+        await self.db.open()
+
+    async def close(self):
+        await self.db.close()
+
+    async def migrate(self):
+        # Returns the versions applied
+        def op(conn):
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS schema_migrations (
+                    version INTEGER PRIMARY KEY,
+                    description TEXT,
+                    applied_at TIMESTAMP
+                );
+            """)
+            done = {row['version'] for row in conn.execute("SELECT version FROM schema_migrations;")}
+            applied = []
+            for version, description, statements in MIGRATIONS:
+                if version in done:
+                    continue
+                for statement in statements:
+                    conn.execute(statement)
+                conn.execute(f"INSERT INTO schema_migrations (version, description, applied_at) VALUES (?, ?, {NOW});",
+                             (version, description))
+                applied.append(version)
+            return applied
+        applied = await self.db.run(op, label='migrate')
+        for version in applied:
+            logger.info("Applied schema migration %d.", version)
+        return applied
+
+    async def clock(self):
+        # The database's current time, as used for updated_at
+        row = await self.db.fetchrow(f"SELECT {NOW} AS now;")
+        return datetime.fromisoformat(row['now'])
+
+    async def notify(self, channel, payload):
+        pass
+
+    async def listen(self, channel, callback):
+        return None
+
+    async def load_channels(self, shards=None):
+        predicate, params = shard_filter('guild_id', shards)
+        return await self.db.fetch(f"SELECT * FROM channels WHERE {predicate};", params)
+
+    async def channels_changed_since(self, since, shards=None):
+        predicate, params = shard_filter('guild_id', shards)
+        return await self.db.fetch(f"SELECT * FROM channels WHERE updated_at >= ? AND {predicate};", (since, *params))
+
+    async def get_channel_config(self, guild_id):
+        return await self.db.fetchrow("SELECT * FROM channels WHERE guild_id = ?;", (guild_id,))
+
+    async def save_channel_config(self, guild_id, requisitions_channel_id, archive_channel_id, server_name):
+        await self.db.execute("""
+            INSERT INTO channels (guild_id, requisitions_channel_id, archive_channel_id, server_name)
+            VALUES (?, ?, ?, ?)
+            ON CONFLICT (guild_id) DO UPDATE
+            SET requisitions_channel_id = excluded.requisitions_channel_id,
+                archive_channel_id = excluded.archive_channel_id,
+                server_name = excluded.server_name;
+        """, (guild_id, requisitions_channel_id, archive_channel_id, server_name))
+
+    async def insert_requisition(self, row):
+        values = requisition_values(row)
+
+        def op(conn):
+            requisition_id = conn.execute(INSERT_REQUISITION_SQL, values).lastrowid
+            if row['status'] in LISTED_STATUSES:
+                conn.execute(DEMAND_SQL, (1, 1, ids_param([requisition_id])))
+            return requisition_id
+        return await self.db.run(op, label='insert requisitions')
+
+    async def insert_requisitions(self, rows):
+        values = [requisition_values(row) for row in rows]
+
+        def op(conn):
+            # The only writer inside the transaction, so the new rows are the ones above the old maximum
+            first = conn.execute("SELECT COALESCE(MAX(id), 0) AS id FROM requisitions;").fetchone()['id']
+            conn.executemany(INSERT_REQUISITION_SQL, values)
+            ids = conn.execute("""
+                SELECT json_group_array(id) AS ids FROM requisitions
+                WHERE id > ? AND status IN (SELECT value FROM json_each(?));
+            """, (first, ids_param(LISTED_STATUSES))).fetchone()['ids']
+            conn.execute(DEMAND_SQL, (1, 1, ids))
+            return len(values)
+        return await self.db.run(op, label='insert requisitions')
+
+    async def export_requisitions(self, out, file_format, guild_id=None, chunk_size=1000):
+        # Writes the requisitions of a guild, or of every guild, to the text file out a
+        # chunk at a time. Returns the number of rows.
+        return await self.export('requisitions', 'id', EXPORT_COLUMNS, requisition_row, out, file_format, guild_id,
+                                 chunk_size)
+
+    async def export_feedback(self, out, file_format, guild_id=None, chunk_size=1000):
+        return await self.export('feedback', 'id', FEEDBACK_COLUMNS, feedback_row, out, file_format, guild_id,
+                                 chunk_size)
+
+    async def export_channels(self, out, file_format, guild_id=None, chunk_size=1000):
+        return await self.export('channels', 'guild_id', CHANNEL_COLUMNS, dict, out, file_format, guild_id,
+                                 chunk_size)
+
+    async def export(self, table, order, columns, convert, out, file_format, guild_id, chunk_size):
+        def op(conn):
+            cursor = conn.execute(f"""
+                SELECT {', '.join(columns)} FROM {table}
+                WHERE ? IS NULL OR guild_id = ?
+                ORDER BY {order};
+            """, (guild_id, guild_id))
+            count = 0
+            while True:
+                rows = [convert(row) for row in cursor.fetchmany(chunk_size)]
+                write_rows(out, rows, file_format, not count, columns)
+                if not rows:
+                    return count
+                count += len(rows)
+        # Reads and writes out on the read connection's thread, off the writer's
+        return await self.db.read(op, label=f'export {table}')
+
+    async def import_channels(self, rows):
+        def op(conn):
+            conn.executemany("""
+                INSERT INTO channels (guild_id, requisitions_channel_id, archive_channel_id, server_name)
+                VALUES (?, ?, ?, ?)
+                ON CONFLICT (guild_id) DO UPDATE
+                SET requisitions_channel_id = excluded.requisitions_channel_id,
+                    archive_channel_id = excluded.archive_channel_id,
+                    server_name = excluded.server_name;
+            """, [(row['guild_id'], row['requisitions_channel_id'], row['archive_channel_id'], row['server_name'])
+                  for row in rows])
+            return len(rows)
+        return await self.db.run(op, label='insert channels')
+
+    async def pending_guilds(self, shards=None):
+        predicate, params = shard_filter('guild_id', shards)
+        rows = await self.db.fetch(f"SELECT DISTINCT guild_id FROM requisitions WHERE status = ? AND {predicate};",
+                                   (STATUS_PENDING, *params))
+        return [row['guild_id'] for row in rows]
+
+    async def claim_pending(self, guild_id, limit):
+        def op(conn):
+            ids = ids_param(row['id'] for row in conn.execute("""
+                SELECT id FROM requisitions
+                WHERE guild_id = ? AND status = ?
+                ORDER BY deadline
+                LIMIT ?;
+            """, (guild_id, STATUS_PENDING, limit)))
+            conn.execute("""
+                UPDATE requisitions SET status = ?, version = version + 1
+                WHERE id IN (SELECT value FROM json_each(?));
+            """, (STATUS_OPEN, ids))
+            conn.execute(DEMAND_SQL, (1, 1, ids))
+            return conn.execute("SELECT * FROM requisitions WHERE id IN (SELECT value FROM json_each(?)) ORDER BY deadline;",
+                                (ids,)).fetchall()
+        rows = await self.db.run(op, label='update requisitions')
+        return [requisition_row(row) for row in rows]
+
+    async def set_message_id(self, requisition_id, message_id):
+        await self.db.execute("UPDATE requisitions SET message_id = ? WHERE id = ?;", (message_id, requisition_id))
+
+    async def load_open_requisitions(self, statuses, limit, shards=None):
+        predicate, params = shard_filter('guild_id', shards)
+        rows = await self.db.fetch(f"""
+            SELECT * FROM requisitions
+            WHERE status IN (SELECT value FROM json_each(?)) AND message_id IS NOT NULL AND {predicate}
+            ORDER BY id DESC
+            LIMIT ?;
+        """, (ids_param(statuses), *params, limit))
+        return [requisition_row(row) for row in rows]
+
+    async def requisitions_changed_since(self, since, shards=None):
+        predicate, params = shard_filter('guild_id', shards)
+        rows = await self.db.fetch(f"""
+            SELECT * FROM requisitions
+            WHERE updated_at >= ? AND message_id IS NOT NULL AND {predicate};
+        """, (since, *params))
+        return [requisition_row(row) for row in rows]
+
+    async def legacy_requisitions(self, statuses):
+        rows = await self.db.fetch("""
+            SELECT * FROM requisitions
+            WHERE guild_id IS NULL AND status IN (SELECT value FROM json_each(?)) AND message_id IS NOT NULL
+            ORDER BY id;
+        """, (ids_param(statuses),))
+        return [requisition_row(row) for row in rows]
+
+    async def adopt_legacy_requisition(self, requisition_id, guild_id):
+        def op(conn):
+            row = conn.execute("SELECT message_id, status FROM requisitions WHERE id = ? AND guild_id IS NULL;",
+                               (requisition_id,)).fetchone()
+            if row is None:
+                return None
+            conn.execute("UPDATE requisitions SET guild_id = ?, version = version + 1 WHERE id = ?;", (guild_id, requisition_id))
+            if row['status'] in LISTED_STATUSES:
+                conn.execute(DEMAND_SQL, (1, 1, ids_param([requisition_id])))
+            conn.execute("UPDATE reminders SET guild_id = ? WHERE message_id = ? AND guild_id IS NULL;",
+                         (guild_id, row['message_id']))
+            return current_version(conn, row['message_id'])
+        return await self.db.run(op, label='update requisitions')
+
+    async def close_legacy_requisitions(self, requisition_ids, status, from_statuses):
+        def op(conn):
+            rows = conn.execute("""
+                SELECT id, message_id FROM requisitions
+                WHERE id IN (SELECT value FROM json_each(?)) AND guild_id IS NULL
+                  AND status IN (SELECT value FROM json_each(?));
+            """, (ids_param(requisition_ids), ids_param(from_statuses))).fetchall()
+            conn.execute("""
+                UPDATE requisitions SET status = ?, version = version + 1
+                WHERE id IN (SELECT value FROM json_each(?));
+            """, (status, ids_param(row['id'] for row in rows)))
+            return [row['message_id'] for row in rows]
+        return await self.db.run(op, label='update requisitions')
+
+    async def get_requisition(self, message_id, statuses):
+        row = await self.db.fetchrow("""
+            SELECT * FROM requisitions
+            WHERE message_id = ? AND status IN (SELECT value FROM json_each(?));
+        """, (message_id, ids_param(statuses)))
+        return requisition_row(row)
+
+    async def transition(self, message_id, status, from_statuses, fulfilled_by=()):
+        def op(conn):
+            row = conn.execute(f"""
+                SELECT id, guild_id, status, created_at, accepted_at, completed_at, {NOW} AS now
+                FROM requisitions
+                WHERE message_id = ? AND status IN (SELECT value FROM json_each(?));
+            """, (message_id, ids_param(from_statuses))).fetchone()
+            if row is None:
+                return None
+            row['now'] = datetime.fromisoformat(row['now'])
+            conn.execute("""
+                UPDATE requisitions
+                SET status = ?, version = version + 1,
+                    accepted_at = COALESCE(accepted_at, ?), completed_at = COALESCE(completed_at, ?)
+                WHERE id = ?;
+            """, (status, row['now'] if status == STATUS_ACCEPTED else None,
+                  row['now'] if status == STATUS_COMPLETED else None, row['id']))
+            record_stats(conn, row, *transition_stats(row, status, fulfilled_by))
+            return current_version(conn, message_id)
+        return await self.db.run(op, label='update requisitions')
+
+    async def set_completion_details(self, message_id, completion_details, status):
+        def op(conn):
+            cursor = conn.execute("""
+                UPDATE requisitions
+                SET completion_details = ?, version = version + 1
+                WHERE message_id = ? AND status = ?;
+            """, (completion_details, message_id, status))
+            return current_version(conn, message_id) if cursor.rowcount else None
+        return await self.db.run(op, label='update requisitions')
+
+    async def update_requisition(self, message_id, version, quantity, payment, deadline):
+        def op(conn):
+            row = conn.execute("SELECT id, status FROM requisitions WHERE message_id = ? AND version = ?;",
+                               (message_id, version)).fetchone()
+            if row is None:
+                return None
+            ids = ids_param([row['id']])
+            listed = row['status'] in LISTED_STATUSES
+            if listed:
+                conn.execute(DEMAND_SQL, (-1, -1, ids))
+            conn.execute("""
+                UPDATE requisitions
+                SET quantity = ?, payment = ?, deadline = ?, version = version + 1
+                WHERE id = ?;
+            """, (quantity, payment, deadline, row['id']))
+            if listed:
+                conn.execute(DEMAND_SQL, (1, 1, ids))
+            return current_version(conn, message_id)
+        return await self.db.run(op, label='update requisitions')
+
+    async def expire_requisitions(self, cutoff, limit, shards=None):
+        predicate, params = shard_filter('guild_id', shards)
+        query = EXPIRED_IDS_SQL.format(predicate=predicate)
+
+        def op(conn):
+            ids = ids_param(row['id'] for row in conn.execute(query, (cutoff, *params, limit)))
+            conn.execute("""
+                UPDATE requisitions SET status = ?, version = version + 1
+                WHERE id IN (SELECT value FROM json_each(?));
+            """, (STATUS_EXPIRED, ids))
+            conn.execute(DEMAND_SQL, (-1, -1, ids))
+            return conn.execute("SELECT * FROM requisitions WHERE id IN (SELECT value FROM json_each(?));",
+                                (ids,)).fetchall()
+        rows = await self.db.run(op, label='update requisitions')
+        return [requisition_row(row) for row in rows]
+
+    async def compact_stats(self, limit, shards=None):
+        predicate, params = shard_filter('guild_id', shards)
+
+        def op(conn):
+            ids = [row['id'] for row in conn.execute(f"""
+                SELECT id FROM stats_events
+                WHERE {predicate}
+                ORDER BY id
+                LIMIT ?;
+            """, (*params, limit))]
+            conn.execute(FOLD_STATS_SQL, (ids_param(ids),))
+            conn.execute("DELETE FROM stats_events WHERE id IN (SELECT value FROM json_each(?));", (ids_param(ids),))
+            conn.execute(f"DELETE FROM demand_stats WHERE open_count = 0 AND {predicate};", params)
+            return len(ids)
+        return await self.db.run(op, label='compact stats')
+
+    async def guild_stats(self, guild_id, since, demand_limit, fulfiller_limit):
+        since = since.isoformat()
+
+        def op(conn):
+            demand = conn.execute("""
+                SELECT material, region, open_count, open_quantity FROM demand_stats
+                WHERE guild_id = ? AND open_count > 0
+                ORDER BY open_quantity DESC, material, region
+                LIMIT ?;
+            """, (guild_id, demand_limit)).fetchall()
+            timings = {}
+            for metric in (METRIC_ACCEPT, METRIC_COMPLETE):
+                rows = conn.execute(STATS_COUNTS_SQL + ";", (guild_id, metric, since) * 2)
+                timings[metric] = {row['key']: row['count'] for row in rows}
+            rows = conn.execute(STATS_COUNTS_SQL + "ORDER BY count DESC, key LIMIT ?;",
+                                (*(guild_id, METRIC_FULFILLED, since) * 2, fulfiller_limit))
+            fulfillers = [(row['key'], row['count']) for row in rows]
+            return demand, timings, fulfillers
+        return await self.db.run(op, label='guild stats')
+
+    async def insert_feedback(self, row):
+        columns = list(row)
+        values = [json.dumps(row[column]) if column == 'fulfilled_by' else row[column] for column in columns]
+
+        def op(conn):
+            feedback_id = conn.execute(f"""
+                INSERT INTO feedback ({', '.join(columns)})
+                VALUES ({', '.join(['?'] * len(columns))});
+            """, values).lastrowid
+            return conn.execute("SELECT * FROM feedback WHERE id = ?;", (feedback_id,)).fetchone()
+        return await self.db.run(op, label='insert feedback')
+
+    async def get_feedback(self, feedback_id):
+        return await self.db.fetchrow("SELECT * FROM feedback WHERE id = ?;", (feedback_id,))
+
+    async def load_pending_feedback(self):
+        return await self.db.fetch("SELECT * FROM feedback WHERE received_at IS NULL ORDER BY id;")
+
+    async def record_feedback(self, feedback_id, rating, comments):
+        def op(conn):
+            row = conn.execute("SELECT guild_id, fulfilled_by FROM feedback WHERE id = ? AND received_at IS NULL;",
+                               (feedback_id,)).fetchone()
+            if row is None:
+                return False
+            conn.execute(f"UPDATE feedback SET rating = ?, comments = ?, received_at = {NOW} WHERE id = ?;",
+                         (rating, comments, feedback_id))
+            if row['guild_id'] is not None:
+                conn.execute("""
+                    INSERT INTO reputation (guild_id, user_id, ratings, rating_total)
+                    SELECT DISTINCT ?, value, 1, ? FROM json_each(?) WHERE 1
+                    ON CONFLICT (guild_id, user_id) DO UPDATE
+                    SET ratings = ratings + 1,
+                        rating_total = rating_total + excluded.rating_total;
+                """, (row['guild_id'], rating, row['fulfilled_by']))
+            return True
+        return await self.db.run(op, label='update feedback')
+
+    async def expire_feedback(self, before):
+        def op(conn):
+            return conn.execute("DELETE FROM feedback WHERE received_at IS NULL AND requested_at < ?;", (before,)).rowcount
+        return await self.db.run(op, label='delete feedback')
+
+    async def reputation(self, guild_id, user_id):
+        return await self.db.fetchrow("SELECT ratings, rating_total FROM reputation WHERE guild_id = ? AND user_id = ?;",
+                                      (guild_id, user_id))
+
+    async def search_requisitions(self, guild_id, statuses, query, limit, offset):
+        conditions = ["guild_id = ?", "status IN (SELECT value FROM json_each(?))", "message_id IS NOT NULL"]
+        params = [guild_id, ids_param(statuses)]
+        for column, terms in (('material', query.material), ('payment', query.payment)):
+            for term in terms:
+                # LIKE is case-insensitive for ASCII in SQLite
+                conditions.append(f"{column} LIKE ? ESCAPE '\\'")
+                params.append(like_pattern(term))
+        if query.region:
+            conditions.append("lower(region) = ?")
+            params.append(query.region)
+        if query.after:
+            conditions.append("deadline >= ?")
+            params.append(query.after)
+        if query.before:
+            conditions.append("deadline <= ?")
+            params.append(query.before)
+        rows = await self.db.fetch(f"""
+            SELECT *, COUNT(*) OVER () AS total FROM requisitions
+            WHERE {' AND '.join(conditions)}
+            ORDER BY deadline, message_id
+            LIMIT ? OFFSET ?;
+        """, (*params, limit, offset))
+        return [requisition_row(row) for row in rows], rows[0]['total'] if rows else 0
+
+    async def apply_reactions(self, rows):
+        # Read, patch and write back in one transaction; the connection is the only
+        # writer in this process, so no concurrent flush can interleave
+        def op(conn):
+            updates = []
+            for message_id, accepted_add, accepted_remove, completed_add, completed_remove in rows:
+                current = conn.execute("SELECT accepted_by, completed_by FROM requisitions WHERE message_id = ?;",
+                                       (message_id,)).fetchone()
+                if current is None:
+                    continue
+                current = requisition_row(current)
+                updates.append((
+                    json.dumps(patch(current['accepted_by'], accepted_add, set(accepted_remove))),
+                    json.dumps(patch(current['completed_by'], completed_add, set(completed_remove))),
+                    message_id
+                ))
+            conn.executemany("UPDATE requisitions SET accepted_by = ?, completed_by = ? WHERE message_id = ?;", updates)
+        await self.db.run(op, label='journal flush')
+
+    async def load_reminders(self):
+        return await self.db.fetch("SELECT id, message_id, guild_id, user_id, content, due_at FROM reminders;")
+
+    async def reminder_ids(self):
+        return await self.db.fetch("SELECT id, guild_id FROM reminders;")
+
+    async def get_reminders(self, reminder_ids):
+        return await self.db.fetch(
+            "SELECT id, message_id, guild_id, user_id, content, due_at FROM reminders WHERE id IN (SELECT value FROM json_each(?));",
+            (ids_param(reminder_ids),)
+        )
+
+    async def insert_reminder(self, message_id, guild_id, user_id, kind, content, due_at):
+        return await self.db.run(lambda conn: conn.execute("""
+            INSERT INTO reminders (message_id, guild_id, user_id, kind, content, due_at)
+            VALUES (?, ?, ?, ?, ?, ?);
+        """, (message_id, guild_id, user_id, kind, content, due_at)).lastrowid, label='insert reminders')
+
+    async def delete_reminders(self, message_ids, kind=None):
+        message_ids = ids_param(message_ids)
+
+        def op(conn):
+            if kind is None:
+                rows = conn.execute("SELECT id FROM reminders WHERE message_id IN (SELECT value FROM json_each(?));",
+                                    (message_ids,)).fetchall()
+            else:
+                rows = conn.execute(
+                    "SELECT id FROM reminders WHERE message_id IN (SELECT value FROM json_each(?)) AND kind = ?;",
+                    (message_ids, kind)
+                ).fetchall()
+            ids = [row['id'] for row in rows]
+            conn.execute("DELETE FROM reminders WHERE id IN (SELECT value FROM json_each(?));", (ids_param(ids),))
+            return ids
+        return await self.db.run(op, label='delete reminders')
+
+    async def delete_reminders_by_id(self, reminder_ids):
+        await self.db.execute("DELETE FROM reminders WHERE id IN (SELECT value FROM json_each(?));",
+                              (ids_param(reminder_ids),))
+
+    async def load_conversations(self):
+        return await self.db.fetch("SELECT * FROM conversations ORDER BY id;")
+
+    async def get_conversation(self, session_id):
+        return await self.db.fetchrow("SELECT * FROM conversations WHERE id = ?;", (session_id,))
+
+    async def insert_conversation(self, user_id, channel_id, guild_id, flow, step, data, context, step_deadline, expires_at):
+        return await self.db.run(lambda conn: conn.execute("""
+            INSERT INTO conversations (user_id, channel_id, guild_id, flow, step, data, context, step_deadline, expires_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?);
+        """, (user_id, channel_id, guild_id, flow, step, data, context, step_deadline, expires_at)).lastrowid,
+            label='insert conversations')
+
+    async def update_conversation(self, session_id, step, data, step_deadline):
+        await self.db.execute("UPDATE conversations SET step = ?, data = ?, step_deadline = ? WHERE id = ?;",
+                              (step, data, step_deadline, session_id))
+
+    async def set_conversation_deadline(self, session_id, step_deadline):
+        await self.db.execute("UPDATE conversations SET step_deadline = ? WHERE id = ?;", (step_deadline, session_id))
+
+    async def delete_conversation(self, session_id):
+        await self.db.execute("DELETE FROM conversations WHERE id = ?;", (session_id,))
@@ -0,0 +1,166 @@
+import asyncio
+import logging
+import time
+from bisect import bisect_left
+
+import discord
+
+from cogs import metrics
+from cogs.requisition_cache import STATUS_ACCEPTED, STATUS_COMPLETED, STATUS_ARCHIVED
+from cogs.search import LISTED_STATUSES
+
+logger = logging.getLogger('matmaster.stats')
+
+compact_seconds = metrics.histogram('matmaster_stats_compaction_seconds', 'Duration of stats compactions.')
+compacted_events = metrics.counter('matmaster_stats_compacted_events_total', 'Stats events folded into daily rollups.')
+
+# Stats events. Timings are logged as the index of their bucket in TIMING_BUCKETS,
+# fulfilments with the user ID as key.
+METRIC_ACCEPT = 'accept'
+METRIC_COMPLETE = 'complete'
+METRIC_FULFILLED = 'fulfilled'
+
+# Upper bounds in seconds of the time-to-accept and time-to-complete buckets; anything
+# slower falls into one last overflow bucket
+TIMING_BUCKETS = (
+    60, 300, 900, 1800, 3600, 2 * 3600, 4 * 3600, 8 * 3600, 16 * 3600,
+    86400, 2 * 86400, 4 * 86400, 7 * 86400, 14 * 86400, 30 * 86400
+)
+
+DEFAULT_DAYS = 30
+MAX_DAYS = 365
+TOP_DEMAND = 10
+TOP_FULFILLERS = 5
+
+
+# Guild stats are kept up to date by the storage backends, in the same transaction as
+# the lifecycle change that causes them:
+#
+#   demand_stats  open count and quantity per (guild, material, region), adjusted as
+#                 requisitions enter and leave LISTED_STATUSES
+#   stats_events  one row per acceptance, completion and fulfilment, appended as they happen
+#   stats_daily   stats_events folded into counts per (guild, metric, day, key) by StatsCompactor
+#
+# Reading stats for a guild touches its demand rows plus a bounded number of rollup and
+# recent event rows, however long the requisition history is.
+
+def timing_bucket(elapsed):
+    return bisect_left(TIMING_BUCKETS, elapsed.total_seconds())
+
+
+def transition_stats(row, status, fulfilled_by=()):
+    # For a requisition row read just before it moves to status, with the database time
+    # as row['now']: the (metric, key) events to log, and whether it leaves open demand.
+    # First acceptance and completion only, so flapping between states counts once.
+    events = []
+    if row['created_at'] is not None:
+        if status == STATUS_ACCEPTED and row['accepted_at'] is None:
+            events.append((METRIC_ACCEPT, timing_bucket(row['now'] - row['created_at'])))
+        elif status == STATUS_COMPLETED and row['completed_at'] is None:
+            events.append((METRIC_COMPLETE, timing_bucket(row['now'] - row['created_at'])))
+    if status == STATUS_ARCHIVED:
+        events.extend((METRIC_FULFILLED, user_id) for user_id in fulfilled_by)
+    return events, row['status'] in LISTED_STATUSES and status not in LISTED_STATUSES
+
+
+def quantile(counts, q):
+    # Estimated from bucket counts ({bucket: count}), interpolating linearly inside the
+    # bucket like Prometheus' histogram_quantile. None without observations.
+    total = sum(counts.values())
+    if not total:
+        return None
+    rank = q * total
+    seen = 0
+    for bucket in sorted(counts):
+        if seen + counts[bucket] >= rank:
+            if bucket >= len(TIMING_BUCKETS):
+                return TIMING_BUCKETS[-1]
+            lower = TIMING_BUCKETS[bucket - 1] if bucket else 0
+            return lower + (TIMING_BUCKETS[bucket] - lower) * (rank - seen) / counts[bucket]
+        seen += counts[bucket]
+    return TIMING_BUCKETS[-1]
+
+
+def duration_text(seconds):
+    if seconds < 3600:
+        return f"{max(1, round(seconds / 60))}m"
+    if seconds < 86400:
+        return f"{seconds / 3600:.1f}h"
+    return f"{seconds / 86400:.1f}d"
+
+
+def timing_text(counts):
+    median = quantile(counts, 0.5)
+    if median is None:
+        return "No data yet"
+    text = f"{duration_text(median)} median over {sum(counts.values())}"
+    if len(TIMING_BUCKETS) in counts:
+        text += f" (some over {duration_text(TIMING_BUCKETS[-1])})"
+    return text
+
+
+def stats_embed(guild_name, days, demand, timings, fulfillers):
+    # Renders the result of storage.guild_stats()
+    embed = discord.Embed(title=f"Requisition stats for {guild_name}", description=f"Last {days} days",
+                          color=discord.Color.blurple())
+    embed.add_field(
+        name="Open demand",
+        value="\n".join(
+            f"**{row['material']}** ({row['region']}): {row['open_quantity']} in {row['open_count']} requisitions"
+            for row in demand
+        ) or "Nothing open",
+        inline=False
+    )
+    embed.add_field(name="Time to accept", value=timing_text(timings.get(METRIC_ACCEPT, {})))
+    embed.add_field(name="Time to complete", value=timing_text(timings.get(METRIC_COMPLETE, {})))
+    embed.add_field(
+        name="Top fulfillers",
+        value="\n".join(f"<@{user_id}>: {count}" for user_id, count in fulfillers) or "Nobody yet",
+        inline=False
+    )
+    return embed
+
+
+# Periodically folds the stats events of this process's guilds into daily rollups, so
+# the event log only ever holds what happened since the last run
+class StatsCompactor:
+    def __init__(self, storage, interval=3600, batch_size=5000, shards=None):
+        self.storage = storage
+        self.interval = interval
+        self.batch_size = batch_size
+        self.shards = shards
+        self.task = None
+
+    async def start(self):
+        self.task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        if self.task:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.compact()
+            except Exception as e:
+                logger.error("Stats compaction failed: %s", e)
+
+    async def compact(self):
+        started = time.perf_counter()
+        total = 0
+        while True:
+            folded = await self.storage.compact_stats(self.batch_size, self.shards)
+            total += folded
+            if folded < self.batch_size:
+                break
+        compacted_events.inc(total)
+        compact_seconds.observe(time.perf_counter() - started)
+        if total:
+            logger.info("Compacted %d stats events into daily rollups.", total)
+        return total
@@ -0,0 +1,36 @@
+from urllib.parse import urlsplit
+
+from cogs.postgres_storage import PostgresStorage
+from cogs.sqlite_storage import SqliteStorage
+
+# Storage backends keep everything MatMaster persists - requisitions, channel config,
+# reminders and conversations - behind one set of async methods, so the cogs never
+# issue SQL themselves:
+#
+#   postgres://... or postgresql://...  PostgresStorage, shared by every worker
+#   sqlite:///relative.db, sqlite:////absolute.db  SqliteStorage, embedded and single-process
+#
+# Rows come back as dicts with the same keys and Python types from either backend.
+# A backend's shared attribute says whether several worker processes can use it.
+
+POSTGRES_SCHEMES = ('postgres', 'postgresql')
+SQLITE_SCHEMES = ('sqlite',)
+
+
+def sqlite_path(url):
+    # sqlite:///data/matmaster.db -> data/matmaster.db, sqlite:////var/lib/matmaster.db -> /var/lib/matmaster.db
+    path = url.split(':///', 1)[1] if ':///' in url else ''
+    if not path:
+        raise ValueError(f"SQLite URL needs a path, e.g. sqlite:///matmaster.db: {url}")
+    return path
+
+
+def open_storage(url, min_size=1, max_size=10, timeout=10.0, **connect_kwargs):
+    # Picks the backend from the URL scheme. Pool sizes and connect_kwargs only apply to Postgres.
+    scheme = urlsplit(url).scheme.lower()
+    if scheme in POSTGRES_SCHEMES:
+        return PostgresStorage(url, min_size=min_size, max_size=max_size, timeout=timeout, **connect_kwargs)
+    if scheme in SQLITE_SCHEMES:
+        return SqliteStorage(sqlite_path(url), timeout=timeout)
+    raise ValueError(f"Unsupported DATABASE_URL scheme: {scheme or url}")
+
@@ -0,0 +1,205 @@
+import csv
+import json
+from datetime import datetime
+
+from cogs.requisition import INSERT_COLUMNS
+from cogs.validation import MAX_LENGTHS, MAX_QUANTITY
+from cogs.requisition_cache import (
+    OPEN_STATUSES, STATUS_OPEN, STATUS_PENDING, STATUS_ARCHIVED, STATUS_CANCELLED, STATUS_EXPIRED
+)
+
+# Bulk export and import of requisitions, feedback and channel configuration, shared by
+# admin.py and !mm_export.
+#
+# Each table is written with its columns from TABLE_COLUMNS. In CSV, lists of user IDs
+# (accepted_by, completed_by, fulfilled_by) are separated by spaces; in JSONL they are
+# arrays. Timestamps are ISO 8601. Requisition and channel exports can be imported again
+# as they are; only the columns in INSERT_COLUMNS and CHANNEL_COLUMNS are read back.
+# Feedback is export-only: it points at requisitions by ID, and imported requisitions
+# get new IDs.
+
+FORMATS = ('csv', 'jsonl')
+
+EXPORT_COLUMNS = (
+    'id', 'message_id', 'guild_id', 'requester', 'material', 'quantity', 'payment', 'deadline',
+    'region', 'accepted_by', 'completed_by', 'completion_details', 'status', 'created_at'
+)
+FEEDBACK_COLUMNS = (
+    'id', 'requisition_id', 'guild_id', 'requester', 'material', 'fulfilled_by', 'archive_channel_id',
+    'archived_message_id', 'rating', 'comments', 'requested_at', 'received_at'
+)
+CHANNEL_COLUMNS = ('guild_id', 'requisitions_channel_id', 'archive_channel_id', 'server_name')
+
+TABLE_COLUMNS = {
+    'requisitions': EXPORT_COLUMNS,
+    'feedback': FEEDBACK_COLUMNS,
+    'channels': CHANNEL_COLUMNS
+}
+TABLES = tuple(TABLE_COLUMNS)
+IMPORT_TABLES = ('requisitions', 'channels')
+
+STATUSES = OPEN_STATUSES + (STATUS_PENDING, STATUS_ARCHIVED, STATUS_CANCELLED, STATUS_EXPIRED)
+
+
+def read_records(f, file_format):
+    # Yields (line number, record dict) without reading the whole file
+    if file_format == 'csv':
+        reader = csv.DictReader(f)
+        for record in reader:
+            yield reader.line_num, record
+        return
+    for line, text in enumerate(f, 1):
+        if text.strip():
+            try:
+                record = json.loads(text)
+            except ValueError as e:
+                record = {'_error': f"invalid JSON: {str(e)}"}
+            yield line, record if isinstance(record, dict) else {'_error': "not a JSON object"}
+
+
+def read_batches(f, file_format, batch_size):
+    batch = []
+    for item in read_records(f, file_format):
+        batch.append(item)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def blank(value):
+    return value is None or (isinstance(value, str) and not value.strip())
+
+
+def parse_int(value):
+    if isinstance(value, bool) or isinstance(value, float):
+        raise ValueError(value)
+    return int(value)
+
+
+def parse_text(value):
+    if not isinstance(value, str):
+        raise ValueError(value)
+    return value.strip()
+
+
+def parse_ids(value):
+    return [parse_int(user_id) for user_id in (value.split() if isinstance(value, str) else value)]
+
+
+def parse_timestamp(value):
+    return datetime.fromisoformat(parse_text(value)).replace(tzinfo=None, microsecond=0)
+
+
+def column_reader(records, errors):
+    # column(name, parse, ...) parses one field of every record, noting the first error
+    # of each record in errors by index
+    for index, (line, record) in enumerate(records):
+        if '_error' in record:
+            errors[index] = record['_error']
+
+    def column(name, parse, required=False, default=None):
+        values = []
+        for index, (line, record) in enumerate(records):
+            value = record.get(name)
+            if blank(value):
+                if required:
+                    errors.setdefault(index, f"{name} is required")
+                values.append(default)
+                continue
+            try:
+                values.append(parse(value))
+            except (TypeError, ValueError):
+                errors.setdefault(index, f"invalid {name}: {value!r}")
+                values.append(default)
+        return values
+    return column
+
+
+def accepted(records, columns, errors, names):
+    # The rows without errors, and the (line, error) of every rejected one
+    rows = [
+        {name: columns[name][index] for name in names}
+        for index in range(len(records)) if index not in errors
+    ]
+    return rows, sorted((records[index][0], error) for index, error in errors.items())
+
+
+def validate_batch(records, guild_id=None, now=None):
+    # Validates a batch of (line, record) pairs one column at a time, so each check runs
+    # as a tight loop over the batch instead of a schema walk per row. Returns the rows
+    # ready for storage.insert_requisitions() and the (line, error) of every rejected one.
+    # Open requisitions without a message ID become pending, to be posted by the bot.
+    now = now or datetime.now()
+    errors = {}
+    column = column_reader(records, errors)
+
+    columns = {
+        'requester': column('requester', parse_int, required=True),
+        'material': column('material', parse_text, required=True),
+        'quantity': column('quantity', parse_int, required=True),
+        'payment': column('payment', parse_text, required=True),
+        'deadline': column('deadline', parse_timestamp, required=True),
+        'region': column('region', parse_text, required=True),
+        'guild_id': [guild_id] * len(records) if guild_id else column('guild_id', parse_int, required=True),
+        'message_id': column('message_id', parse_int),
+        'accepted_by': column('accepted_by', parse_ids, default=()),
+        'completed_by': column('completed_by', parse_ids, default=()),
+        'completion_details': column('completion_details', parse_text, default=''),
+        'status': column('status', lambda value: parse_text(value).lower(), default=STATUS_OPEN)
+    }
+
+    for index, quantity in enumerate(columns['quantity']):
+        if quantity is not None and not 1 <= quantity <= MAX_QUANTITY:
+            errors.setdefault(index, f"quantity must be between 1 and {MAX_QUANTITY}")
+    for name, limit in MAX_LENGTHS.items():
+        for index, value in enumerate(columns[name]):
+            if value is not None and len(value) > limit:
+                errors.setdefault(index, f"{name} is longer than {limit} characters")
+    statuses = columns['status']
+    for index, (status, message_id, deadline) in enumerate(zip(statuses, columns['message_id'], columns['deadline'])):
+        if status not in STATUSES:
+            errors.setdefault(index, f"unknown status {status!r}")
+        elif message_id is None and status in OPEN_STATUSES:
+            if status != STATUS_OPEN:
+                errors.setdefault(index, f"{status} requisitions need their message_id")
+            elif deadline is not None and deadline <= now:
+                errors.setdefault(index, "deadline has already passed")
+            else:
+                statuses[index] = STATUS_PENDING
+    return accepted(records, columns, errors, INSERT_COLUMNS)
+
+
+def validate_channels(records, guild_id=None):
+    # Like validate_batch, for channel configuration rows for storage.import_channels()
+    errors = {}
+    column = column_reader(records, errors)
+    columns = {
+        'guild_id': [guild_id] * len(records) if guild_id else column('guild_id', parse_int, required=True),
+        'requisitions_channel_id': column('requisitions_channel_id', parse_int, required=True),
+        'archive_channel_id': column('archive_channel_id', parse_int, required=True),
+        'server_name': column('server_name', parse_text, required=True)
+    }
+    return accepted(records, columns, errors, CHANNEL_COLUMNS)
+
+
+def csv_value(value):
+    if isinstance(value, (list, tuple)):
+        return ' '.join(map(str, value))
+    if isinstance(value, datetime):
+        return value.isoformat(' ')
+    return value
+
+
+def write_rows(out, rows, file_format, header, columns=EXPORT_COLUMNS):
+    # For backends without COPY: writes export rows (dicts) the same way COPY would
+    if file_format == 'csv':
+        writer = csv.writer(out)
+        if header:
+            writer.writerow(columns)
+        writer.writerows([csv_value(row[name]) for name in columns] for row in rows)
+        return
+    for row in rows:
+        out.write(json.dumps({name: row[name] for name in columns}, default=datetime.isoformat))
+        out.write('\n')
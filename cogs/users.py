@@ -0,0 +1,61 @@
+import asyncio
+from collections import OrderedDict
+
+import discord
+
+from cogs import metrics
+
+cached_users = metrics.gauge('matmaster_user_cache_size', 'Users held in the requisition user cache.')
+lookups_total = metrics.counter('matmaster_user_lookups_total', 'User lookups by the source that answered them.')
+
+
+# Bounded LRU of the users MatMaster actually deals with - requesters, people who
+# accepted a job and whoever reacted to a post. The bot runs without the members intent
+# or a member cache, so discord.py only keeps users alive while something references
+# them; this cache is what keeps the ones needed for DMs. Misses fall back to
+# bot.get_user and then a single fetch_user per ID, shared by concurrent callers.
+class UserCache:
+    def __init__(self, bot, max_size=2000):
+        self.bot = bot
+        self.max_size = max_size
+        self.users = OrderedDict()
+        self.fetching = {}
+        cached_users.set_function(lambda: len(self.users))
+
+    def __len__(self):
+        return len(self.users)
+
+    def put(self, user):
+        self.users[user.id] = user
+        self.users.move_to_end(user.id)
+        while len(self.users) > self.max_size:
+            self.users.popitem(last=False)
+
+    async def get(self, user_id):
+        user = self.users.get(user_id)
+        if user is not None:
+            self.users.move_to_end(user_id)
+            lookups_total.inc(source='cache')
+            return user
+
+        user = self.bot.get_user(user_id)
+        if user is not None:
+            lookups_total.inc(source='client')
+            self.put(user)
+            return user
+
+        future = self.fetching.get(user_id)
+        if future is None:
+            future = self.fetching[user_id] = asyncio.ensure_future(self._fetch(user_id))
+        return await asyncio.shield(future)
+
+    async def _fetch(self, user_id):
+        try:
+            user = await self.bot.fetch_user(user_id)
+        except discord.NotFound:
+            return None
+        finally:
+            self.fetching.pop(user_id, None)
+        lookups_total.inc(source='fetch')
+        self.put(user)
+        return user
@@ -0,0 +1,102 @@
+# Validation of requisition payloads. A schema is compiled once, at import, into a list
+# of (field, check) closures, so validating a payload is a loop over plain function
+# calls with no schema walk or rule lookup per call. Validators keep no state between
+# calls: errors are returned as a value, {field: [message, ...]} like Cerberus' errors,
+# and empty when the payload is valid, so concurrent commands can't see each other's.
+
+# Longest material, payment and region accepted, which bounds the size of each row and
+# of the posts and DMs rendered from it
+MAX_LENGTHS = {
+    'material': 100,
+    'payment': 100,
+    'region': 50
+}
+# Largest value of the INTEGER quantity column
+MAX_QUANTITY = 2 ** 31 - 1
+
+REQUISITION_SCHEMA = {
+    'material': {'type': 'string', 'required': True, 'maxlength': MAX_LENGTHS['material']},
+    'quantity': {'type': 'integer', 'min': 1, 'max': MAX_QUANTITY, 'required': True},
+    'payment': {'type': 'string', 'required': True, 'maxlength': MAX_LENGTHS['payment']},
+    'deadline': {'type': 'string', 'required': True},
+    'region': {'type': 'string', 'required': True, 'maxlength': MAX_LENGTHS['region']}
+}
+
+TYPES = {
+    'string': (str, "must be of string type"),
+    'integer': (int, "must be of integer type")
+}
+
+
+def compile_field(rules):
+    # One check for a present value: returns its error message, or None
+    expected, type_error = TYPES[rules['type']]
+    limits = []
+    if 'min' in rules:
+        limits.append(lambda value, low=rules['min']: f"min value is {low}" if value < low else None)
+    if 'max' in rules:
+        limits.append(lambda value, high=rules['max']: f"max value is {high}" if value > high else None)
+    if 'maxlength' in rules:
+        limits.append(lambda value, high=rules['maxlength']: f"max length is {high}" if len(value) > high else None)
+
+    def check(value):
+        if not isinstance(value, expected) or isinstance(value, bool):
+            return type_error
+        for limit in limits:
+            error = limit(value)
+            if error is not None:
+                return error
+        return None
+    return check
+
+
+def compile_schema(schema):
+    # Returns validate(data) -> errors and validate_batch(payloads) -> [errors, ...]. The
+    # batch form runs one field at a time over all payloads, which keeps each check in a
+    # tight loop and skips building an errors dict for every valid payload.
+    checks = [(field, rules.get('required', False), compile_field(rules)) for field, rules in schema.items()]
+    known = frozenset(schema)
+
+    def validate(data):
+        errors = {}
+        for field, required, check in checks:
+            value = data.get(field)
+            if value is None:
+                if required:
+                    errors[field] = ["required field"]
+                continue
+            error = check(value)
+            if error is not None:
+                errors[field] = [error]
+        for field in data.keys() - known:
+            errors[field] = ["unknown field"]
+        return errors
+
+    def validate_batch(payloads):
+        errors = {}
+        for field, required, check in checks:
+            for index, value in enumerate([data.get(field) for data in payloads]):
+                if value is None:
+                    if not required:
+                        continue
+                    error = "required field"
+                else:
+                    error = check(value)
+                    if error is None:
+                        continue
+                errors.setdefault(index, {})[field] = [error]
+        for index, data in enumerate(payloads):
+            if data.keys() != known:
+                for field in data.keys() - known:
+                    errors.setdefault(index, {})[field] = ["unknown field"]
+        return [errors.get(index, {}) for index in range(len(payloads))]
+
+    return validate, validate_batch
+
+
+# validate_requisitions() returns the errors of each payload, in order
+validate_requisition, validate_requisitions = compile_schema(REQUISITION_SCHEMA)
+
+
+def error_text(errors):
+    return "; ".join(f"{field}: {', '.join(messages)}" for field, messages in errors.items())
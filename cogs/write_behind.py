@@ -0,0 +1,103 @@
+import asyncio
+import logging
+import time
+
+from cogs import metrics
+
+logger = logging.getLogger('matmaster.journal')
+
+COLUMNS = ('accepted_by', 'completed_by')
+
+flush_seconds = metrics.histogram('matmaster_journal_flush_seconds', 'Time taken to flush the reaction journal.')
+flushed_rows = metrics.counter('matmaster_journal_flushed_requisitions_total', 'Requisitions written by journal flushes.')
+backlog = metrics.gauge('matmaster_journal_backlog', 'Requisitions with reaction changes waiting to be flushed.')
+
+
+# Write-behind journal for accepted_by/completed_by. Reaction handlers record changes
+# in memory; a background task coalesces them per requisition (last change per user
+# wins) and writes each batch in a single transaction on a short interval and on shutdown.
+# Only the added and removed users are sent, so rows are patched rather than rewritten.
+class ReactionJournal:
+    def __init__(self, storage, interval=2.0, batch_size=500):
+        self.storage = storage
+        self.interval = interval
+        self.batch_size = batch_size
+        self.pending = {}
+        self.task = None
+        self.last_flush_seconds = 0.0
+        backlog.set_function(lambda: len(self.pending))
+
+    def __len__(self):
+        return len(self.pending)
+
+    def record(self, message_id, column, user_id, added):
+        changes = self.pending.setdefault(message_id, {column: {} for column in COLUMNS})
+        changes[column][user_id] = added
+
+    def overlay(self, message_id, requisition):
+        # Applies unflushed changes to a requisition that was just read back from the DB
+        changes = self.pending.get(message_id)
+        if changes is None:
+            return requisition
+        for column in COLUMNS:
+            user_ids = getattr(requisition, column)
+            for user_id, added in changes[column].items():
+                if added and user_id not in user_ids:
+                    user_ids.append(user_id)
+                elif not added and user_id in user_ids:
+                    user_ids.remove(user_id)
+        return requisition
+
+    async def start(self):
+        self.task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        if self.task:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+        await self.flush()
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error("Reaction journal flush failed: %s", e)
+
+    async def flush(self):
+        while self.pending:
+            batch = {}
+            for message_id in list(self.pending)[:self.batch_size]:
+                batch[message_id] = self.pending.pop(message_id)
+            try:
+                await self._write(batch)
+            except Exception:
+                # Put the batch back underneath anything recorded while it was in flight
+                for message_id, changes in batch.items():
+                    newer = self.pending.get(message_id)
+                    if newer is not None:
+                        for column in COLUMNS:
+                            changes[column].update(newer[column])
+                    self.pending[message_id] = changes
+                raise
+
+    async def _write(self, batch):
+        rows = []
+        for message_id, changes in batch.items():
+            row = [message_id]
+            for column in COLUMNS:
+                row.append([user_id for user_id, added in changes[column].items() if added])
+                row.append([user_id for user_id, added in changes[column].items() if not added])
+            rows.append(tuple(row))
+
+        started = time.perf_counter()
+        await self.storage.apply_reactions(rows)
+        self.last_flush_seconds = time.perf_counter() - started
+        flush_seconds.observe(self.last_flush_seconds)
+        flushed_rows.inc(len(rows))
+        logger.debug("Flushed reaction journal for %d requisitions in %.3fs", len(rows), self.last_flush_seconds)
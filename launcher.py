@@ -0,0 +1,117 @@
+import json
+import logging
+import os
+import signal
+import subprocess
+import sys
+import time
+import urllib.request
+
+# Configure logging
+logging.basicConfig(level=logging.INFO, format='%(asctime)s:%(levelname)s:%(name)s:%(message)s')
+logger = logging.getLogger('launcher')
+
+DISCORD_TOKEN = os.getenv('DISCORD_TOKEN')
+SHARD_COUNT = os.getenv('SHARD_COUNT', 'auto')
+WORKER_COUNT = int(os.getenv('WORKER_COUNT', '1'))
+# Discord allows one IDENTIFY per 5 seconds per concurrency bucket
+IDENTIFY_INTERVAL = float(os.getenv('IDENTIFY_INTERVAL', '5.5'))
+RESTART_DELAY = float(os.getenv('WORKER_RESTART_DELAY', '10'))
+
+GATEWAY_URL = 'https://discord.com/api/v10/gateway/bot'
+
+
+def recommended_shards():
+    request = urllib.request.Request(GATEWAY_URL, headers={
+        'Authorization': f"Bot {DISCORD_TOKEN}",
+        'User-Agent': 'matmaster-launcher'
+    })
+    with urllib.request.urlopen(request, timeout=10) as response:
+        data = json.load(response)
+    return data['shards'], data['session_start_limit']['max_concurrency']
+
+
+def partition(shard_count, worker_count):
+    # Contiguous shard ranges, as even as possible
+    worker_count = max(1, min(worker_count, shard_count))
+    size, extra = divmod(shard_count, worker_count)
+    ranges, start = [], 0
+    for worker in range(worker_count):
+        end = start + size + (1 if worker < extra else 0)
+        ranges.append(list(range(start, end)))
+        start = end
+    return ranges
+
+
+# Runs matmaster.py as one process per shard range. Workers are started one identify
+# window apart per shard so their gateway logins don't hit the identify rate limit,
+# crashed workers are restarted, and SIGTERM/SIGINT are forwarded to every worker.
+class Launcher:
+    def __init__(self, shard_count, worker_count, max_concurrency=1):
+        self.shard_count = shard_count
+        self.ranges = partition(shard_count, worker_count)
+        self.max_concurrency = max_concurrency
+        self.workers = {}
+        self.stopping = False
+
+    def spawn(self, index):
+        shard_ids = self.ranges[index]
+        env = dict(os.environ, SHARD_COUNT=str(self.shard_count), SHARD_IDS=','.join(map(str, shard_ids)),
+                   WORKER_INDEX=str(index))
+        process = subprocess.Popen([sys.executable, 'matmaster.py'], env=env)
+        self.workers[index] = process
+        logger.info("Started worker %d (pid %d) for shards %d-%d.", index, process.pid, shard_ids[0], shard_ids[-1])
+
+    def stagger(self, index):
+        # Each worker identifies its shards back to back, so the next one waits for them
+        shards = len(self.ranges[index])
+        return IDENTIFY_INTERVAL * -(-shards // self.max_concurrency)
+
+    def stop(self, signum, frame):
+        self.stopping = True
+        for process in self.workers.values():
+            if process.poll() is None:
+                process.send_signal(signum)
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        logger.info("Running %d shards across %d workers.", self.shard_count, len(self.ranges))
+
+        for index in range(len(self.ranges)):
+            if self.stopping:
+                break
+            self.spawn(index)
+            if index < len(self.ranges) - 1:
+                time.sleep(self.stagger(index))
+
+        while self.workers:
+            time.sleep(1)
+            for index, process in list(self.workers.items()):
+                code = process.poll()
+                if code is None:
+                    continue
+                if self.stopping:
+                    del self.workers[index]
+                    continue
+                logger.error("Worker %d exited with code %s, restarting in %ss.", index, code, RESTART_DELAY)
+                time.sleep(RESTART_DELAY)
+                if not self.stopping:
+                    self.spawn(index)
+
+
+def main():
+    if not DISCORD_TOKEN:
+        logger.error("DISCORD_TOKEN not found in environment variables.")
+        sys.exit(1)
+
+    max_concurrency = 1
+    if SHARD_COUNT == 'auto':
+        shard_count, max_concurrency = recommended_shards()
+    else:
+        shard_count = int(SHARD_COUNT)
+    Launcher(shard_count, WORKER_COUNT, max_concurrency).run()
+
+
+if __name__ == "__main__":
+    main()
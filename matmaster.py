@@ -1,18 +1,61 @@
 import discord
 from discord.ext import commands
+import atexit
 import logging
 import os
 import asyncio
-import psycopg2
-from psycopg2.extras import RealDictCursor
+from cogs.storage import open_storage
 from cogs.requisition_flow import RequisitionFlow
+from cogs.shard_stats import ShardStats
+from cogs.loop_monitor import LoopMonitor
+from cogs import metrics
+from cogs.logs import setup_logging, parse_pairs
 
-# Configure logging
-logging.basicConfig(level=logging.DEBUG, format='%(asctime)s:%(levelname)s:%(name)s:%(message)s')
-logger = logging.getLogger('discord')
+# Configure logging. Records are sampled, queued and written as JSON lines by a
+# background thread, so logging never blocks the event loop.
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO').upper()
+# Per-subsystem levels, e.g. discord.gateway=WARNING,matmaster.outbound=DEBUG
+LOG_LEVELS = parse_pairs(os.getenv('LOG_LEVELS'), str.upper)
+LOG_FORMAT = os.getenv('LOG_FORMAT', 'json')
+# Share of DEBUG/INFO records kept per high-volume category
+LOG_SAMPLE_RATES = parse_pairs(os.getenv('LOG_SAMPLE_RATES', 'reaction=0.01,gateway=0.01'), float)
+log_listener = setup_logging(LOG_LEVEL, LOG_LEVELS, json_format=LOG_FORMAT == 'json', sample_rates=LOG_SAMPLE_RATES,
+                             lean_records=True)
+# Writes out whatever is still queued, whichever way the process exits
+atexit.register(log_listener.stop)
+logger = logging.getLogger('matmaster')
 
 DISCORD_TOKEN = os.getenv('DISCORD_TOKEN')
 DATABASE_URL = os.getenv('DATABASE_URL')
+DB_POOL_MIN = int(os.getenv('DB_POOL_MIN', '1'))
+DB_POOL_MAX = int(os.getenv('DB_POOL_MAX', '10'))
+DB_QUERY_TIMEOUT = float(os.getenv('DB_QUERY_TIMEOUT', '10'))
+REQUISITION_CACHE_SIZE = int(os.getenv('REQUISITION_CACHE_SIZE', '5000'))
+MAX_MESSAGES = int(os.getenv('MAX_MESSAGES', '100'))
+USER_CACHE_SIZE = int(os.getenv('USER_CACHE_SIZE', '2000'))
+JOURNAL_FLUSH_INTERVAL = float(os.getenv('JOURNAL_FLUSH_INTERVAL', '2'))
+OUTBOUND_WORKERS = int(os.getenv('OUTBOUND_WORKERS', '4'))
+DM_COALESCE_WINDOW = float(os.getenv('DM_COALESCE_WINDOW', '2'))
+POST_EDIT_WINDOW = float(os.getenv('POST_EDIT_WINDOW', '1.5'))
+CONVERSATION_TIMEOUT = int(os.getenv('CONVERSATION_TIMEOUT', '300'))
+CONVERSATION_TTL = int(os.getenv('CONVERSATION_TTL', '1800'))
+DEADLINE_LANGUAGES = os.getenv('DEADLINE_LANGUAGES', 'en').split(',')
+DEADLINE_TIMEZONE = os.getenv('DEADLINE_TIMEZONE')
+EXPIRY_SWEEP_INTERVAL = int(os.getenv('EXPIRY_SWEEP_INTERVAL', '300'))
+EXPIRY_GRACE_HOURS = float(os.getenv('EXPIRY_GRACE_HOURS', '0'))
+STATS_COMPACTION_INTERVAL = int(os.getenv('STATS_COMPACTION_INTERVAL', '3600'))
+FEEDBACK_TTL = int(os.getenv('FEEDBACK_TTL', '86400'))
+# Set by launcher.py for each worker process; unset runs every shard in this process
+SHARD_COUNT = int(os.getenv('SHARD_COUNT')) if os.getenv('SHARD_COUNT') else None
+SHARD_IDS = [int(shard_id) for shard_id in os.getenv('SHARD_IDS').split(',')] if os.getenv('SHARD_IDS') else None
+SHARD_REPORT_INTERVAL = int(os.getenv('SHARD_REPORT_INTERVAL', '60'))
+# Metrics are served only when a port is set; each worker started by launcher.py adds its index
+METRICS_PORT = int(os.getenv('METRICS_PORT')) + int(os.getenv('WORKER_INDEX', '0')) if os.getenv('METRICS_PORT') else None
+METRICS_HOST = os.getenv('METRICS_HOST', '127.0.0.1')
+LOOP_LAG_THRESHOLD = float(os.getenv('LOOP_LAG_THRESHOLD', '0.25'))
+# Each worker started by launcher.py keeps its own snapshot
+SNAPSHOT_PATH = f"{os.getenv('SNAPSHOT_PATH')}.{os.getenv('WORKER_INDEX', '0')}" if os.getenv('SNAPSHOT_PATH') else None
+SNAPSHOT_MAX_AGE = int(os.getenv('SNAPSHOT_MAX_AGE', '86400'))
 
 if not DISCORD_TOKEN:
     logger.error("DISCORD_TOKEN not found in environment variables.")
@@ -27,20 +70,28 @@ intents = discord.Intents.default()
 intents.message_content = True
 intents.reactions = True
 intents.guilds = True
-intents.members = True
+# Members are never needed: reaction payloads carry the reacting member and everyone
+# else is resolved on demand through the cog's user cache.
+intents.members = False
 
-# Create the bot instance with a simple '!' prefix
-bot = commands.Bot(command_prefix='!', intents=intents, help_command=None)
+# Create the bot instance with a simple '!' prefix. Requisition reactions are handled
+# from raw gateway events, so the message cache only needs to be small, and no guild
+# members are chunked or cached.
+bot = commands.AutoShardedBot(
+    command_prefix='!', intents=intents, help_command=None, max_messages=MAX_MESSAGES,
+    member_cache_flags=discord.MemberCacheFlags.none(), chunk_guilds_at_startup=False,
+    shard_count=SHARD_COUNT, shard_ids=SHARD_IDS
+)
 
 @bot.event
 async def on_ready():
-    logger.info(f"Logged in as {bot.user}! Bot is in the following guilds: {[guild.name for guild in bot.guilds]}")
+    logger.info("Logged in as %s! Bot is in %d guilds.", bot.user, len(bot.guilds))
     all_commands = ', '.join([command.name for command in bot.commands])
-    logger.info(f"Available commands: {all_commands}")
+    logger.info("Available commands: %s", all_commands)
 
 @bot.event
 async def on_command_error(ctx, error):
-    logger.error(f"An error occurred: {str(error)}")
+    logger.error("An error occurred: %s", error)
     await ctx.send(f"An error occurred: {str(error)}")
 
 @bot.command(name='mm_help')
@@ -68,8 +119,20 @@ async def mm_help(ctx):
         "Or, simply type `!mm_update_request` and I'll guide you through the update process interactively, asking for each detail one step at a time.\n"
         "The person requesting the requisition can cancel it at any time by reacting with the red X.\n\n"
 
+        "**!mm_list [region]** / **!mm_search [material] region= payment= after= before=**\n"
+        "Finds open requisitions, e.g. `!mm_search iron region=Central`\n\n"
+
+        "**!mm_stats [days]**\n"
+        "Shows what's in demand, how quickly requisitions get accepted and completed, and who fulfils the most, over the last 30 days by default.\n\n"
+
+        "**!mm_reputation [@user]**\n"
+        "Shows the average rating requesters gave a user for the requisitions they fulfilled.\n\n"
+
+        "**!mm_export [csv|jsonl] [requisitions|feedback|channels]** (administrators)\n"
+        "Uploads a file with all of this server's requisitions, feedback or channel settings.\n\n"
+
         "**Feedback on Requisitions**\n"
-        "Once your requisition is completed and archived, I’ll send you a direct message to collect your feedback. It’s a great way to let others know who to work with!\n\n"
+        "Once your requisition is completed and archived, I’ll send you a direct message asking you to rate it from 1 to 5, with a few words if you like. Ratings add up to the reputation of whoever fulfilled it, so others know who to work with!\n\n"
         
         "**Support the Bot**\n"
         "If you find this bot helpful, please consider donating to support its development: https://ko-fi.com/jedespo\n"
@@ -89,10 +152,49 @@ async def on_guild_join(guild):
             break
 
 async def main():
-    async with bot:
-        conn = psycopg2.connect(DATABASE_URL, sslmode='require', cursor_factory=RealDictCursor)
-        await bot.add_cog(RequisitionFlow(bot, conn))
-        await bot.start(DISCORD_TOKEN)
+    storage = open_storage(DATABASE_URL, min_size=DB_POOL_MIN, max_size=DB_POOL_MAX, timeout=DB_QUERY_TIMEOUT, sslmode='require')
+    if not storage.shared and SHARD_IDS is not None and len(SHARD_IDS) < SHARD_COUNT:
+        logger.error("This DATABASE_URL can't be shared between workers; use Postgres or run a single worker.")
+        exit(1)
+    await storage.open()
+    await storage.migrate()
+    monitor = LoopMonitor(threshold=LOOP_LAG_THRESHOLD)
+    await monitor.start()
+    metrics_runner = None
+    if METRICS_PORT:
+        metrics_runner = await metrics.serve(METRICS_HOST, METRICS_PORT)
+        logger.info("Serving metrics on http://%s:%s/metrics", METRICS_HOST, METRICS_PORT)
+    try:
+        # Storage outlives the bot so cogs can flush pending writes while unloading
+        async with bot:
+            await bot.add_cog(RequisitionFlow(
+                bot, storage,
+                cache_size=REQUISITION_CACHE_SIZE,
+                journal_interval=JOURNAL_FLUSH_INTERVAL,
+                outbound_workers=OUTBOUND_WORKERS,
+                dm_coalesce_window=DM_COALESCE_WINDOW,
+                edit_window=POST_EDIT_WINDOW,
+                conversation_timeout=CONVERSATION_TIMEOUT,
+                conversation_ttl=CONVERSATION_TTL,
+                deadline_languages=DEADLINE_LANGUAGES,
+                deadline_timezone=DEADLINE_TIMEZONE,
+                shard_ids=SHARD_IDS,
+                shard_count=SHARD_COUNT,
+                user_cache_size=USER_CACHE_SIZE,
+                expiry_interval=EXPIRY_SWEEP_INTERVAL,
+                expiry_grace_hours=EXPIRY_GRACE_HOURS,
+                snapshot_path=SNAPSHOT_PATH,
+                snapshot_max_age=SNAPSHOT_MAX_AGE,
+                stats_interval=STATS_COMPACTION_INTERVAL,
+                feedback_ttl=FEEDBACK_TTL
+            ))
+            await bot.add_cog(ShardStats(bot, interval=SHARD_REPORT_INTERVAL))
+            await bot.start(DISCORD_TOKEN)
+    finally:
+        if metrics_runner:
+            await metrics_runner.cleanup()
+        await monitor.stop()
+        await storage.close()
 
 if __name__ == "__main__":
     asyncio.run(main())
@@ -0,0 +1,34 @@
+import asyncio
+from datetime import datetime, timedelta
+
+import pytest
+
+from cogs.sqlite_storage import SqliteStorage
+
+
+# Runs test(storage) on a fresh event loop against a migrated SQLite database in tmp_path
+@pytest.fixture
+def with_storage(tmp_path):
+    def run(test):
+        async def main():
+            storage = SqliteStorage(str(tmp_path / 'matmaster.db'))
+            await storage.open()
+            await storage.migrate()
+            try:
+                return await test(storage)
+            finally:
+                await storage.close()
+        return asyncio.run(main())
+    return run
+
+
+# A requisition row for storage.insert_requisition(), open for a week unless overridden
+@pytest.fixture
+def requisition_row():
+    def row(message_id, **overrides):
+        return dict({
+            'requester': 111, 'material': 'Iron', 'quantity': 10, 'payment': 'gold',
+            'deadline': datetime.now() + timedelta(days=7), 'accepted_by': [], 'completed_by': [],
+            'message_id': message_id, 'region': 'EU', 'guild_id': 1, 'completion_details': '', 'status': 'open'
+        }, **overrides)
+    return row
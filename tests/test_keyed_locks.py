@@ -0,0 +1,62 @@
+import asyncio
+
+import pytest
+
+from cogs.keyed_locks import KeyedLocks
+
+
+def test_same_key_runs_in_order_and_is_evicted():
+    async def test():
+        locks = KeyedLocks()
+        order = []
+
+        async def work(key, name):
+            async with locks.hold(key):
+                order.append(f"{name} in")
+                await asyncio.sleep(0.01)
+                order.append(f"{name} out")
+
+        first = asyncio.create_task(work(1, 'a'))
+        await asyncio.sleep(0)
+        waiting = [asyncio.create_task(work(1, name)) for name in ('b', 'c')]
+        other = asyncio.create_task(work(2, 'x'))
+        await asyncio.sleep(0)
+        assert len(locks) == 2
+        await asyncio.gather(first, other, *waiting)
+        assert [entry for entry in order if entry[0] != 'x'] == ['a in', 'a out', 'b in', 'b out', 'c in', 'c out']
+        # Another key isn't held up by key 1
+        assert order.index('x in') < order.index('a out')
+        assert len(locks) == 0
+    asyncio.run(test())
+
+
+def test_lock_is_evicted_after_error_and_cancellation():
+    async def test():
+        locks = KeyedLocks()
+        with pytest.raises(RuntimeError):
+            async with locks.hold(1):
+                raise RuntimeError('handler failed')
+        assert len(locks) == 0
+
+        release = asyncio.Event()
+
+        async def holder():
+            async with locks.hold(1):
+                await release.wait()
+
+        async def waiter():
+            async with locks.hold(1):
+                pass
+
+        held = asyncio.create_task(holder())
+        await asyncio.sleep(0)
+        waiting = asyncio.create_task(waiter())
+        await asyncio.sleep(0)
+        waiting.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await waiting
+        assert len(locks) == 1
+        release.set()
+        await held
+        assert len(locks) == 0
+    asyncio.run(test())
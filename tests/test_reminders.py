@@ -0,0 +1,91 @@
+import asyncio
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+
+import discord
+
+from cogs.reminders import MAX_ATTEMPTS, RETRY_DELAY, ReminderScheduler
+
+
+# Answers send_dm with a result, or with the exception given for the user
+class FakeOutbound:
+    def __init__(self, failures=None):
+        self.failures = failures or {}
+        self.sent = []
+
+    def send_dm(self, user_id, content, coalesce=True):
+        future = asyncio.get_running_loop().create_future()
+        if user_id in self.failures:
+            future.set_exception(self.failures[user_id])
+        else:
+            self.sent.append((user_id, content))
+            future.set_result(None)
+        return future
+
+
+def forbidden():
+    return discord.Forbidden(SimpleNamespace(status=403, reason='Forbidden'), 'Cannot send messages to this user')
+
+
+async def stored_reminders(storage):
+    return sorted(row['user_id'] for row in await storage.db.fetch("SELECT user_id FROM reminders;"))
+
+
+async def schedule_due(scheduler, *user_ids):
+    for user_id in user_ids:
+        await scheduler.schedule(1000 + user_id, 1, user_id, f"reminder for {user_id}", datetime.now() - timedelta(seconds=1))
+
+
+def test_failed_reminders_are_retried_with_backoff(with_storage):
+    async def test(storage):
+        outbound = FakeOutbound({2: ConnectionError('gateway gone'), 3: forbidden()})
+        scheduler = ReminderScheduler(None, storage, outbound)
+        await schedule_due(scheduler, 1, 2, 3)
+        before = datetime.now()
+        await scheduler.deliver(scheduler._pop_due(datetime.now()))
+        assert outbound.sent == [(1, 'reminder for 1')]
+        # Delivered and closed-DM reminders are deleted; the failed one waits for its retry
+        assert await stored_reminders(storage) == [2]
+        assert scheduler._pop_due(datetime.now()) == []
+        (due_at, reminder_id), = scheduler.heap
+        assert scheduler.pending[reminder_id][1] == 2
+        assert due_at >= before + timedelta(seconds=RETRY_DELAY)
+
+        # Each attempt waits longer, until the scheduler gives up and deletes it
+        due_times = []
+        while scheduler.heap:
+            due_at, _ = scheduler.heap[0]
+            due_times.append(due_at)
+            await scheduler.deliver(scheduler._pop_due(due_at))
+        assert len(due_times) == MAX_ATTEMPTS - 1
+        for index, (earlier, later) in enumerate(zip(due_times, due_times[1:])):
+            assert later - earlier >= timedelta(seconds=RETRY_DELAY * 2 ** index)
+        assert await stored_reminders(storage) == []
+        assert len(scheduler) == 0 and scheduler.attempts == {}
+    with_storage(test)
+
+
+def test_sent_reminders_are_not_resent_when_the_delete_fails(with_storage):
+    async def test(storage):
+        outbound = FakeOutbound()
+        scheduler = ReminderScheduler(None, storage, outbound)
+        await schedule_due(scheduler, 1, 2)
+        delete = storage.delete_reminders_by_id
+
+        async def failing_delete(reminder_ids):
+            raise ConnectionError('database gone')
+        storage.delete_reminders_by_id = failing_delete
+        await scheduler.deliver(scheduler._pop_due(datetime.now()))
+        assert len(outbound.sent) == 2
+        assert len(scheduler) == 0 and scheduler.heap == []
+        # Still stored, but a reload doesn't pick them up again
+        assert await stored_reminders(storage) == [1, 2]
+        await scheduler.load()
+        assert len(scheduler) == 0
+
+        storage.delete_reminders_by_id = delete
+        await schedule_due(scheduler, 3)
+        await scheduler.deliver(scheduler._pop_due(datetime.now()))
+        assert len(outbound.sent) == 3
+        assert await stored_reminders(storage) == [] and scheduler.finished == set()
+    with_storage(test)
@@ -0,0 +1,67 @@
+import io
+from datetime import datetime
+
+from cogs.requisition_cache import STATUS_ARCHIVED, STATUS_OPEN, STATUS_PENDING
+from cogs.transfer import read_batches, validate_batch
+
+NOW = datetime(2030, 1, 1)
+
+CSV = """requester,material,quantity,payment,deadline,region,guild_id,message_id,accepted_by,completed_by,status
+111,Iron,10,gold,2030-02-01 12:00,EU,1,,,,
+111,Iron,10,gold,2030-02-01 12:00,EU,1,5001,7 8,,accepted
+,Iron,10,gold,2030-02-01 12:00,EU,1,,,,
+111,Iron,0,gold,2030-02-01 12:00,EU,1,,,,
+111,Iron,10,gold,2029-12-01 12:00,EU,1,,,,
+111,Iron,10,gold,2030-02-01 12:00,EU,1,,,,completed
+111,Iron,10,gold,tomorrow,EU,1,,,,
+111,Iron,10,gold,2029-12-01 12:00,EU,1,5002,7,7,archived
+111,Iron,10,gold,2030-02-01 12:00,EU,1,,,,lost
+"""
+
+
+def validated(text, file_format='csv', guild_id=None):
+    batch, = read_batches(io.StringIO(text), file_format, 100)
+    return validate_batch(batch, guild_id, NOW)
+
+
+def test_validate_batch_accepts_valid_rows():
+    rows, errors = validated(CSV)
+    assert [(row['message_id'], row['status'], list(row['accepted_by'])) for row in rows] == [
+        (None, STATUS_PENDING, []), (5001, 'accepted', [7, 8]), (5002, STATUS_ARCHIVED, [7])
+    ]
+    assert rows[0]['deadline'] == datetime(2030, 2, 1, 12, 0)
+
+
+def test_validate_batch_reports_the_first_error_per_line():
+    rows, errors = validated(CSV)
+    assert errors == [
+        (4, "requester is required"),
+        (5, "quantity must be between 1 and 2147483647"),
+        (6, "deadline has already passed"),
+        (7, "completed requisitions need their message_id"),
+        (8, "invalid deadline: 'tomorrow'"),
+        (10, "unknown status 'lost'")
+    ]
+
+
+def test_validate_batch_reads_jsonl_and_forces_the_guild():
+    text = '{"requester": 111, "material": "Iron", "quantity": 10, "payment": "gold", ' \
+           '"deadline": "2030-02-01T12:00:00", "region": "EU", "guild_id": 2, "status": "Open", "message_id": 5003}\n' \
+           '{"requester": 111, "material": "Iron", "quantity": 10.5}\n' \
+           'not json\n'
+    rows, errors = validated(text, 'jsonl', guild_id=9)
+    assert [(row['guild_id'], row['status'], row['message_id']) for row in rows] == [(9, STATUS_OPEN, 5003)]
+    assert [line for line, _ in errors] == [2, 3]
+    assert errors[0][1] == "invalid quantity: 10.5"
+    assert errors[1][1].startswith("invalid JSON")
+
+
+def test_validated_rows_can_be_stored(with_storage):
+    async def test(storage):
+        rows, _ = validated(CSV)
+        await storage.insert_requisitions(rows)
+        stored = await storage.db.fetch("SELECT message_id, status FROM requisitions ORDER BY id;")
+        assert [(row['message_id'], row['status']) for row in stored] == [
+            (None, STATUS_PENDING), (5001, 'accepted'), (5002, STATUS_ARCHIVED)
+        ]
+    with_storage(test)
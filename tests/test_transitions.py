@@ -0,0 +1,75 @@
+import asyncio
+from datetime import datetime, timedelta
+
+from benchmarks.fake_discord import reaction
+from benchmarks.load_test import Harness
+from cogs.requisition_cache import STATUS_ACCEPTED, STATUS_ARCHIVED, STATUS_COMPLETED, STATUS_EXPIRED, STATUS_OPEN
+
+
+async def status_and_version(storage, message_id):
+    row = await storage.db.fetchrow("SELECT status, version FROM requisitions WHERE message_id = ?;", (message_id,))
+    return row['status'], row['version']
+
+
+def test_racing_transitions_apply_once(with_storage, requisition_row):
+    async def test(storage):
+        await storage.insert_requisition(requisition_row(1001, status=STATUS_COMPLETED))
+        results = await asyncio.gather(*(
+            storage.transition(1001, STATUS_ARCHIVED, (STATUS_COMPLETED,), fulfilled_by=[222]) for _ in range(5)
+        ))
+        assert [result for result in results if result is not None] == [1]
+        assert await status_and_version(storage, 1001) == (STATUS_ARCHIVED, 1)
+    with_storage(test)
+
+
+def test_transition_loses_to_expiry(with_storage, requisition_row):
+    async def test(storage):
+        await storage.insert_requisition(requisition_row(1001, deadline=datetime.now() - timedelta(minutes=1)))
+        expired = await storage.expire_requisitions(datetime.now(), 10)
+        assert [row['message_id'] for row in expired] == [1001]
+        assert await storage.transition(1001, STATUS_ACCEPTED, (STATUS_OPEN,)) is None
+        assert await status_and_version(storage, 1001) == (STATUS_EXPIRED, 1)
+    with_storage(test)
+
+
+def test_stale_version_update_is_rejected(with_storage, requisition_row):
+    async def test(storage):
+        await storage.insert_requisition(requisition_row(1001))
+        # Another process accepts the requisition after this one read version 0
+        assert await storage.transition(1001, STATUS_ACCEPTED, (STATUS_OPEN,)) == 1
+        deadline = datetime.now() + timedelta(days=14)
+        assert await storage.update_requisition(1001, 0, 99, 'silver', deadline) is None
+        row = await storage.get_requisition(1001, (STATUS_ACCEPTED,))
+        assert (row['quantity'], row['payment'], row['version']) == (10, 'gold', 1)
+        assert await storage.update_requisition(1001, 1, 99, 'silver', deadline) == 2
+        row = await storage.get_requisition(1001, (STATUS_ACCEPTED,))
+        assert (row['quantity'], row['payment']) == (99, 'silver')
+    with_storage(test)
+
+
+def test_repeated_confirmations_archive_once(tmp_path):
+    async def test():
+        harness = Harness(f"sqlite:///{tmp_path / 'matmaster.db'}", 1)
+        await harness.open()
+        await harness.start()
+        try:
+            cog = harness.cog
+            guild_id, channel_id = harness.guilds[0]
+            await harness.create(0, 111)
+            message_id = next(iter(cog.active_requisitions.entries))
+            worker, requester = harness.bot.member(222), harness.bot.member(111)
+            await cog.on_raw_reaction_add(reaction(guild_id, channel_id, message_id, worker, '✋'))
+            await cog.on_raw_reaction_add(reaction(guild_id, channel_id, message_id, worker, '✅'))
+            requisition = cog.active_requisitions.get(message_id)
+            await cog.record_completion_details({'message_id': message_id, 'material': requisition.material}, 'At the dock')
+            await asyncio.gather(*(
+                cog.on_raw_reaction_add(reaction(guild_id, channel_id, message_id, requester, '✅')) for _ in range(5)
+            ))
+            archive_channel = next(channel for channel in harness.bot.channels.values()
+                                   if channel.guild_id == guild_id and channel.id != channel_id)
+            assert archive_channel.sent == 1
+            assert (await status_and_version(harness.storage, message_id))[0] == STATUS_ARCHIVED
+            assert len(cog.locks) == 0
+        finally:
+            await harness.close()
+    asyncio.run(test())
@@ -0,0 +1,53 @@
+import pytest
+
+from cogs.requisition_cache import STATUS_ACCEPTED, STATUS_OPEN
+from cogs.write_behind import ReactionJournal
+
+
+async def participants(storage, message_id):
+    row = await storage.get_requisition(message_id, (STATUS_OPEN, STATUS_ACCEPTED))
+    return row['accepted_by'], row['completed_by']
+
+
+def test_flush_patches_the_stored_lists(with_storage, requisition_row):
+    async def test(storage):
+        await storage.insert_requisition(requisition_row(1001, accepted_by=[7]))
+        journal = ReactionJournal(storage)
+        journal.record(1001, 'accepted_by', 8, True)
+        journal.record(1001, 'accepted_by', 7, False)
+        journal.record(1001, 'completed_by', 8, True)
+        await journal.flush()
+        assert len(journal) == 0
+        assert await participants(storage, 1001) == ([8], [8])
+    with_storage(test)
+
+
+def test_failed_flush_is_merged_under_newer_changes(with_storage, requisition_row):
+    async def test(storage):
+        await storage.insert_requisition(requisition_row(1001))
+        await storage.insert_requisition(requisition_row(1002))
+        journal = ReactionJournal(storage)
+        journal.record(1001, 'accepted_by', 7, True)
+        journal.record(1001, 'accepted_by', 8, True)
+        journal.record(1002, 'accepted_by', 9, True)
+        apply_reactions = storage.apply_reactions
+
+        async def failing_apply(rows):
+            # Changes arrive while the batch is in flight, then the write fails
+            journal.record(1001, 'accepted_by', 8, False)
+            journal.record(1001, 'completed_by', 7, True)
+            raise ConnectionError('database gone')
+        storage.apply_reactions = failing_apply
+        with pytest.raises(ConnectionError):
+            await journal.flush()
+        assert await participants(storage, 1001) == ([], [])
+        # The newer change for user 8 wins over the failed batch's
+        assert journal.pending[1001] == {'accepted_by': {7: True, 8: False}, 'completed_by': {7: True}}
+        assert journal.pending[1002] == {'accepted_by': {9: True}, 'completed_by': {}}
+
+        storage.apply_reactions = apply_reactions
+        await journal.flush()
+        assert len(journal) == 0
+        assert await participants(storage, 1001) == ([7], [7])
+        assert await participants(storage, 1002) == ([9], [])
+    with_storage(test)